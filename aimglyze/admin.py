@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import json
+import time
+import uuid
+import hmac
+import threading
+import logging
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# 管理令牌环境变量，优先于配置文件中的 server.admin_token
+ADMIN_TOKEN_ENV = 'AIMGLYZE_ADMIN_TOKEN'
+# 每处理多少个条目让出一次，避免长时间占用 I/O 与 GIL
+TASK_BATCH_SIZE = 100
+# 保留的已结束任务数
+MAX_FINISHED_TASKS = 50
+
+
+def get_admin_token(config):
+    """管理令牌，为空表示不启用管理接口"""
+    return os.environ.get(ADMIN_TOKEN_ENV) or config['server']['admin_token']
+
+
+def check_token(expected, given):
+    return bool(expected and given) and hmac.compare_digest(
+        expected.encode('utf-8'), given.encode('utf-8'))
+
+
+class AdminTask(object):
+    """后台维护任务及其进度"""
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.status = 'queued'  # queued, running, done, failed
+        self.total = 0
+        self.done = 0
+        self.result = {}
+        self.error = None
+        self.created = time.time()
+        self.started = self.finished = None
+
+    def to_dict(self):
+        return dict(id=self.id, kind=self.kind, params=self.params,
+                    status=self.status, total=self.total, done=self.done,
+                    progress=round(self.done / self.total, 4)
+                    if self.total else (1.0 if self.status == 'done' else 0.0),
+                    result=self.result, error=self.error,
+                    created=self.created, started=self.started,
+                    finished=self.finished)
+
+    @classmethod
+    def from_dict(cls, data):
+        task = cls(data['kind'], data['params'])
+        for name in ('id', 'status', 'total', 'done', 'result', 'error',
+                     'created', 'started', 'finished'):
+            setattr(task, name, data[name])
+        return task
+
+
+class TaskManager(object):
+    """
+    运行中服务器的维护任务：直接操作服务器的内存映射，逐条增量处理，
+    不重新扫描目录，处理结果立即反映到 results_cache、cache_files 等。
+    同一类任务同时只运行一个。
+    多进程模式下任务状态同时写入 state_dir，任一进程都能查询进度。
+    """
+
+    def __init__(self, server, batch_size=TASK_BATCH_SIZE, state_dir=None):
+        self.server = server
+        self.batch_size = batch_size
+        self.state_dir = Path(state_dir) if state_dir else None
+        if self.state_dir is not None:
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.runners = {
+            'clean-cache': self.clean_cache,
+            'clean-uploads': self.clean_uploads,
+            'compact': self.compact,
+        }
+
+    def submit(self, kind, params=None):
+        """提交任务，类型未知抛出 ValueError，同类任务运行中抛出 RuntimeError"""
+        if kind not in self.runners:
+            raise ValueError(f"未知任务类型: {kind}")
+        with self.lock:
+            for task in self.tasks.values():
+                if task.kind == kind and task.status in ('queued', 'running'):
+                    raise RuntimeError(f"任务 {task.id} ({kind}) 正在运行")
+            task = AdminTask(kind, params or {})
+            self.tasks[task.id] = task
+            self.prune()
+        self.save(task)
+        threading.Thread(target=self.run, args=(task,), daemon=True,
+                         name=f"aimglyze-admin-{task.id}").start()
+        return task
+
+    def prune(self):
+        finished = [t for t in self.tasks.values()
+                    if t.status in ('done', 'failed')]
+        for task in sorted(finished, key=lambda t: t.created)[
+                :max(0, len(finished) - MAX_FINISHED_TASKS)]:
+            self.tasks.pop(task.id, None)
+            if self.state_dir is not None:
+                try:
+                    os.unlink(self.state_dir / f"{task.id}.json")
+                except OSError:
+                    pass
+
+    def save(self, task):
+        """多进程模式下写出任务状态"""
+        if self.state_dir is None:
+            return
+        path = self.state_dir / f"{task.id}.json"
+        tmp_path = path.with_name(f".{task.id}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(task.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        try:
+            return AdminTask.from_dict(self.read_cache(path))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get(self, task_id):
+        task = self.tasks.get(task_id)
+        if task is None and self.state_dir is not None \
+                and task_id.isalnum():
+            # 其他进程提交的任务
+            task = self.load(self.state_dir / f"{task_id}.json")
+        return task
+
+    def list(self):
+        tasks = dict(self.tasks)
+        if self.state_dir is not None:
+            for path in self.state_dir.glob('*.json'):
+                if path.stem not in tasks:
+                    task = self.load(path)
+                    if task is not None:
+                        tasks[task.id] = task
+        return [t.to_dict() for t in sorted(
+            tasks.values(), key=lambda t: t.created, reverse=True)]
+
+    def run(self, task):
+        task.status = 'running'
+        task.started = time.time()
+        self.save(task)
+        log.info("管理任务开始: %s [%s]", task.kind, task.id)
+        try:
+            self.runners[task.kind](task, **task.params)
+            task.status = 'done'
+            log.info("管理任务完成: %s [%s] %s", task.kind, task.id, task.result)
+        except Exception as e:
+            task.status = 'failed'
+            task.error = str(e)
+            log.exception("管理任务失败: %s [%s]", task.kind, task.id)
+        finally:
+            task.finished = time.time()
+            self.save(task)
+
+    def step(self, task):
+        """完成一个条目，每批让出一次"""
+        task.done += 1
+        if task.done % self.batch_size == 0:
+            self.save(task)
+            time.sleep(0)
+
+    def read_cache(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def clean_cache(self, task):
+        """按缓存文件映射清理过期缓存，只解析修改时间已过期的文件；其他持久层调用 expire"""
+        server = self.server
+        max_age = server.cache_max_age + server.stale_window
+        items = list(server.cache_files.items())
+        task.total = len(items)
+        task.result = dict(deleted=0)
+        now = time.time()
+        for cache_key, info in items:
+            self.step(task)
+            if now - info['mtime'] <= max_age:
+                continue
+            try:
+                cache_time = self.read_cache(info['path']).get(
+                    'timestamp', info['mtime'])
+            except FileNotFoundError:
+                server.forget_cache(cache_key)
+                continue
+            except Exception:
+                cache_time = info['mtime']
+            if now - cache_time <= max_age:
+                continue
+            try:
+                os.unlink(info['path'])
+            except FileNotFoundError:
+                pass
+            server.forget_cache(cache_key)
+            task.result['deleted'] += 1
+        # 其他持久层 (Redis 层由服务器按过期时间删除)
+        for backend in server.cache_backends:
+            if backend.name != 'disk':
+                task.result['deleted'] += backend.expire(max_age)
+
+    def clean_uploads(self, task, threshold=0.5, dry_run=False):
+        """按上传文件映射清理置信度低于 threshold 的上传文件及其缓存"""
+        server = self.server
+        if not server.save_upload:
+            raise RuntimeError("上传保存功能未启用")
+        threshold = float(threshold)
+        items = list(server.file_hash_map.items())
+        task.total = len(items)
+        task.result = dict(matched=0, deleted=0, dry_run=bool(dry_run))
+        for file_hash, file_path in items:
+            self.step(task)
+            cache_key = server.result_key(file_hash)
+            cache_data = server.results_cache.get(cache_key)
+            if cache_data is None:
+                try:
+                    cache_data = self.read_cache(
+                        server.get_cache_file_path(cache_key))
+                except Exception:
+                    continue
+            result = cache_data.get('result')
+            confidence = result.get('confidence', 1.0) \
+                if isinstance(result, dict) else 1.0
+            if not isinstance(confidence, (int, float)) \
+                    or confidence >= threshold:
+                continue
+            task.result['matched'] += 1
+            if dry_run:
+                continue
+            for path in (file_path, server.get_cache_file_path(cache_key)):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            server.file_hash_map.pop(file_hash, None)
+            server.forget_cache(cache_key)
+            task.result['deleted'] += 1
+
+    def compact(self, task):
+        """
+        压缩缓存: 删除中断遗留的临时文件和无法解析的缓存文件，
+        移除内存中已过期的结果，重写感知哈希索引
+        """
+        server = self.server
+        max_age = server.cache_max_age + server.stale_window
+        items = list(server.cache_files.items())
+        task.total = len(items)
+        task.result = dict(temp_files=0, corrupt=0, memory_evicted=0)
+        with os.scandir(server.cache_dir) as it:
+            for entry in it:
+                # 临时文件写入后立即替换，超过 1 分钟的视为遗留
+                if entry.name.endswith('.tmp') and entry.is_file() \
+                        and time.time() - entry.stat().st_mtime > 60:
+                    try:
+                        os.unlink(entry.path)
+                        task.result['temp_files'] += 1
+                    except OSError:
+                        pass
+        for cache_key, info in items:
+            self.step(task)
+            try:
+                self.read_cache(info['path'])
+            except FileNotFoundError:
+                server.forget_cache(cache_key)
+            except (ValueError, UnicodeDecodeError):
+                os.unlink(info['path'])
+                server.forget_cache(cache_key)
+                task.result['corrupt'] += 1
+        task.result['memory_evicted'] = server.results_cache.expire(max_age)
+        if server.phash_index is not None:
+            server.phash_index.compact()
+            task.result['phash_entries'] = len(server.phash_index)
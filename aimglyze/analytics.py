@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import sys
+import json
+import math
+import threading
+import logging
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# 评分者，依次对应 total_score 中的自评、互评、师评
+RATERS = ('self', 'peer', 'teacher')
+# 快照格式版本，不一致时丢弃重建
+SNAPSHOT_VERSION = 1
+PERCENTILES = (10, 25, 50, 75, 90)
+# 稳健 z 分数 (中位数与 MAD) 超过此值视为异常
+OUTLIER_Z = 3.5
+# 每类异常最多列出的条目数
+MAX_OUTLIERS = 50
+
+
+def import_numpy():
+    """延迟导入 NumPy，未安装时给出安装提示"""
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("统计分析需要 NumPy: pip install numpy") from None
+    return numpy
+
+
+def to_number(value, default=0.0):
+    """分数字段转为浮点数，无法转换时返回 default"""
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_task_score(cache_data):
+    """
+    从评价表缓存中取出 (标题, 置信度, 总分[3], 维度列表)，
+    维度为 (名称, 满分, 得分[3])，各要点得分按评分者求和。
+    不是评价表结果时返回 None
+    """
+    result = cache_data.get('result') if cache_data else None
+    if not isinstance(result, dict):
+        return None
+    dimensions = []
+    for dim in result.get('dimensions') or []:
+        if not isinstance(dim, dict):
+            continue
+        points = [p for p in dim.get('points') or [] if isinstance(p, dict)]
+        scores = [sum(to_number(p.get(r)) for p in points) for r in RATERS]
+        maximum = to_number(dim.get('score')) or sum(
+            to_number(p.get('score')) for p in points)
+        dimensions.append((str(dim.get('desc') or '').strip(),
+                           maximum, scores))
+    if not dimensions:
+        return None
+    total = result.get('total_score')
+    if isinstance(total, list) and len(total) == len(RATERS):
+        totals = [to_number(x, math.nan) for x in total]
+    else:
+        totals = [sum(d[2][i] for d in dimensions)
+                  for i in range(len(RATERS))]
+    return (str(result.get('table_title') or '').strip(),
+            to_number(result.get('confidence'), math.nan),
+            totals, dimensions)
+
+
+def clean(value, digits=4):
+    """NumPy 数值转为可 JSON 序列化的值，NaN 转为 None"""
+    if isinstance(value, (list, tuple)):
+        return [clean(v, digits) for v in value]
+    if hasattr(value, 'tolist'):
+        return clean(value.tolist(), digits)
+    if isinstance(value, float):
+        return None if math.isnan(value) else round(value, digits)
+    return value
+
+
+class ScoreTable(object):
+    """
+    评价表结果的列式表 (NumPy)，按缓存文件的修改时间增量维护，
+    并保存为 .npz 快照，重复统计时不必重新解析全部缓存文件。
+
+    - 每条结果一行: keys, mtimes, title (标题编号), timestamp,
+      confidence, totals[n, 3]
+    - 每个评价维度一行 (长表): dim_row (所属结果行), dim_name (维度编号),
+      dim_max (满分), dim_scores[m, 3]
+    - 不是评价表的缓存记在 skip_keys/skip_mtimes 中，同样不重复解析
+    """
+
+    def __init__(self, path):
+        self.np = import_numpy()
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.reset()
+        self.load()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def reset(self):
+        np = self.np
+        self.keys = np.array([], dtype=str)
+        self.mtimes = np.zeros(0)
+        self.title = np.zeros(0, dtype=np.int32)
+        self.timestamp = np.zeros(0)
+        self.confidence = np.zeros(0, dtype=np.float32)
+        self.totals = np.zeros((0, len(RATERS)), dtype=np.float32)
+        self.dim_row = np.zeros(0, dtype=np.int32)
+        self.dim_name = np.zeros(0, dtype=np.int32)
+        self.dim_max = np.zeros(0, dtype=np.float32)
+        self.dim_scores = np.zeros((0, len(RATERS)), dtype=np.float32)
+        self.titles, self.title_ids = [], {}
+        self.dim_names, self.dim_name_ids = [], {}
+        self.skipped = {}
+
+    def load(self):
+        """读取快照，不存在或格式不符时从空表开始"""
+        if not self.path.exists():
+            return
+        np = self.np
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if int(data['version']) != SNAPSHOT_VERSION:
+                    raise ValueError(f"快照版本不符: {int(data['version'])}")
+                for name in ('keys', 'mtimes', 'title', 'timestamp',
+                             'confidence', 'totals', 'dim_row', 'dim_name',
+                             'dim_max', 'dim_scores'):
+                    setattr(self, name, data[name])
+                self.titles = data['titles'].tolist()
+                self.dim_names = data['dim_names'].tolist()
+                self.skipped = dict(zip(data['skip_keys'].tolist(),
+                                        data['skip_mtimes'].tolist()))
+        except Exception as e:
+            log.warning("读取统计快照失败，将重新构建: %s", e)
+            self.reset()
+            return
+        self.title_ids = {t: i for i, t in enumerate(self.titles)}
+        self.dim_name_ids = {n: i for i, n in enumerate(self.dim_names)}
+        log.info("已加载统计快照: %s 条评价结果", len(self))
+
+    def save(self):
+        """原子写入快照"""
+        np = self.np
+        temp_file = self.path.with_name(
+            f"{self.path.name}.{os.getpid()}.tmp")
+        try:
+            with open(temp_file, 'wb') as f:
+                np.savez(
+                    f, version=SNAPSHOT_VERSION,
+                    keys=self.keys, mtimes=self.mtimes, title=self.title,
+                    timestamp=self.timestamp, confidence=self.confidence,
+                    totals=self.totals, dim_row=self.dim_row,
+                    dim_name=self.dim_name, dim_max=self.dim_max,
+                    dim_scores=self.dim_scores,
+                    titles=np.array(self.titles, dtype=str),
+                    dim_names=np.array(self.dim_names, dtype=str),
+                    skip_keys=np.array(list(self.skipped), dtype=str),
+                    skip_mtimes=np.array(list(self.skipped.values()),
+                                         dtype=float))
+            os.replace(temp_file, self.path)
+        except Exception as e:
+            log.warning("保存统计快照失败: %s", e)
+            try:
+                os.unlink(temp_file)
+            except OSError:
+                pass
+
+    def vocab_id(self, vocab, ids, name):
+        if name not in ids:
+            ids[name] = len(vocab)
+            vocab.append(name)
+        return ids[name]
+
+    def refresh(self, cache_files, load):
+        """
+        与缓存文件映射对齐: 丢弃已删除或已修改的行，只解析新增或修改的
+        缓存文件，load(cache_key) 返回缓存数据或 None。
+        有变化时保存快照，返回 (新增数, 删除数)
+        """
+        np = self.np
+        with self.lock:
+            current = {key: info['mtime'] for key, info in
+                       list(cache_files.items())}
+            keep = np.fromiter(
+                (current.get(k) == m for k, m in
+                 zip(self.keys.tolist(), self.mtimes.tolist())),
+                dtype=bool, count=len(self.keys))
+            skipped = {k: m for k, m in self.skipped.items()
+                       if current.get(k) == m}
+            known = set(self.keys[keep].tolist()) | set(skipped)
+            rows = []  # [(cache_key, mtime, timestamp, parsed), ...]
+            for cache_key, mtime in current.items():
+                if cache_key in known:
+                    continue
+                cache_data = load(cache_key)
+                parsed = parse_task_score(cache_data)
+                if parsed is None:
+                    # 读取失败的不记录，下次再试
+                    if cache_data is not None:
+                        skipped[cache_key] = mtime
+                    continue
+                rows.append((cache_key, mtime,
+                             to_number(cache_data.get('timestamp')), parsed))
+            removed = int(len(keep) - keep.sum())
+            if not rows and not removed and len(skipped) == len(
+                    self.skipped):
+                return 0, 0
+            self.skipped = skipped
+            self.merge(keep, rows)
+            self.save()
+            return len(rows), removed
+
+    def merge(self, keep, rows):
+        """保留 keep 选中的行，追加新解析的行"""
+        np = self.np
+        # 旧行号到新行号的映射，维度行随所属结果一起保留
+        remap = np.cumsum(keep, dtype=np.int32) - 1
+        dim_keep = keep[self.dim_row]
+        dim_row = [remap[self.dim_row[dim_keep]]]
+        dim_name = [self.dim_name[dim_keep]]
+        dim_max = [self.dim_max[dim_keep]]
+        dim_scores = [self.dim_scores[dim_keep]]
+        base = int(keep.sum())
+        titles, dims = [], []
+        for i, (_, _, _, parsed) in enumerate(rows):
+            title, _, _, dimensions = parsed
+            titles.append(self.vocab_id(self.titles, self.title_ids, title))
+            for name, maximum, scores in dimensions:
+                dims.append((base + i, self.vocab_id(
+                    self.dim_names, self.dim_name_ids, name),
+                    maximum, scores))
+        if dims:
+            dim_row.append(np.array([d[0] for d in dims], dtype=np.int32))
+            dim_name.append(np.array([d[1] for d in dims], dtype=np.int32))
+            dim_max.append(np.array([d[2] for d in dims], dtype=np.float32))
+            dim_scores.append(np.array([d[3] for d in dims],
+                                       dtype=np.float32))
+        self.dim_row = np.concatenate(dim_row)
+        self.dim_name = np.concatenate(dim_name)
+        self.dim_max = np.concatenate(dim_max)
+        self.dim_scores = np.concatenate(dim_scores)
+        self.keys = np.concatenate([
+            self.keys[keep], np.array([r[0] for r in rows], dtype=str)])
+        self.mtimes = np.concatenate([
+            self.mtimes[keep], np.array([r[1] for r in rows], dtype=float)])
+        self.timestamp = np.concatenate([
+            self.timestamp[keep],
+            np.array([r[2] for r in rows], dtype=float)])
+        self.title = np.concatenate([
+            self.title[keep], np.array(titles, dtype=np.int32)])
+        self.confidence = np.concatenate([
+            self.confidence[keep],
+            np.array([r[3][1] for r in rows], dtype=np.float32)])
+        self.totals = np.concatenate([
+            self.totals[keep],
+            np.array([r[3][2] for r in rows], dtype=np.float32).reshape(
+                -1, len(RATERS))])
+
+    def scope(self, owns):
+        """owns(cache_key) 为真的行，owns 为 None 时全部 (调用时持有锁)"""
+        np = self.np
+        if owns is None:
+            return np.ones(len(self.keys), dtype=bool)
+        return np.fromiter(map(owns, self.keys.tolist()), dtype=bool,
+                           count=len(self.keys))
+
+    def cohorts(self, owns=None):
+        """
+        按评价表标题分组的人数与各评分者的平均总分，
+        owns 见 select
+        """
+        np = self.np
+        with self.lock:
+            rows = self.scope(owns)
+            title, totals = self.title[rows], self.totals[rows]
+            titles = list(self.titles)
+        counts = np.bincount(title, minlength=len(titles))
+        sums = [np.bincount(title, weights=np.nan_to_num(totals[:, i]),
+                            minlength=len(titles))
+                for i in range(len(RATERS))]
+        cohorts = []
+        for i in np.flatnonzero(counts).tolist():
+            n = int(counts[i])
+            cohorts.append(dict(
+                title=titles[i], count=n,
+                mean_total={r: clean(float(sums[k][i]) / n)
+                            for k, r in enumerate(RATERS)}))
+        cohorts.sort(key=lambda c: -c['count'])
+        return cohorts
+
+    def select(self, title=None, owns=None):
+        """
+        取出一个分组 (title 为 None 时全部) 的列，返回列字典。
+        快照包含共用缓存目录中所有配置的结果，owns 不为 None 时
+        只取 owns(cache_key) 为真的行 (通常为当前分析器配置的结果)
+        """
+        np = self.np
+        with self.lock:
+            rows = self.scope(owns)
+            if title is not None:
+                tid = self.title_ids.get(title, -1)
+                rows &= self.title == tid
+            dim_mask = rows[self.dim_row]
+            remap = np.cumsum(rows) - 1
+            return dict(
+                keys=self.keys[rows], totals=self.totals[rows],
+                confidence=self.confidence[rows],
+                dim_row=remap[self.dim_row[dim_mask]],
+                dim_name=self.dim_name[dim_mask],
+                dim_max=self.dim_max[dim_mask],
+                dim_scores=self.dim_scores[dim_mask],
+                dim_names=list(self.dim_names))
+
+    def describe(self, values):
+        """一组数值的计数、均值、标准差、极值与分位数"""
+        np = self.np
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return dict(count=0)
+        return dict(
+            count=int(len(values)), mean=clean(float(values.mean())),
+            std=clean(float(values.std())), min=clean(float(values.min())),
+            max=clean(float(values.max())),
+            percentiles=dict(zip(
+                (f"p{p}" for p in PERCENTILES),
+                clean(np.percentile(values, PERCENTILES)))))
+
+    def correlation(self, matrix, labels):
+        """按列计算相关系数，只使用各列都有值的行"""
+        np = self.np
+        matrix = matrix[~np.isnan(matrix).any(axis=1)]
+        if len(matrix) < 3 or not len(labels):
+            return dict(labels=labels, count=int(len(matrix)), matrix=None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = np.corrcoef(matrix, rowvar=False)
+        return dict(labels=labels, count=int(len(matrix)),
+                    matrix=clean(np.atleast_2d(corr)))
+
+    def outliers(self, values, keys, threshold):
+        """稳健 z 分数 0.6745 * (x - 中位数) / MAD 超过阈值的条目"""
+        np = self.np
+        valid = ~np.isnan(values)
+        if valid.sum() < 3:
+            return []
+        median = np.median(values[valid])
+        mad = np.median(np.abs(values[valid] - median))
+        if mad == 0:
+            return []
+        z = 0.6745 * (values - median) / mad
+        idx = np.flatnonzero(valid & (np.abs(z) > threshold))
+        idx = idx[np.argsort(-np.abs(z[idx]))][:MAX_OUTLIERS]
+        return [dict(cache_key=str(keys[i]), value=clean(float(values[i])),
+                     z=clean(float(z[i]), 2)) for i in idx.tolist()]
+
+    def report(self, title=None, rater='teacher', bins=10,
+               threshold=OUTLIER_Z, owns=None):
+        """
+        一个分组的统计报告:
+        - distribution: 总分直方图与描述统计
+        - dimensions: 各维度得分率 (得分/满分) 的均值与分位数
+        - correlations: 评分者之间、维度之间的相关系数
+        - outliers: 总分异常、自评与师评差异异常的条目
+        owns 见 select
+        """
+        np = self.np
+        if rater not in RATERS:
+            raise ValueError(f"rater must be one of {', '.join(RATERS)}")
+        if not 1 <= bins <= 100:
+            raise ValueError("bins must be between 1 and 100")
+        r = RATERS.index(rater)
+        data = self.select(title, owns)
+        keys, totals = data['keys'], data['totals'].astype(float)
+        n = len(keys)
+        scores = totals[:, r]
+        valid = scores[~np.isnan(scores)]
+        upper = max(100.0, float(valid.max())) if len(valid) else 100.0
+        hist, edges = np.histogram(valid, bins=bins, range=(0, upper))
+        # 维度得分率，满分为 0 的记为 NaN
+        dim_max = data['dim_max'].astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(dim_max > 0,
+                             data['dim_scores'][:, r] / dim_max, np.nan)
+        names, inverse = np.unique(data['dim_name'], return_inverse=True)
+        labels = [data['dim_names'][i] for i in names.tolist()]
+        dimensions = []
+        for k, label in enumerate(labels):
+            group = inverse == k
+            dimensions.append(dict(
+                name=label, max_score=clean(float(np.median(
+                    dim_max[group]))),
+                **self.describe(rates[group])))
+        # 结果 × 维度 的得分率矩阵，同一维度重复出现时取后者
+        matrix = np.full((n, len(labels)), np.nan)
+        matrix[data['dim_row'], inverse] = rates
+        return dict(
+            title=title, rater=rater, count=n,
+            confidence=self.describe(data['confidence'].astype(float)),
+            distribution=dict(
+                edges=clean(edges, 2), counts=hist.tolist(),
+                **self.describe(scores)),
+            dimensions=dimensions,
+            correlations=dict(
+                raters=self.correlation(totals, list(RATERS)),
+                dimensions=self.correlation(matrix, labels)),
+            outliers=dict(
+                threshold=threshold,
+                total=self.outliers(scores, keys, threshold),
+                self_vs_teacher=self.outliers(
+                    totals[:, 0] - totals[:, 2], keys, threshold)))
+
+
+def analytics_main(args):
+    """aimglyze analytics 子命令"""
+    from .storage import StorageContext
+    try:
+        import_numpy()
+    except ImportError as e:
+        log.error("%s", e)
+        return 1
+    context = StorageContext(args.config)
+    try:
+        context.require_persistent()
+    except ValueError as e:
+        log.error("%s", e)
+        return 1
+    context.scan_cache_files()
+    table = ScoreTable(context.cache_dir / 'analytics.npz')
+    # 与最后一个持久缓存层对齐，磁盘层为缓存文件映射
+    added, removed = table.refresh(
+        context.cache_index(),
+        lambda cache_key: context.load_from_cache(cache_key, math.inf))
+    log.info("统计快照: 新增 %s 条，删除 %s 条，共 %s 条评价结果", added, removed, len(table))
+    owns = None if args.all_apps else context.owns_key
+    if args.cohorts:
+        cohorts = table.cohorts(owns)
+        report = dict(count=sum(c['count'] for c in cohorts),
+                      cohorts=cohorts)
+    else:
+        try:
+            report = table.report(title=args.title, rater=args.rater,
+                                  bins=args.bins, threshold=args.threshold,
+                                  owns=owns)
+        except ValueError as e:
+            log.error("%s", e)
+            return 1
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        log.info("统计报告已保存: %s", args.output)
+    else:
+        sys.stdout.write(text + '\n')
+    return 0
@@ -3,12 +3,80 @@
 # Copyright (c) 2025 shmilee
 
 import os
-import openai
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
 import base64
-import json_repair
-import yaml
-import functools
-print = functools.partial(print, flush=True)
+import logging
+import contextlib
+from types import SimpleNamespace
+
+log = logging.getLogger(__name__)
+# 当前线程中服务商调用的 (截止时间, 取消检查函数)
+_limits = threading.local()
+# 服务商客户端 {(类型, 地址, API_KEY): 客户端}，见 shared_client
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def shared_client(key, factory):
+    '''
+    相同服务商、地址与 API_KEY 的分析器共用一个客户端及其连接池，
+    如同一进程中挂载的多个应用、级联分析的各级模型
+    '''
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = factory()
+        return client
+
+
+class AnalysisCancelled(Exception):
+    '''
+    分析被取消，reason 为 'timeout'（超过请求截止时间）
+    或 'disconnected'（客户端已断开）
+    '''
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+@contextlib.contextmanager
+def call_limits(deadline=None, cancelled=None):
+    '''
+    为当前线程中的服务商调用设置截止时间 (time.time() 时间戳)
+    与取消检查函数，流式输出的每个分片都会检查
+    '''
+    previous = getattr(_limits, 'value', None)
+    _limits.value = (deadline, cancelled)
+    try:
+        yield
+    finally:
+        _limits.value = previous
+
+
+def check_limits():
+    '''超过截止时间或调用已取消时抛出 AnalysisCancelled'''
+    value = getattr(_limits, 'value', None)
+    if value is None:
+        return
+    deadline, cancelled = value
+    if cancelled is not None and cancelled():
+        raise AnalysisCancelled('disconnected', "客户端已断开")
+    if deadline is not None and time.time() >= deadline:
+        raise AnalysisCancelled('timeout', "超过请求截止时间")
+
+
+def remaining_time():
+    '''距截止时间的秒数，未设置截止时间返回 None'''
+    value = getattr(_limits, 'value', None)
+    if value is None or value[0] is None:
+        return None
+    return max(0.1, value[0] - time.time())
 
 
 class Analyzer(object):
@@ -16,6 +84,12 @@ class Analyzer(object):
     识别图中内容，返回 JSON 输出
     '''
     default_model = "NO-MODEL"
+    # 是否将流式 token 实时回显到 stdout，默认关闭
+    echo_tokens = False
+    # 是否支持一次请求分析多张图片 (create_response_many)
+    supports_packing = True
+    # 影响分析结果的设置，用于缓存键中的分析器指纹
+    fingerprint_fields = ('model', 'system_prompt', 'user_prompt', 'thinking')
 
     def __init__(self, API_KEY=None, model=None, max_tokens=8192,
                  temperature=1.0, thinking=False,
@@ -38,6 +112,11 @@ class Analyzer(object):
         """
         self.user_prompt = user_prompt or '图片描述控制在200字左右。'
 
+    @classmethod
+    def fingerprint_setting(cls, setting):
+        '''setting 中影响分析结果的部分，见 storage.analyzer_fingerprint'''
+        return {name: setting.get(name) for name in cls.fingerprint_fields}
+
     def set_AiClient(self, API_KEY):
         # for self.client.chat.completions.create
         raise NotImplementedError()
@@ -58,14 +137,18 @@ class Analyzer(object):
             }
         })
 
-    def create_response(self, image_data: bytes, mime_type: str):
-        img_msg = self._create_img_msg(image_data, mime_type)
-        text_msg = {"type": "text", "text": self.user_prompt}
+    def _create_timeout_kwargs(self):
+        # 截止时间传给服务商请求，等待首个 token 时也能超时
+        timeout = remaining_time()
+        return dict(timeout=timeout) if timeout is not None else {}
+
+    def _create_completion(self, system_prompt, content):
+        check_limits()
         response = self.client.chat.completions.create(
             model=self.model,
             messages=[
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": [img_msg, text_msg]},
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": content},
             ],
             response_format={
                 "type": "json_object",
@@ -73,45 +156,88 @@ class Analyzer(object):
             max_tokens=self.max_tokens,
             temperature=self.temperature,
             stream=True,  # 启用流式输出
-            **self._create_thinking_kwargs()
+            **self._create_thinking_kwargs(),
+            **self._create_timeout_kwargs()
         )
         return response
 
+    def create_response(self, image_data: bytes, mime_type: str):
+        img_msg = self._create_img_msg(image_data, mime_type)
+        text_msg = {"type": "text", "text": self.user_prompt}
+        return self._create_completion(self.system_prompt, [img_msg, text_msg])
+
+    def get_pack_prompt(self, count):
+        '''多图打包时的系统提示词，要求按图片顺序输出结果数组'''
+        return self.system_prompt + f"""
+            本次用户将依次提供 {count} 张图片（图片 1 到图片 {count}），
+            请分别分析每张图片，每张图片的结果使用上述 JSON 格式，
+            并增加 index 字段表示图片序号，最终严格按照以下格式输出：
+            {{"results": [{{"index": 1, ...}}, {{"index": 2, ...}}]}}
+            results 数组必须包含全部 {count} 张图片的结果。
+        """
+
+    def create_response_many(self, images):
+        '''images 为 [(image_data, mime_type), ...]，一次请求发送多张图片'''
+        content = []
+        for idx, (image_data, mime_type) in enumerate(images, 1):
+            content.append({"type": "text", "text": f"图片 {idx}:"})
+            content.append(self._create_img_msg(image_data, mime_type))
+        content.append({"type": "text", "text": self.user_prompt})
+        return self._create_completion(
+            self.get_pack_prompt(len(images)), content)
+
     def get_response_message(self, response):
-        # 初始化变量用于收集流式数据
-        reasoning_content = ""     # 推理过程内容
-        content = ""               # 回答内容
-        reasoning_started = False  # 推理过程开始标志
-        content_started = False    # 内容输出开始标志
-        for idx, chunk in enumerate(response, 1):
-            if not chunk.choices:
-                continue
+        # 收集流式数据，分片放入列表，最后再拼接
+        reasoning_parts = []       # 推理过程内容
+        content_parts = []         # 回答内容
+        # 回显时只写入 stdout 缓冲区，不逐 token 刷新
+        echo = sys.stdout.write if self.echo_tokens else None
+        try:
+            for chunk in response:
+                # 超时或客户端断开时，立即停止读取流式输出
+                check_limits()
+                self._collect_chunk(chunk, reasoning_parts, content_parts, echo)
+        except AnalysisCancelled as e:
+            close = getattr(response, 'close', None)
+            if close is not None:
+                close()
+            log.info("🤖 已取消服务商调用: %s", e)
+            raise
+        if echo:
+            echo("\n")
+            sys.stdout.flush()
+        content = "".join(content_parts).strip()
+        if reasoning_parts:
+            log.debug("🧠 思考过程：%s", "".join(reasoning_parts).strip())
+        log.debug("💬 回答内容：%s", content)
+        return content
+
+    def _collect_chunk(self, chunk, reasoning_parts, content_parts, echo):
+        if chunk.choices:
             delta = chunk.choices[0].delta
             # 处理流式推理过程输出
             if (self.thinking and hasattr(delta, 'reasoning_content')
                     and delta.reasoning_content):
-                if not reasoning_started:
-                    print("\n🧠 思考过程：")
-                    reasoning_started = True
-                reasoning_content += delta.reasoning_content
-                if reasoning_content.strip():
-                    print(delta.reasoning_content, end="")
+                if echo and not reasoning_parts:
+                    echo("\n🧠 思考过程：\n")
+                reasoning_parts.append(delta.reasoning_content)
+                if echo:
+                    echo(delta.reasoning_content)
             # 处理流式回答内容输出
             if hasattr(delta, 'content') and delta.content:
-                if not content_started:
-                    print("\n💬 回答内容：")
-                    content_started = True
-                content += delta.content
-                if content.strip():
-                    print(delta.content, end="")
-        return content.strip()
+                if echo and not content_parts:
+                    echo("\n💬 回答内容：\n")
+                content_parts.append(delta.content)
+                if echo:
+                    echo(delta.content)
 
     def chat(self, image_data: bytes, mime_type: str):
-        print('🤖 Creating chat ...', end=' ')
+        log.debug('🤖 Creating chat ...')
         response = self.create_response(image_data, mime_type)
-        print('Done.')
         msg = self.get_response_message(response)
+        log.info('🤖 Chat done, %s: %d chars', self.model, len(msg))
         # ref: https://github.com/mangiucugna/json_repair
+        import json_repair
         obj = json_repair.repair_json(msg, return_objects=True,
                                       ensure_ascii=False)
         # with open('./sample-msg.json', 'w') as fp:
@@ -119,6 +245,65 @@ class Analyzer(object):
         #    json.dump(obj, fp, indent=2, ensure_ascii=False)
         return obj
 
+    def split_results(self, obj, count):
+        '''
+        拆分打包结果，返回长度为 count 的列表，无效的单张结果为 None；
+        整体格式错误时抛出 ValueError
+        '''
+        items = obj.get('results') if isinstance(obj, dict) else obj
+        if not isinstance(items, list) or not items:
+            raise ValueError("打包结果格式错误: 缺少 results 数组")
+        results = [None] * count
+        if all(isinstance(item, dict) and isinstance(item.get('index'), int)
+               for item in items):
+            # 按 index 对应图片，重复或越界的序号忽略
+            for item in items:
+                idx = item.pop('index') - 1
+                if 0 <= idx < count and results[idx] is None and item:
+                    results[idx] = item
+        elif len(items) == count:
+            for idx, item in enumerate(items):
+                if isinstance(item, dict):
+                    item.pop('index', None)
+                    results[idx] = item or None
+        else:
+            raise ValueError(
+                f"打包结果数量不符: {len(items)} != {count}")
+        return results
+
+    def chat_many(self, images):
+        '''多图打包分析，返回与 images 对应的结果列表，无效结果为 None'''
+        log.debug('🤖 Creating packed chat, %d images ...', len(images))
+        response = self.create_response_many(images)
+        msg = self.get_response_message(response)
+        log.info('🤖 Packed chat done, %s: %d images, %d chars',
+                 self.model, len(images), len(msg))
+        import json_repair
+        obj = json_repair.repair_json(msg, return_objects=True,
+                                      ensure_ascii=False)
+        return self.split_results(obj, len(images))
+
+    def attempt_info(self, start, **kwargs):
+        '''一次服务商调用的记录'''
+        return dict(analyzer=self.__class__.__name__, model=self.model,
+                    thinking=self.thinking,
+                    elapsed=round(time.time() - start, 3), **kwargs)
+
+    def chat_detail(self, image_data: bytes, mime_type: str):
+        '''返回 (结果, 调用记录列表)'''
+        start = time.time()
+        obj = self.chat(image_data, mime_type)
+        return obj, [self.attempt_info(start)]
+
+    def chat_many_detail(self, images):
+        '''返回 (结果列表, 每张图片的调用记录列表)'''
+        start = time.time()
+        results = self.chat_many(images)
+        attempts = [[self.attempt_info(start, packed=len(images),
+                                       pack_index=idx)] if obj else []
+                    for idx, obj in enumerate(results, 1)]
+        return results, attempts
+
 
 class GeminiAnalyzer(Analyzer):
     '''
@@ -129,10 +314,12 @@ class GeminiAnalyzer(Analyzer):
     def set_AiClient(self, API_KEY):
         # https://ai.google.dev/gemini-api/docs/openai?hl=zh-cn
         # need GEMINI_API_KEY environment variable
-        self.client = openai.OpenAI(
-            api_key=API_KEY or os.environ.get("GEMINI_API_KEY"),
-            base_url="https://generativelanguage.googleapis.com/v1beta/openai/"
-        )
+        import openai
+        api_key = API_KEY or os.environ.get("GEMINI_API_KEY")
+        base_url = "https://generativelanguage.googleapis.com/v1beta/openai/"
+        self.client = shared_client(
+            ('openai', base_url, api_key),
+            lambda: openai.OpenAI(api_key=api_key, base_url=base_url))
 
     def _create_thinking_kwargs(self):
         return dict(extra_body={
@@ -153,19 +340,27 @@ class GenaiAnalyzer(Analyzer):
     https://ai.google.dev/gemini-api/docs/image-understanding?hl=zh-cn
     '''
     default_model = "gemini-2.5-flash"
+    # genai 的请求格式与 OpenAI 不同，尚未实现多图打包
+    supports_packing = False
 
     def set_AiClient(self, API_KEY):
         # need GEMINI_API_KEY environment variable
         from google import genai
-        self.client = genai.Client(
-            api_key=API_KEY or os.environ.get("GEMINI_API_KEY"))
+        api_key = API_KEY or os.environ.get("GEMINI_API_KEY")
+        self.client = shared_client(
+            ('genai', None, api_key), lambda: genai.Client(api_key=api_key))
 
     def create_response(self, image_data: bytes, mime_type: str):
         from google.genai import types
+        check_limits()
+        timeout = remaining_time()
         response = self.client.models.generate_content_stream(  # 流式响应
             model=self.model,
             config=types.GenerateContentConfig(
                 system_instruction=self.system_prompt,
+                # 请求超时，单位毫秒
+                http_options=(types.HttpOptions(timeout=int(timeout * 1000))
+                              if timeout is not None else None),
                 # TODO https://ai.google.dev/gemini-api/docs/structured-output?hl=zh-cn
                 response_mime_type="application/json",
                 # https://ai.google.dev/gemini-api/docs/thinking?hl=zh-cn
@@ -192,9 +387,9 @@ class ZhipuAnalyzer(Analyzer):
     def set_AiClient(self, API_KEY):
         # need ZAI_API_KEY environment variable
         from zai import ZhipuAiClient
-        self.client = ZhipuAiClient(
-            api_key=API_KEY or os.environ.get("ZAI_API_KEY")
-        )
+        api_key = API_KEY or os.environ.get("ZAI_API_KEY")
+        self.client = shared_client(
+            ('zhipu', None, api_key), lambda: ZhipuAiClient(api_key=api_key))
 
     def _create_thinking_kwargs(self):
         return dict(thinking={
@@ -213,9 +408,340 @@ class DeepseekAnalyzer(Analyzer):
     def set_AiClient(self, API_KEY):
         # https://api-docs.deepseek.com/zh-cn/
         # need XXX_API_KEY environment variable
-        self.client = openai.OpenAI(
-            api_key=API_KEY or os.environ.get('DEEPSEEK_API_KEY'),
-            base_url="https://api.deepseek.com")
+        import openai
+        api_key = API_KEY or os.environ.get('DEEPSEEK_API_KEY')
+        base_url = "https://api.deepseek.com"
+        self.client = shared_client(
+            ('openai', base_url, api_key),
+            lambda: openai.OpenAI(api_key=api_key, base_url=base_url))
+
+
+class FakeAPIError(Exception):
+    '''FakeAnalyzer 模拟的服务商错误'''
+    status_code = 500
+
+
+class FakeRateLimitError(FakeAPIError):
+    '''FakeAnalyzer 模拟的 429 限流错误'''
+    status_code = 429
+
+
+class FakeAnalyzer(Analyzer):
+    '''
+    离线模拟分析器，不访问任何服务商，用于压测和回归基准。
+
+    - replay: 录制的流式输出，文件或目录（按图片哈希选取文件）；
+      .jsonl 每行一个 {"content": ..., "reasoning_content": ...} 分片，
+      其他文件视为完整回答文本，按 chunk_size 切分回放。
+    - 未设置 replay 时，按 schema (desc-tags/task-score，默认由
+      system_prompt 推断) 合成 JSON，内容只由图片数据决定。
+    - ttft/token_delay: 首 token 延迟与每个分片的延迟（秒），
+      latency 为首 token 延迟的分布: fixed, uniform, exponential, lognormal。
+    - error_rate/rate_limit_rate: 请求失败、429 限流的概率。
+    - seed: 延迟与错误的随机种子，固定后结果可重复。
+    '''
+    default_model = "fake-model"
+    latency_choices = ('fixed', 'uniform', 'exponential', 'lognormal')
+    desc_tags_pool = [
+        "人工智能", "图像识别", "科技", "风景", "人物", "建筑", "动物",
+        "植物", "交通工具", "文档", "表格", "手写", "室内", "室外",
+        "夜景", "插画", "图标", "数据分析",
+    ]
+
+    def __init__(self, replay=None, schema=None, seed=0,
+                 ttft=0.0, token_delay=0.0, latency='fixed',
+                 latency_sigma=0.5, chunk_size=8,
+                 error_rate=0.0, rate_limit_rate=0.0, **kwargs):
+        super().__init__(**kwargs)
+        if latency not in self.latency_choices:
+            raise ValueError(f"Invalid latency distribution: {latency}")
+        self.replay = replay
+        self.schema = schema or (
+            'task-score' if 'dimensions' in self.system_prompt
+            else 'desc-tags')
+        self.ttft = float(ttft)
+        self.token_delay = float(token_delay)
+        self.latency = latency
+        self.latency_sigma = float(latency_sigma)
+        self.chunk_size = max(1, int(chunk_size))
+        self.error_rate = float(error_rate)
+        self.rate_limit_rate = float(rate_limit_rate)
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+
+    def set_AiClient(self, API_KEY):
+        self.client = None
+
+    def sample_ttft(self):
+        with self.rng_lock:
+            if self.latency == 'uniform':
+                return self.rng.uniform(0, 2 * self.ttft)
+            elif self.latency == 'exponential':
+                return self.rng.expovariate(1 / self.ttft) if self.ttft else 0
+            elif self.latency == 'lognormal':
+                return self.ttft * self.rng.lognormvariate(
+                    0, self.latency_sigma)
+            return self.ttft
+
+    def maybe_raise(self):
+        with self.rng_lock:
+            x = self.rng.random()
+        if x < self.rate_limit_rate:
+            raise FakeRateLimitError("Error code: 429 - rate limit (fake)")
+        if x < self.rate_limit_rate + self.error_rate:
+            raise FakeAPIError("Error code: 500 - internal error (fake)")
+
+    def load_replay(self, digest):
+        path = self.replay
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(path, f) for f in os.listdir(path)
+                if os.path.isfile(os.path.join(path, f)))
+            if not files:
+                raise FileNotFoundError(f"Empty replay directory: {path}")
+            path = files[int(digest[:8], 16) % len(files)]
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in text.splitlines()
+                    if line.strip()]
+        return self.split_chunks(text)
+
+    def split_chunks(self, text, key='content'):
+        n = self.chunk_size
+        return [{key: text[i:i+n]} for i in range(0, len(text), n)]
+
+    def synthesize(self, digest):
+        '''根据图片哈希合成符合提示词格式的结果'''
+        rng = random.Random(digest)
+        confidence = round(0.05 + 0.95 * int(digest[8:12], 16) / 0xffff, 2)
+        if self.schema == 'task-score':
+            dimensions = []
+            for i in range(rng.randint(2, 4)):
+                points = []
+                for j in range(rng.randint(2, 4)):
+                    score = rng.choice([5, 10])
+                    points.append({
+                        "desc": f"要点 {i+1}.{j+1}",
+                        "score": score,
+                        "self": rng.randint(score // 2, score),
+                        "peer": rng.randint(score // 2, score),
+                        "teacher": rng.randint(score // 2, score),
+                    })
+                dimensions.append({
+                    "desc": f"评价维度 {i+1}",
+                    "score": sum(p["score"] for p in points),
+                    "points": points,
+                })
+            totals = [sum(p[k] for d in dimensions for p in d["points"])
+                      for k in ("self", "peer", "teacher")]
+            return {
+                "confidence": confidence,
+                "table_title": f"任务过程评价记录表 {digest[:6]}",
+                "dimensions": dimensions,
+                "total_score": totals,
+                "report": "模拟评价：该学生完成了任务的主要步骤。",
+                "strengths": [f"学习优势 {k+1}" for k in range(3)],
+                "improvements": [f"改进建议 {k+1}" for k in range(
+                    3 if totals[2] >= 80 else 5)],
+                "overall": "模拟总体评价。" * 20,
+            }
+        return {
+            "name": f"模拟图片 {digest[:8]}",
+            "desc": f"这是一张模拟分析的图片，哈希前缀为 {digest[:8]}。" * 8,
+            "tags": rng.sample(self.desc_tags_pool, rng.randint(3, 12)),
+            "confidence": confidence,
+        }
+
+    def wait(self, delay):
+        '''模拟等待首 token，同真实请求一样按截止时间或取消提前结束'''
+        end = time.time() + delay
+        while True:
+            left = end - time.time()
+            if left <= 0:
+                return
+            time.sleep(min(left, 0.1))
+            check_limits()
+
+    def iter_chunks(self, chunks, first_delay):
+        self.wait(first_delay)
+        for idx, data in enumerate(chunks):
+            if idx and self.token_delay:
+                time.sleep(self.token_delay)
+            yield SimpleNamespace(choices=[SimpleNamespace(
+                delta=SimpleNamespace(
+                    content=data.get('content'),
+                    reasoning_content=data.get('reasoning_content')))])
+
+    def create_response(self, image_data: bytes, mime_type: str):
+        self.maybe_raise()
+        digest = hashlib.sha1(image_data).hexdigest()
+        if self.replay:
+            chunks = self.load_replay(digest)
+        else:
+            chunks = self.split_chunks(json.dumps(
+                self.synthesize(digest), ensure_ascii=False, indent=2))
+            if self.thinking:
+                chunks = self.split_chunks(
+                    "模拟思考过程。", 'reasoning_content') + chunks
+        return self.iter_chunks(chunks, self.sample_ttft())
+
+    @property
+    def supports_packing(self):
+        # 录制文件只对应单张图片
+        return not self.replay
+
+    def create_response_many(self, images):
+        self.maybe_raise()
+        results = []
+        for idx, (image_data, mime_type) in enumerate(images, 1):
+            digest = hashlib.sha1(image_data).hexdigest()
+            results.append(dict(index=idx, **self.synthesize(digest)))
+        chunks = self.split_chunks(json.dumps(
+            {'results': results}, ensure_ascii=False, indent=2))
+        return self.iter_chunks(chunks, self.sample_ttft())
+
+
+class CascadeAnalyzer(Analyzer):
+    '''
+    级联分析：先用快速、便宜的模型（如 glm-4.6v-flash 不开思考），
+    结果置信度低于 min_confidence 或缺少 required_fields 时，
+    再用更强的模型（或开启思考）重新分析。
+
+    fast/strong 为子分析器配置，analyzer 为类名，其余为初始化参数，
+    未设置的提示词、max_tokens 等参数沿用本级配置。
+    '''
+    default_model = "cascade"
+
+    def __init__(self, fast=None, strong=None, min_confidence=0.6,
+                 required_fields=None, API_KEY=None, **kwargs):
+        super().__init__(API_KEY=API_KEY, **kwargs)
+        self.min_confidence = float(min_confidence)
+        self.required_fields = list(required_fields or ['confidence'])
+        shared = dict(API_KEY=API_KEY, max_tokens=self.max_tokens,
+                      temperature=self.temperature,
+                      system_prompt=self.system_prompt,
+                      user_prompt=self.user_prompt)
+        self.fast = self.make_stage(fast, shared, thinking=False)
+        self.strong = self.make_stage(strong, shared, thinking=True)
+        self.model = f"{self.fast.model}->{self.strong.model}"
+
+    def set_AiClient(self, API_KEY):
+        # 由子分析器各自创建客户端
+        self.client = None
+
+    @property
+    def supports_packing(self):
+        # 打包分析由快速模型完成
+        return self.fast.supports_packing
+
+    @classmethod
+    def fingerprint_setting(cls, setting):
+        '''包含判定条件，及按 make_stage 合并后各级子分析器的设置'''
+        data = super().fingerprint_setting(setting)
+        data.update(min_confidence=float(setting.get('min_confidence', 0.6)),
+                    required_fields=list(setting.get('required_fields')
+                                         or ['confidence']))
+        for name, thinking in (('fast', False), ('strong', True)):
+            stage = dict(system_prompt=setting.get('system_prompt'),
+                         user_prompt=setting.get('user_prompt'),
+                         thinking=thinking)
+            stage.update(setting.get(name) or {})
+            stage_class = AnalyzerMap[stage.pop('analyzer', None) or 'default']
+            data[name] = dict(analyzer=stage_class.__name__,
+                              **stage_class.fingerprint_setting(stage))
+        return data
+
+    def make_stage(self, config, shared, **defaults):
+        setting = dict(shared, **defaults)
+        setting.update(config or {})
+        analyzer_class = AnalyzerMap[setting.pop('analyzer', None) or 'default']
+        return analyzer_class(**setting)
+
+    def check(self, result):
+        '''检查结果，通过返回 None，否则返回原因'''
+        if not isinstance(result, dict):
+            return 'invalid'
+        missing = [k for k in self.required_fields if k not in result]
+        if missing:
+            return 'missing:' + ','.join(missing)
+        confidence = result.get('confidence')
+        if not isinstance(confidence, (int, float)):
+            return 'no-confidence'
+        if confidence < self.min_confidence:
+            return 'low-confidence'
+        return None
+
+    def judge(self, stage, name, obj, start, attempts, outcomes, **kwargs):
+        '''检查并记录一次调用的结果，通过返回 True'''
+        reason = self.check(obj)
+        attempts.append(stage.attempt_info(
+            start, stage=name, accepted=reason is None, reason=reason,
+            confidence=obj.get('confidence') if isinstance(obj, dict)
+            else None, **kwargs))
+        outcomes.append((obj, reason))
+        if reason is not None and name == 'fast':
+            log.info("级联分析: 快速模型结果未通过 (%s)，升级到强模型", reason)
+        return reason is None
+
+    def escalate(self, image_data, mime_type, attempts, outcomes):
+        '''用强模型重新分析，返回 (结果, 调用记录)'''
+        self.strong.echo_tokens = self.echo_tokens
+        start = time.time()
+        obj = self.strong.chat(image_data, mime_type)
+        if self.judge(self.strong, 'strong', obj, start, attempts, outcomes):
+            return obj, attempts
+        # 都未通过: 优先返回格式完整的结果，强模型优先
+        for obj, reason in reversed(outcomes):
+            if reason == 'low-confidence':
+                return obj, attempts
+        return outcomes[-1][0], attempts
+
+    def chat_detail(self, image_data: bytes, mime_type: str):
+        attempts, outcomes = [], []
+        self.fast.echo_tokens = self.echo_tokens
+        start = time.time()
+        try:
+            obj = self.fast.chat(image_data, mime_type)
+        except AnalysisCancelled:
+            raise
+        except Exception as e:
+            attempts.append(self.fast.attempt_info(
+                start, stage='fast', accepted=False, reason='error',
+                error=str(e)))
+            log.info("级联分析: 快速模型出错 (%s)，升级到强模型", e)
+        else:
+            if self.judge(self.fast, 'fast', obj, start, attempts, outcomes):
+                return obj, attempts
+        return self.escalate(image_data, mime_type, attempts, outcomes)
+
+    def chat_many_detail(self, images):
+        '''快速模型打包分析，未通过的图片再逐张用强模型分析'''
+        self.fast.echo_tokens = self.echo_tokens
+        start = time.time()
+        packed = self.fast.chat_many(images)
+        results, attempts = [], []
+        for idx, ((image_data, mime_type), obj) in enumerate(
+                zip(images, packed), 1):
+            tried, outcomes = [], []
+            if obj is not None and not self.judge(
+                    self.fast, 'fast', obj, start, tried, outcomes,
+                    packed=len(images), pack_index=idx):
+                try:
+                    obj, tried = self.escalate(
+                        image_data, mime_type, tried, outcomes)
+                except AnalysisCancelled:
+                    raise
+                except Exception as e:
+                    # 交给调用方逐张重试
+                    log.warning("级联分析: 强模型出错 (%s)", e)
+                    obj, tried = None, []
+            results.append(obj)
+            attempts.append(tried)
+        return results, attempts
+
+    def chat(self, image_data: bytes, mime_type: str):
+        return self.chat_detail(image_data, mime_type)[0]
 
 
 # TODO 其他免费平台 https://github.com/fruitbars/simple-one-api
@@ -225,6 +751,8 @@ AnalyzerMap = dict(
     GenaiAnalyzer=GenaiAnalyzer,
     ZhipuAnalyzer=ZhipuAnalyzer,
     DeepseekAnalyzer=DeepseekAnalyzer,  # 不免费
+    FakeAnalyzer=FakeAnalyzer,  # 离线模拟，用于压测
+    CascadeAnalyzer=CascadeAnalyzer,  # 快速模型优先，低置信度再升级
 )
 
 
@@ -239,6 +767,7 @@ def get_analyzer_config(yaml_config: str):
     ```
     '''
     if os.path.isfile(yaml_config):
+        import yaml
         with open(yaml_config, 'r', encoding='utf-8') as yc:
             config = yaml.safe_load(yc)
         return dict(
@@ -258,5 +787,6 @@ if __name__ == "__main__":
         image_data = image_file.read()
     ext = os.path.splitext(image_path)[1].lower()
     mime_type = f"image/{ext[1:] if ext else 'png'}"
+    analyzer.echo_tokens = True
     msg = analyzer.chat(image_data, mime_type)
     print(f"\n🤖 分析结果:\n{msg}")
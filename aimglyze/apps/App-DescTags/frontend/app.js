@@ -150,7 +150,7 @@ async function checkConnection() {
         // 使用更快的请求方式，设置超时
         const controller = new AbortController();
         const timeoutId = setTimeout(() => controller.abort(), 3000); // 3秒超时
-        const response = await fetch('/api/health', {
+        const response = await fetch('api/health', {
             method: 'GET',
             signal: controller.signal,
             headers: {
@@ -207,7 +207,7 @@ function updateConnectionStatus(connected) {
 // 加载配置
 async function loadConfig() {
     try {
-        const response = await fetch('/api/config');
+        const response = await fetch('api/config');
         if (response.ok) {
             AppState.config = await response.json();
             // 更新页面标题和副标题
@@ -321,7 +321,7 @@ async function uploadFile(file) {
     try {
         // 模拟进度
         simulateProgress();
-        const response = await fetch('/api/analyze', {
+        const response = await fetch('api/analyze', {
             method: 'POST',
             body: formData
         });
@@ -387,7 +387,7 @@ function showLoading(show) {
 async function loadSampleData() {
     showLoading(true);
     try {
-        const response = await fetch('/api/sample');
+        const response = await fetch('api/sample');
         if (!response.ok) {
             throw new Error('加载示例数据失败');
         }
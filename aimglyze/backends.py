@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import json
+import time
+import socket
+import threading
+import logging
+from collections import OrderedDict
+from urllib.parse import urlsplit, unquote
+
+log = logging.getLogger(__name__)
+
+# cache.backends 中可用的缓存层
+BACKENDS = ('memory', 'disk', 'redis')
+
+
+def is_fresh(cache_data, max_age):
+    """缓存数据是否在 max_age 秒内写入"""
+    try:
+        return time.time() - float(cache_data.get('timestamp', 0)) < max_age
+    except (TypeError, ValueError):
+        return False
+
+
+class CacheBackend(object):
+    """
+    缓存层接口，值为缓存数据 {'result', 'timestamp', 'cache_key', ...}:
+    - get(cache_key): 返回缓存数据，不存在返回 None，不判断是否过期
+    - put(cache_data, ttl): 写入，ttl 为剩余有效秒数，不支持自动过期的层忽略
+    - delete(cache_key): 删除，返回是否存在
+    - entries(since, owns): 逐条返回 (cache_key, 缓存数据)，供导出、打包与统计；
+      owns 不为 None 时只返回 owns(cache_key) 为真的条目 (在读取数据之前筛选)，
+      since 不为 None 时可以跳过早于此时间写入的条目 (调用方仍需按时间戳判断)
+    - iterate(max_age): 逐条返回 (cache_key, timestamp)，
+      max_age 不为 None 时只返回未过期的条目
+    """
+    name = None
+
+    def get(self, cache_key):
+        raise NotImplementedError
+
+    def put(self, cache_data, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, cache_key):
+        raise NotImplementedError
+
+    def entries(self, since=None, owns=None):
+        raise NotImplementedError
+
+    def iterate(self, max_age=None):
+        return self.select(self.entries(), max_age)
+
+    def expire(self, max_age):
+        """删除超过 max_age 秒的条目，返回删除个数"""
+        now = time.time()
+        expired = [cache_key for cache_key, timestamp in self.iterate()
+                   if now - timestamp >= max_age]
+        return sum(1 for cache_key in expired if self.delete(cache_key))
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def select(entries, max_age):
+        """从 (cache_key, 缓存数据) 中取出未过期的 (cache_key, timestamp)"""
+        now = time.time()
+        for cache_key, cache_data in entries:
+            try:
+                timestamp = float(cache_data.get('timestamp', 0))
+            except (AttributeError, TypeError, ValueError):
+                continue
+            if max_age is None or now - timestamp < max_age:
+                yield cache_key, timestamp
+
+
+class MemoryBackend(CacheBackend):
+    """
+    进程内缓存层，同时提供字典接口 (in、[]、pop、items 等)。
+    max_entries 为 None 时不限条目数，超过时淘汰最久未使用的；
+    为 0 时不保存任何条目 (未启用内存层)
+    """
+    name = 'memory'
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, cache_key, default=None):
+        with self.lock:
+            cache_data = self.data.get(cache_key)
+            if cache_data is None:
+                return default
+            if self.max_entries:
+                self.data.move_to_end(cache_key)
+            return cache_data
+
+    def put(self, cache_data, ttl=None):
+        self[cache_data['cache_key']] = cache_data
+
+    def delete(self, cache_key):
+        return self.pop(cache_key, None) is not None
+
+    def entries(self, since=None, owns=None):
+        return ((cache_key, cache_data) for cache_key, cache_data
+                in self.items() if owns is None or owns(cache_key))
+
+    def __setitem__(self, cache_key, cache_data):
+        if self.max_entries == 0:
+            return
+        with self.lock:
+            self.data[cache_key] = cache_data
+            self.data.move_to_end(cache_key)
+            if self.max_entries:
+                while len(self.data) > self.max_entries:
+                    self.data.popitem(last=False)
+
+    def __getitem__(self, cache_key):
+        cache_data = self.get(cache_key)
+        if cache_data is None:
+            raise KeyError(cache_key)
+        return cache_data
+
+    def __contains__(self, cache_key):
+        return cache_key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def pop(self, cache_key, default=None):
+        with self.lock:
+            return self.data.pop(cache_key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def items(self):
+        with self.lock:
+            return list(self.data.items())
+
+
+class DiskBackend(CacheBackend):
+    """缓存目录中每个键一个 JSON 文件，先写临时文件再原子替换"""
+    name = 'disk'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, cache_key):
+        return self.cache_dir / f"{cache_key}.json"
+
+    def get(self, cache_key):
+        try:
+            with open(self.path(cache_key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, cache_data, ttl=None):
+        cache_file = self.path(cache_data['cache_key'])
+        # 先写临时文件再替换，避免并发请求读到半个文件
+        tmp_file = cache_file.with_name(
+            f".{cache_file.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(cache_data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, cache_file)
+
+    def delete(self, cache_key):
+        try:
+            os.unlink(self.path(cache_key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def entries(self, since=None, owns=None):
+        """边遍历目录边读取，缓存文件在取得时间戳之后写入，按修改时间跳过旧文件"""
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not (entry.name.endswith('.json') and entry.is_file()):
+                    continue
+                cache_key = entry.name[:-5]
+                if owns is not None and not owns(cache_key):
+                    continue
+                try:
+                    if since is not None and entry.stat().st_mtime < since:
+                        continue
+                    cache_data = self.get(cache_key)
+                except (OSError, ValueError) as e:
+                    log.debug("跳过无法读取的缓存: %s, %s", entry.name, e)
+                    continue
+                if isinstance(cache_data, dict):
+                    yield cache_key, cache_data
+
+
+class RespError(Exception):
+    """Redis 服务器返回的错误"""
+
+
+class RespClient(object):
+    """
+    最小的 RESP2 客户端，可连接 Redis 及兼容协议的服务 (Valkey、KeyDB 等)。
+    url 形如 redis://[[user]:password@]host[:port][/db]，每个线程一个连接
+    """
+
+    def __init__(self, url, timeout=2.0):
+        parts = urlsplit(url)
+        if parts.scheme != 'redis':
+            raise ValueError(f"不支持的 Redis 地址: {url}")
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 6379
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.strip('/') or 0)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = self.local.conn = (sock, sock.makefile('rb'))
+        try:
+            if self.password:
+                self.call(conn, 'AUTH', *filter(None, (self.username,
+                                                      self.password)))
+            if self.db:
+                self.call(conn, 'SELECT', self.db)
+        except BaseException:
+            self.disconnect()
+            raise
+        return conn
+
+    def disconnect(self):
+        conn = getattr(self.local, 'conn', None)
+        self.local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def execute(self, *args):
+        """执行一条命令，返回回复；连接断开时重连一次"""
+        conn = getattr(self.local, 'conn', None)
+        try:
+            return self.call(conn or self.connect(), *args)
+        except ConnectionError:
+            # 服务器重启或空闲连接被关闭，命令都是幂等的，重试一次
+            self.disconnect()
+        except OSError:
+            # 超时等，连接中可能残留未读的回复，不再使用
+            self.disconnect()
+            raise
+        return self.call(self.connect(), *args)
+
+    def call(self, conn, *args):
+        sock, reader = conn
+        sock.sendall(self.encode(args))
+        return self.read_reply(reader)
+
+    @staticmethod
+    def encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            elif not isinstance(arg, bytes):
+                arg = str(arg).encode('ascii')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Redis 连接已关闭")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RespError(rest.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            size = int(rest)
+            if size < 0:
+                return None
+            data = reader.read(size + 2)
+            if len(data) != size + 2:
+                raise ConnectionError("Redis 连接已关闭")
+            return data[:-2]
+        if kind == b'*':
+            size = int(rest)
+            if size < 0:
+                return None
+            return [self.read_reply(reader) for _ in range(size)]
+        raise RespError(f"无法解析的回复: {line[:32]!r}")
+
+    def close(self):
+        self.disconnect()
+
+
+def glob_escape(text):
+    """转义 Redis 键模式中的特殊字符"""
+    return ''.join('\\' + c if c in '*?[]\\' else c for c in text)
+
+
+class RedisBackend(CacheBackend):
+    """
+    Redis 协议缓存层，每个结果一个字符串键 prefix + cache_key，
+    写入时按剩余有效期设置过期时间，由服务器自动删除过期结果。
+    多个节点共享同一服务时，前端节点无需本地缓存目录即可水平扩展
+    """
+    name = 'redis'
+    scan_count = 500
+
+    def __init__(self, url, prefix='aimglyze:', timeout=2.0):
+        self.client = RespClient(url, timeout)
+        self.prefix = prefix
+
+    def key(self, cache_key):
+        return f"{self.prefix}{cache_key}"
+
+    def get(self, cache_key):
+        data = self.client.execute('GET', self.key(cache_key))
+        return None if data is None else json.loads(data)
+
+    def put(self, cache_data, ttl=None):
+        args = ['SET', self.key(cache_data['cache_key']),
+                json.dumps(cache_data, ensure_ascii=False,
+                           separators=(',', ':'))]
+        if ttl is not None:
+            args += ['PX', max(1, int(ttl * 1000))]
+        self.client.execute(*args)
+
+    def delete(self, cache_key):
+        return self.client.execute('DEL', self.key(cache_key)) > 0
+
+    def entries(self, since=None, owns=None):
+        """用 SCAN 分批遍历前缀下的键，每批一次 MGET"""
+        pattern = f"{glob_escape(self.prefix)}*"
+        start = len(self.prefix.encode('utf-8'))
+        cursor = b'0'
+        while True:
+            cursor, keys = self.client.execute(
+                'SCAN', cursor, 'MATCH', pattern, 'COUNT', self.scan_count)
+            if owns is not None:
+                keys = [key for key in keys
+                        if owns(key[start:].decode('utf-8'))]
+            if keys:
+                values = self.client.execute('MGET', *keys)
+                for key, value in zip(keys, values):
+                    if value is None:
+                        continue
+                    try:
+                        cache_data = json.loads(value)
+                    except ValueError:
+                        continue
+                    if isinstance(cache_data, dict):
+                        yield key[start:].decode('utf-8'), cache_data
+            if cursor == b'0':
+                return
+
+    def expire(self, max_age):
+        # 过期时间由服务器处理
+        return 0
+
+    def close(self):
+        self.client.close()
+
+
+def create_backends(context):
+    """
+    按 cache.backends 创建缓存层，返回 (内存层, [持久层, ...])。
+    内存层只能位于最前面；未启用时返回不保存条目的内存层
+    """
+    cache_config = context.config['cache']
+    names = list(cache_config['backends'])
+    unknown = [name for name in names if name not in BACKENDS]
+    if unknown:
+        raise ValueError(f"未知的缓存层: {', '.join(unknown)}")
+    if len(set(names)) != len(names):
+        raise ValueError("缓存层不能重复")
+    if 'memory' in names[1:]:
+        raise ValueError("内存缓存层只能位于最前面")
+    if names[:1] == ['memory']:
+        memory = MemoryBackend(cache_config['memory_size'] or None)
+        names = names[1:]
+    else:
+        memory = MemoryBackend(0)
+    backends = []
+    for name in names:
+        if name == 'disk':
+            backends.append(DiskBackend(context.cache_dir))
+        else:
+            backends.append(RedisBackend(
+                cache_config['redis_url'], cache_config['redis_prefix'],
+                cache_config['redis_timeout']))
+    return memory, backends
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import logging
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .server import AnalysisServer
+
+log = logging.getLogger(__name__)
+
+CSV_FIELDS = ['path', 'hash', 'cached', 'elapsed', 'error', 'confidence',
+              'result']
+
+
+def collect_files(target, allowed_extensions=None, recursive=False):
+    """收集目录或通配符匹配的图片文件"""
+    if os.path.isdir(target):
+        pattern = os.path.join(target, '**', '*') if recursive \
+            else os.path.join(target, '*')
+        paths = glob.glob(pattern, recursive=recursive)
+    else:
+        paths = glob.glob(target, recursive=True)
+    files = []
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        ext = os.path.splitext(path)[1].lower()
+        if allowed_extensions and ext not in allowed_extensions:
+            continue
+        files.append(os.path.abspath(path))
+    return sorted(files)
+
+
+class ResultWriter(object):
+    """
+    边完成边写出结果（JSONL 或 CSV，按扩展名判断），
+    每条记录立即刷新，中断后可从已写出的记录恢复。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+        self.lock = threading.Lock()
+        self.fp = None
+        self.csv_writer = None
+
+    def load_finished(self):
+        """读取已成功完成的文件路径"""
+        finished = set()
+        if not os.path.exists(self.path):
+            return finished
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            if self.format == 'csv':
+                rows = csv.DictReader(f)
+            else:
+                rows = []
+                for line in f:
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        # 中断时可能写了半行，忽略
+                        continue
+            for row in rows:
+                if row.get('path') and not row.get('error'):
+                    finished.add(row['path'])
+        return finished
+
+    def open(self):
+        new_file = not os.path.exists(self.path) \
+            or os.path.getsize(self.path) == 0
+        self.fp = open(self.path, 'a', encoding='utf-8', newline='')
+        if self.format == 'csv':
+            self.csv_writer = csv.DictWriter(self.fp, fieldnames=CSV_FIELDS)
+            if new_file:
+                self.csv_writer.writeheader()
+
+    def write(self, record):
+        with self.lock:
+            if self.format == 'csv':
+                result = record.get('result')
+                row = dict(record, result=json.dumps(
+                    result, ensure_ascii=False) if result is not None else '')
+                self.csv_writer.writerow(
+                    {k: row.get(k, '') for k in CSV_FIELDS})
+            else:
+                self.fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.fp.flush()
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+
+class Progress(object):
+    """进度与剩余时间显示"""
+
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.done = self.errors = self.cached = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.tty = stream.isatty()
+        self.last_report = 0
+
+    def update(self, cached=False, error=False):
+        with self.lock:
+            self.done += 1
+            self.errors += bool(error)
+            self.cached += bool(cached)
+            now = time.time()
+            if not self.tty and now - self.last_report < 5 \
+                    and self.done < self.total:
+                return
+            self.last_report = now
+            elapsed = now - self.start
+            rate = self.done / elapsed if elapsed > 0 else 0
+            eta = (self.total - self.done) / rate if rate > 0 else 0
+            line = (f"[{self.done}/{self.total}] 缓存 {self.cached} "
+                    f"失败 {self.errors} | {rate:.2f} 张/秒 | "
+                    f"ETA {int(eta // 60):02d}:{int(eta % 60):02d}")
+            if self.tty:
+                self.stream.write('\r' + line + ' ' * 8)
+                if self.done >= self.total:
+                    self.stream.write('\n')
+                self.stream.flush()
+            else:
+                log.info(line)
+
+
+class BatchRunner(object):
+    """离线批量分析，复用 AnalysisServer 的哈希与缓存，pack>1 时多图打包分析"""
+
+    def __init__(self, server, writer, jobs=4, pack=1):
+        self.server = server
+        self.writer = writer
+        self.jobs = max(1, jobs)
+        self.pack = max(1, pack)
+
+    def read_image(self, path):
+        with open(path, 'rb') as f:
+            image_data = f.read()
+        mime_type = mimetypes.guess_type(path)[0] or 'image/jpeg'
+        return image_data, mime_type
+
+    def analyze(self, path, image_data, mime_type, cache_key):
+        start = time.time()
+        if self.server.save_upload:
+            self.server.save_uploaded_file(image_data, mime_type, cache_key)
+        result = self.server.analyze_image(image_data, mime_type, cache_key)
+        return self.make_record(path, cache_key, result, False,
+                                time.time() - start)
+
+    def make_record(self, path, cache_key, result, cached, elapsed=0.0):
+        record = dict(path=path, hash=cache_key, cached=cached,
+                      elapsed=round(elapsed, 3),
+                      error=result.get('error'),
+                      result=result.get('result'))
+        if isinstance(record['result'], dict):
+            record['confidence'] = record['result'].get('confidence')
+        if result.get('near_duplicate'):
+            record['near_duplicate'] = result['near_duplicate']
+        return record
+
+    def emit(self, progress, record):
+        self.writer.write(record)
+        progress.update(cached=record['cached'], error=record['error'])
+        if record['error']:
+            log.warning("分析失败: %s: %s", record['path'], record['error'])
+
+    def run(self, files):
+        progress = Progress(len(files))
+        # 未命中的图片 {cache_key: [path, ...]}，相同内容只分析一次
+        misses = {}
+        # 先处理缓存命中的图片，不占用并发名额
+        for path in files:
+            try:
+                image_data, mime_type = self.read_image(path)
+            except OSError as e:
+                self.emit(progress, dict(path=path, hash=None, cached=False,
+                                         elapsed=0, error=str(e)))
+                continue
+            cache_key = self.server.get_file_hash(image_data)
+            cache_data = self.server.lookup_cache(
+                self.server.result_key(cache_key))
+            if cache_data:
+                self.emit(progress, self.make_record(
+                    path, cache_key, cache_data, True))
+            else:
+                # 只保留路径，分析时再读取，避免大目录占用内存
+                misses.setdefault(cache_key, []).append(path)
+        log.info("缓存命中 %s 张，待分析 %s 张，并发 %s，每次打包 %s 张",
+                 progress.done, len(misses), self.jobs, self.pack)
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            futures = {}
+            groups = list(misses.items())
+            for i in range(0, len(groups), self.pack):
+                group = groups[i:i + self.pack]
+                futures[executor.submit(self.analyze_group, group)] = group
+            for future in as_completed(futures):
+                for record, (_, paths) in zip(future.result(),
+                                              futures[future]):
+                    self.emit(progress, record)
+                    # 内容相同的其他文件直接复用结果
+                    for path in paths[1:]:
+                        self.emit(progress, dict(
+                            record, path=path, cached=not record['error']))
+        except KeyboardInterrupt:
+            log.warning("已中断，已完成的结果已写出，重新运行即可继续")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        return progress
+
+    def analyze_path(self, path, cache_key):
+        try:
+            image_data, mime_type = self.read_image(path)
+            return self.analyze(path, image_data, mime_type, cache_key)
+        except Exception as e:
+            return dict(path=path, hash=cache_key, cached=False,
+                        elapsed=0, error=str(e))
+
+    def analyze_group(self, group):
+        """分析一组 (cache_key, [path, ...])，返回每组首个文件的记录"""
+        if len(group) == 1:
+            cache_key, paths = group[0]
+            return [self.analyze_path(paths[0], cache_key)]
+        start = time.time()
+        records, items = [None] * len(group), []
+        for i, (cache_key, paths) in enumerate(group):
+            try:
+                image_data, mime_type = self.read_image(paths[0])
+            except OSError as e:
+                records[i] = dict(path=paths[0], hash=cache_key,
+                                  cached=False, elapsed=0, error=str(e))
+                continue
+            if self.server.save_upload:
+                self.server.save_uploaded_file(
+                    image_data, mime_type, cache_key)
+            items.append((i, (image_data, mime_type, cache_key)))
+        results = self.server.analyze_images([item for _, item in items])
+        # 打包分析的耗时由组内图片均摊
+        elapsed = (time.time() - start) / max(1, len(items))
+        for (i, _), result in zip(items, results):
+            cache_key, paths = group[i]
+            records[i] = self.make_record(paths[0], cache_key, result,
+                                          False, elapsed)
+        return records
+
+
+def batch_main(args):
+    """aimglyze batch 子命令"""
+    server = AnalysisServer(args.config)
+    # 批量分析不使用过期结果（进程结束前来不及后台刷新），直接重新分析
+    server.stale_window = 0
+    files = collect_files(args.target,
+                          server.config['server']['allowed_extensions'],
+                          args.recursive)
+    if not files:
+        log.error("没有找到图片: %s", args.target)
+        return 1
+    writer = ResultWriter(args.output)
+    finished = writer.load_finished()
+    todo = [f for f in files if f not in finished]
+    log.info("共 %s 张图片，已完成 %s 张，结果写入: %s",
+             len(files), len(files) - len(todo), args.output)
+    if not todo:
+        return 0
+    pack = args.pack
+    if pack > 1 and not server.analyzer.supports_packing:
+        log.warning("%s 不支持多图打包，逐张分析", server.analyzer.__class__.__name__)
+        pack = 1
+    writer.open()
+    try:
+        progress = BatchRunner(server, writer, args.jobs,
+                               pack).run(todo)
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        writer.close()
+    log.info("批量分析完成: %s 张，缓存命中 %s，失败 %s，耗时 %.1f秒",
+             progress.done, progress.cached, progress.errors, time.time() - progress.start)
+    return 1 if progress.errors else 0
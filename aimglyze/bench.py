@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import sys
+import json
+import time
+import yaml
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import threading
+import http.client
+from pathlib import Path
+
+from .server import AnalysisServer, make_http_server
+
+log = logging.getLogger(__name__)
+
+# 流量类型及默认权重
+DEFAULT_MIX = dict(unique=2, duplicate=4, results=2, static=1, health=1)
+# 与基线比较的指标: (路径, 越大越好?)
+BASELINE_METRICS = [
+    (('throughput_rps',), True),
+    (('cache', 'hit_rate'), True),
+    (('rss_mb', 'peak'), False),
+] + [
+    (('latency_ms', kind, p), False)
+    for kind in ['all'] + list(DEFAULT_MIX)
+    for p in ('p50', 'p95', 'p99')
+]
+
+
+def parse_mix(text):
+    """解析流量配比，如 'unique=2,duplicate=4,health=1'"""
+    mix = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f"未知的流量类型: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, q):
+    """最近秩百分位数"""
+    if not sorted_values:
+        return None
+    idx = max(0, min(len(sorted_values) - 1,
+                     int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[idx]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    if not values:
+        return dict(count=0)
+    return dict(
+        count=len(values),
+        mean=round(sum(values) / len(values), 3),
+        p50=round(percentile(values, 50), 3),
+        p95=round(percentile(values, 95), 3),
+        p99=round(percentile(values, 99), 3),
+        max=round(values[-1], 3),
+    )
+
+
+def get_rss_mb():
+    """读取当前进程的 RSS 与峰值 RSS (MB)"""
+    rss = dict(current=None, peak=None)
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss['current'] = round(int(line.split()[1]) / 1024, 2)
+                elif line.startswith('VmHWM:'):
+                    rss['peak'] = round(int(line.split()[1]) / 1024, 2)
+    except OSError:
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # macOS 单位为字节，Linux 为 KB
+            peak = peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+            rss['peak'] = round(peak, 2)
+        except ImportError:
+            pass
+    return rss
+
+
+def make_image(rng, size):
+    """生成指定大小的伪图片数据（PNG 文件头 + 随机字节）"""
+    return b'\x89PNG\r\n\x1a\n' + rng.randbytes(max(0, size - 8))
+
+
+def make_multipart(image_data, mime_type='image/png', filename='bench.png'):
+    boundary = f"----aimglyze-bench-{os.urandom(8).hex()}"
+    body = b''.join([
+        f'--{boundary}\r\n'.encode(),
+        f'Content-Disposition: form-data; name="file"; '
+        f'filename="{filename}"\r\n'.encode(),
+        f'Content-Type: {mime_type}\r\n\r\n'.encode(),
+        image_data,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def prepare_config(config_path, workdir, analyzer='FakeAnalyzer',
+                   fake_setting=None, save_upload=None):
+    """
+    复制配置到临时目录: 缓存和上传目录放在 workdir 下，端口自动分配，
+    默认替换为 FakeAnalyzer，保留原配置的提示词。
+    """
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+
+    def absolute(path, default):
+        path = path or default
+        return path if os.path.isabs(path) else os.path.join(config_dir, path)
+
+    if analyzer:
+        config['analyzer'] = analyzer
+        setting = config.get('setting') or {}
+        setting.update(fake_setting or {})
+        config['setting'] = setting
+    cache = config.setdefault('cache', {}) or {}
+    cache.update(dir=os.path.join(workdir, 'cache'), cleanup_on_start=False)
+    config['cache'] = cache
+    server = config.setdefault('server', {}) or {}
+    server.update(
+        host='127.0.0.1', port=0,
+        frontend_root=absolute(server.get('frontend_root'), './frontend'),
+        sample_file=absolute(server.get('sample_file'), './sample-msg.json'),
+        upload_dir=os.path.join(workdir, 'uploads'),
+    )
+    if save_upload is not None:
+        server['save_upload'] = save_upload
+    config['server'] = server
+    config['log'] = dict(config.get('log') or {}, access_log='')
+    bench_config = os.path.join(workdir, 'config.yaml')
+    with open(bench_config, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+    return bench_config
+
+
+class BenchRunner(object):
+    """对运行中的服务器发送混合流量并统计结果"""
+
+    def __init__(self, host, port, frontend_root, mix=None, requests=500,
+                 concurrency=8, image_size=200 * 1024, dup_pool=8, seed=0):
+        self.host = host
+        self.port = port
+        self.mix = mix or dict(DEFAULT_MIX)
+        self.requests = requests
+        self.concurrency = concurrency
+        self.image_size = image_size
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # 静态资源列表
+        self.static_paths = ['/'] + sorted(
+            '/' + p.name for p in Path(frontend_root).iterdir()
+            if p.is_file() and p.name != 'index.html')
+        # 重复上传使用的图片池
+        self.dup_images = [make_image(self.rng, image_size)
+                           for _ in range(max(1, dup_pool))]
+        self.known_keys = []
+        self.latencies = {kind: [] for kind in DEFAULT_MIX}
+        self.errors = {kind: 0 for kind in DEFAULT_MIX}
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            data = resp.read()
+            return resp.status, data
+        finally:
+            conn.close()
+
+    def upload(self, image_data):
+        body, content_type = make_multipart(image_data)
+        status, data = self.request('POST', '/api/analyze', body, {
+            'Content-Type': content_type,
+            'Content-Length': str(len(body)),
+        })
+        result = json.loads(data)
+        ok = status == 200 and 'error' not in result
+        return ok, result.get('cache_key') if ok else None
+
+    def warmup(self):
+        """预先上传重复图片池，保证 duplicate/results 请求命中缓存"""
+        for image_data in self.dup_images:
+            ok, key = self.upload(image_data)
+            if ok:
+                self.known_keys.append(key)
+
+    def make_plan(self):
+        kinds = [k for k, w in self.mix.items() if w > 0]
+        weights = [self.mix[k] for k in kinds]
+        return self.rng.choices(kinds, weights=weights, k=self.requests)
+
+    def run_one(self, kind, rng):
+        # 准备请求数据，不计入耗时
+        if kind == 'unique':
+            payload = make_image(rng, self.image_size)
+        elif kind == 'duplicate':
+            payload = rng.choice(self.dup_images)
+        elif kind == 'results':
+            payload = rng.choice(self.known_keys or ['0' * 40])
+        elif kind == 'static':
+            payload = rng.choice(self.static_paths)
+        start = time.perf_counter()
+        try:
+            if kind in ('unique', 'duplicate'):
+                ok, _ = self.upload(payload)
+            elif kind == 'results':
+                status, _ = self.request('GET', f'/api/results/{payload}')
+                ok = status == 200
+            elif kind == 'static':
+                status, _ = self.request('GET', payload)
+                ok = status == 200
+            else:
+                status, _ = self.request('GET', '/api/health')
+                ok = status == 200
+        except Exception as e:
+            log.debug("请求失败 %s: %s", kind, e)
+            ok = False
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.latencies[kind].append(elapsed)
+            if not ok:
+                self.errors[kind] += 1
+
+    def run(self):
+        plan = self.make_plan()
+        index = iter(range(len(plan)))
+        index_lock = threading.Lock()
+
+        def worker(worker_id):
+            rng = random.Random(f"{self.rng.random()}-{worker_id}")
+            while True:
+                with index_lock:
+                    i = next(index, None)
+                if i is None:
+                    return
+                self.run_one(plan[i], rng)
+
+        threads = [threading.Thread(target=worker, args=(i,), daemon=True)
+                   for i in range(self.concurrency)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - start
+
+
+def run_bench(config_path, requests=500, concurrency=8, mix=None,
+              image_size=200 * 1024, dup_pool=8, seed=0,
+              analyzer='FakeAnalyzer', fake_setting=None, keep_workdir=False):
+    """启动服务器并执行一次压测，返回报告字典"""
+    workdir = tempfile.mkdtemp(prefix='aimglyze-bench-')
+    httpd = None
+    try:
+        bench_config = prepare_config(
+            config_path, workdir, analyzer, fake_setting)
+        server = AnalysisServer(bench_config)
+        httpd = make_http_server(server)
+        host, port = httpd.server_address[:2]
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        log.info("压测服务器: http://%s:%s, 工作目录: %s", host, port, workdir)
+
+        runner = BenchRunner(host, port, server.frontend_root, mix=mix,
+                             requests=requests, concurrency=concurrency,
+                             image_size=image_size, dup_pool=dup_pool,
+                             seed=seed)
+        runner.warmup()
+        # 预热产生的统计不计入报告
+        with server.stats_lock:
+            before = dict(server.stats)
+        duration = runner.run()
+        with server.stats_lock:
+            stats = {k: v - before.get(k, 0) for k, v in server.stats.items()}
+
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        all_latencies = [v for values in runner.latencies.values()
+                         for v in values]
+        report = dict(
+            timestamp=time.time(),
+            python=platform.python_version(),
+            config=os.path.abspath(config_path),
+            analyzer=server.analyzer.__class__.__name__,
+            params=dict(requests=requests, concurrency=concurrency,
+                        mix=runner.mix, image_size=image_size,
+                        dup_pool=dup_pool, seed=seed,
+                        threaded=server.config['server']['threaded']),
+            duration_s=round(duration, 3),
+            throughput_rps=round(len(all_latencies) / duration, 3),
+            latency_ms=dict(
+                all=summarize(all_latencies),
+                **{k: summarize(v) for k, v in runner.latencies.items()}),
+            errors=runner.errors,
+            rss_mb=get_rss_mb(),
+            cache=dict(stats, hit_rate=round(
+                (stats['memory_hits'] + stats['disk_hits']) / lookups, 4)
+                if lookups else None),
+        )
+        return report
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+        if not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _lookup(report, path):
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+
+def compare_reports(report, baseline, tolerance=0.1):
+    """
+    与基线比较，返回 (比较明细, 回归列表)。
+    指标变差超过 tolerance（相对值）即视为回归。
+    """
+    details, regressions = [], []
+    for path, higher_is_better in BASELINE_METRICS:
+        new, old = _lookup(report, path), _lookup(baseline, path)
+        if not isinstance(new, (int, float)) or not isinstance(old, (int, float)):
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        item = dict(metric='.'.join(path), baseline=old, current=new,
+                    change=round(change, 4), regression=worse > tolerance)
+        details.append(item)
+        if item['regression']:
+            regressions.append(item)
+    return details, regressions
+
+
+def bench_main(args):
+    """aimglyze bench 子命令"""
+    if not args.verbose:
+        # 压测时只显示服务器的警告和错误
+        for name in ('aimglyze.server', 'aimglyze.storage',
+                     'aimglyze.analyzer'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+    fake_setting = dict(ttft=args.fake_ttft, token_delay=args.fake_token_delay,
+                        error_rate=args.fake_error_rate, seed=args.seed)
+    report = run_bench(
+        args.config, requests=args.requests, concurrency=args.concurrency,
+        mix=parse_mix(args.mix) if args.mix else None,
+        image_size=int(args.image_size * 1024), dup_pool=args.dup_pool,
+        seed=args.seed,
+        analyzer=None if args.analyzer == 'keep' else args.analyzer,
+        fake_setting=fake_setting, keep_workdir=args.keep_workdir)
+    code = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        details, regressions = compare_reports(
+            report, baseline, args.tolerance)
+        report['comparison'] = dict(
+            baseline=os.path.abspath(args.baseline),
+            tolerance=args.tolerance, details=details,
+            regressions=[r['metric'] for r in regressions])
+        for r in regressions:
+            log.warning("性能回归: %s %s -> %s (%+.1f%%)",
+                        r['metric'], r['baseline'], r['current'], r['change'] * 100)
+        code = 1 if regressions else 0
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        log.info("压测报告已保存: %s", args.output)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        log.info("基线已保存: %s", args.save_baseline)
+    return code
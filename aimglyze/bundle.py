@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import io
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import logging
+
+log = logging.getLogger(__name__)
+
+BUNDLE_VERSION = 1
+SUMS_NAME = 'SHA256SUMS'
+MANIFEST_NAME = 'manifest.json'
+# 缓存键与上传文件名只允许这些字符，防止路径穿越
+KEY_RE = re.compile(r'^[0-9A-Za-z_-]+$')
+UPLOAD_RE = re.compile(r'^([0-9a-f]{40})(\.[0-9A-Za-z]+)?$')
+
+
+class BundleError(Exception):
+    """bundle 格式错误或校验失败"""
+
+
+class BundleWriter(object):
+    """
+    把文件逐个写入 tar.gz，校验和先写到临时文件，
+    最后追加 SHA256SUMS (sha256sum 格式) 与 manifest.json
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.temp = f"{self.path}.{os.getpid()}.tmp"
+        self.tar = tarfile.open(self.temp, 'w:gz')
+        self.sums = tempfile.TemporaryFile()
+        self.counts = dict(cache=0, uploads=0)
+
+    def addfile(self, name, data, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def add(self, folder, name, data, mtime):
+        member = f"{folder}/{name}"
+        self.addfile(member, data, mtime)
+        digest = hashlib.sha256(data).hexdigest()
+        self.sums.write(f"{digest}  {member}\n".encode('utf-8'))
+        self.counts[folder] += 1
+
+    def close(self, **extra):
+        """写入校验和与 manifest 并完成文件，返回 manifest"""
+        now = time.time()
+        self.sums.seek(0)
+        sums = self.sums.read()
+        self.sums.close()
+        self.addfile(SUMS_NAME, sums, now)
+        manifest = dict(version=BUNDLE_VERSION, created=now,
+                        counts=self.counts,
+                        sums_sha256=hashlib.sha256(sums).hexdigest(),
+                        **extra)
+        self.addfile(MANIFEST_NAME, json.dumps(
+            manifest, ensure_ascii=False, indent=2).encode('utf-8'), now)
+        self.tar.close()
+        os.replace(self.temp, self.path)
+        return manifest
+
+    def abort(self):
+        self.tar.close()
+        self.sums.close()
+        try:
+            os.unlink(self.temp)
+        except OSError:
+            pass
+
+
+def read_cache_timestamp(path):
+    """读取缓存文件中的时间戳，文件不存在返回 None，无法读取返回 0"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            timestamp = json.load(f).get('timestamp', 0)
+        return float(timestamp)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError, AttributeError):
+        return 0.0
+
+
+def export_bundle(context, output, uploads=False, since=None, owns=None):
+    """
+    把缓存 (及上传文件) 打包为 tar.gz bundle，返回 manifest。
+    已过期 (超过有效期与 stale_while_revalidate 窗口) 的缓存不打包；
+    since 不为 None 时只打包此时间之后写入的条目，用于增量同步；
+    owns 不为 None 时只打包 owns(cache_key) 为真的缓存 (通常为当前分析器
+    配置的结果)，否则包含共用缓存目录中所有配置的结果
+    """
+    now = time.time()
+    max_age = context.cache_max_age + context.stale_window
+    writer = BundleWriter(output)
+    try:
+        # 从最后一个持久缓存层读取，磁盘层与 Redis 层相同
+        for cache_key, cache_data in context.cache_entries(since, owns):
+            if not KEY_RE.match(cache_key):
+                continue
+            try:
+                timestamp = float(cache_data.get('timestamp', 0))
+            except (TypeError, ValueError):
+                log.warning("跳过时间戳无效的缓存: %s", cache_key)
+                continue
+            if now - timestamp > max_age:
+                continue
+            if since is not None and timestamp < since:
+                continue
+            data = json.dumps(cache_data, ensure_ascii=False,
+                              indent=2).encode('utf-8')
+            writer.add('cache', f"{cache_key}.json", data, timestamp)
+        if uploads and context.save_upload and context.upload_dir is not None:
+            with os.scandir(context.upload_dir) as it:
+                for entry in it:
+                    if not (UPLOAD_RE.match(entry.name) and entry.is_file()):
+                        continue
+                    mtime = entry.stat().st_mtime
+                    if since is not None and mtime < since:
+                        continue
+                    with open(entry.path, 'rb') as f:
+                        writer.add('uploads', entry.name, f.read(), mtime)
+        elif uploads:
+            log.warning("上传保存功能未启用，不打包上传文件")
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close(source=context.config_path, since=since)
+
+
+class BundleImporter(object):
+    """
+    把 bundle 合并到本地缓存与上传目录:
+    - 本地没有的缓存直接写入，已有的按时间戳保留较新者，相同或更旧的跳过
+    - 上传文件按内容寻址，已存在的跳过，内容与文件名的哈希不符的丢弃
+    读取时先把需要写入的文件放到暂存目录，读完并核对 SHA256SUMS 与
+    manifest 后才移入，不完整的 bundle 不会写入任何文件。
+    缓存写入磁盘层，再写入其他持久层 (如 Redis)，需要配置磁盘层
+    """
+
+    def __init__(self, context, dry_run=False):
+        self.context = context
+        self.dry_run = dry_run
+        self.stats = dict(added=0, replaced=0, skipped=0,
+                          uploads_added=0, uploads_skipped=0, invalid=0)
+        # {成员名: (sha256, 时间戳, 是否写入, 暂存路径)}
+        self.pending = {}
+        self.upload_stems = None
+        self.staging = {}
+
+    def stage_dir(self, folder):
+        """暂存目录与目标目录在同一文件系统，移入时只需重命名"""
+        if folder not in self.staging:
+            parent = self.context.cache_dir if folder == 'cache' \
+                else self.context.upload_dir
+            self.staging[folder] = tempfile.mkdtemp(
+                prefix='.bundle-', dir=parent)
+        return self.staging[folder]
+
+    def stage(self, member, data, timestamp, write):
+        """记录成员的校验和，需要写入时放入暂存目录"""
+        path = None
+        if write and not self.dry_run:
+            folder, _, name = member.partition('/')
+            path = os.path.join(self.stage_dir(folder), name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, (timestamp, timestamp))
+        self.pending[member] = (hashlib.sha256(data).hexdigest(),
+                                timestamp, write, path)
+
+    def read_cache(self, member, name, data):
+        try:
+            timestamp = float(json.loads(data)['timestamp'])
+        except (ValueError, TypeError, KeyError):
+            log.warning("bundle 中的缓存格式错误: %s", member)
+            self.stats['invalid'] += 1
+            return
+        local = read_cache_timestamp(
+            self.context.get_cache_file_path(name[:-5]))
+        self.stage(member, data, timestamp,
+                   local is None or local < timestamp)
+
+    def read_upload(self, member, name, data, mtime):
+        context = self.context
+        if not context.save_upload or context.upload_dir is None:
+            self.stage(member, data, mtime, False)
+            return
+        stem = UPLOAD_RE.match(name).group(1)
+        if hashlib.sha1(data).hexdigest() != stem:
+            log.warning("上传文件内容与文件名不符: %s", member)
+            self.stats['invalid'] += 1
+            return
+        if self.upload_stems is None:
+            # 同一图片可能以不同扩展名保存，按哈希判断是否已存在
+            with os.scandir(context.upload_dir) as it:
+                self.upload_stems = {e.name.split('.', 1)[0] for e in it}
+        self.stage(member, data, mtime, stem not in self.upload_stems)
+        self.upload_stems.add(stem)
+
+    def commit(self, member, timestamp, write, path):
+        """把校验通过的文件移入目标目录"""
+        context = self.context
+        folder, _, name = member.partition('/')
+        if folder == 'uploads':
+            if not write:
+                self.stats['uploads_skipped'] += 1
+                return
+            self.stats['uploads_added'] += 1
+            if not self.dry_run:
+                target = context.upload_dir / name
+                os.replace(path, target)
+                context.file_hash_map[name.split('.', 1)[0]] = str(target)
+            return
+        cache_key = name[:-5]
+        cache_file = context.get_cache_file_path(cache_key)
+        # 暂存之后本地可能又写入了更新的结果，移入前再比较一次
+        local = read_cache_timestamp(cache_file)
+        if not write or (local is not None and local >= timestamp):
+            self.stats['skipped'] += 1
+            return
+        self.stats['added' if local is None else 'replaced'] += 1
+        if self.dry_run:
+            return
+        os.replace(path, cache_file)
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cache_data = json.load(f)
+        # 进程内的旧结果失效
+        context.results_cache.pop(cache_key, None)
+        context.register_cache_file(cache_key)
+        cache_data['cache_key'] = cache_key
+        for backend in context.cache_backends:
+            if backend.name == 'disk':
+                continue
+            try:
+                context.put_backend(backend, cache_data)
+            except Exception as e:
+                log.warning("写入缓存失败: %s %s, 错误: %s", backend.name, cache_key, e)
+        context.index_cache_result(cache_key, cache_data.get('result'),
+                                   timestamp)
+
+    def run(self, path):
+        """读取并合并 bundle，返回 (manifest, 统计)；格式或校验错误抛出 BundleError"""
+        try:
+            return self._run(path)
+        finally:
+            for directory in self.staging.values():
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def _run(self, path):
+        manifest, sums = None, None
+        with tarfile.open(path, 'r|gz') as tar:
+            for member in tar:
+                folder, _, name = member.name.partition('/')
+                if member.isfile() and member.name == MANIFEST_NAME:
+                    manifest = json.loads(tar.extractfile(member).read())
+                elif member.isfile() and member.name == SUMS_NAME:
+                    sums = tar.extractfile(member).read()
+                elif member.isfile() and folder == 'cache' \
+                        and name.endswith('.json') and KEY_RE.match(name[:-5]):
+                    self.read_cache(member.name, name,
+                                    tar.extractfile(member).read())
+                elif member.isfile() and folder == 'uploads' \
+                        and UPLOAD_RE.match(name):
+                    self.read_upload(member.name, name,
+                                     tar.extractfile(member).read(),
+                                     member.mtime)
+                else:
+                    log.warning("未知的 bundle 成员，跳过: %s", member.name)
+                    self.stats['invalid'] += 1
+        if manifest is None or sums is None:
+            raise BundleError("bundle 缺少 manifest 或校验和，文件可能不完整")
+        if int(manifest.get('version', 0)) > BUNDLE_VERSION:
+            raise BundleError(f"不支持的 bundle 版本: {manifest['version']}")
+        if hashlib.sha256(sums).hexdigest() != manifest.get('sums_sha256'):
+            raise BundleError("SHA256SUMS 与 manifest 不一致")
+        expected = {}
+        for line in sums.decode('utf-8').splitlines():
+            digest, _, member = line.partition('  ')
+            expected[member] = digest
+        for member, (digest, timestamp, write, path) in self.pending.items():
+            if expected.get(member) != digest:
+                log.warning("校验和不符，跳过: %s", member)
+                self.stats['invalid'] += 1
+                continue
+            self.commit(member, timestamp, write, path)
+        return manifest, self.stats
+
+
+def bundle_export_main(args):
+    """aimglyze bundle-export 子命令"""
+    from .storage import StorageContext
+    from .export import parse_time
+    try:
+        since = parse_time(args.since)
+    except ValueError as e:
+        log.error("%s", e)
+        return 1
+    context = StorageContext(args.config)
+    try:
+        context.require_persistent()
+    except ValueError as e:
+        log.error("%s", e)
+        return 1
+    start = time.time()
+    manifest = export_bundle(context, args.output, args.uploads, since,
+                             None if args.all_apps else context.owns_key)
+    counts = manifest['counts']
+    log.info("已打包 %s 个缓存、%s 个上传文件 -> %s (%.1f MB, %.1f 秒)",
+             counts['cache'], counts['uploads'], args.output,
+             os.path.getsize(args.output) / 2**20, time.time() - start)
+    return 0
+
+
+def bundle_import_main(args):
+    """aimglyze bundle-import 子命令"""
+    from .storage import StorageContext
+    context = StorageContext(args.config)
+    if 'disk' not in context.config['cache']['backends']:
+        log.error("bundle-import 把缓存写入磁盘缓存层，cache.backends 中没有 disk")
+        return 1
+    importer = BundleImporter(context, dry_run=args.dry_run)
+    try:
+        manifest, stats = importer.run(args.bundle)
+    except (BundleError, tarfile.TarError, OSError, ValueError) as e:
+        log.error("导入失败，未写入任何文件: %s", e)
+        return 1
+    log.info("bundle 来源: %s，创建于 %s", manifest.get('source'),
+             time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest['created'])))
+    log.info("%s: 新增 %s，替换 %s，跳过 %s 个缓存；"
+             "新增 %s，跳过 %s 个上传文件；无效 %s 个",
+             '模拟导入' if args.dry_run else '导入完成',
+             stats['added'], stats['replaced'], stats['skipped'],
+             stats['uploads_added'], stats['uploads_skipped'], stats['invalid'])
+    return 1 if stats['invalid'] else 0
@@ -4,12 +4,16 @@
 
 import os
 import sys
+import logging
 import argparse
 from pathlib import Path
 import importlib.resources as resources
 
-# 导入服务器启动函数
-from .server import run_server, cleanup_cache, cleanup_low_confidence_uploads
+# 服务器、分析器等模块在执行对应子命令时才导入，加快清理等命令的启动
+from .logger import setup_logging
+
+# 以 python -m aimglyze.cli 运行时 __name__ 为 __main__
+log = logging.getLogger('aimglyze.cli')
 
 # 应用别名映射
 APP_ALIASES = {
@@ -28,20 +32,21 @@ def resolve_config_path(config_arg: str):
     if config_arg.lower() in APP_ALIASES:
         alias = config_arg.lower()
         resource_path = APP_ALIASES[alias]
-        # 尝试从包资源中获取
+        # 尝试从包资源中获取，resources.path 只接受文件名，子目录用 files 拼接
         try:
-            with resources.path('aimglyze.apps', resource_path) as config_path:
+            resource = resources.files('aimglyze') / 'apps' / resource_path
+            with resources.as_file(resource) as config_path:
                 if config_path.exists():
-                    print(f"找到应用别名 '{alias}' -> {config_path}")
+                    log.info("找到应用别名 '%s' -> %s", alias, config_path)
                     return str(config_path)
                 else:
                     raise FileNotFoundError(f"应用配置未找到: {config_path}")
         except Exception as e:
-            print(f"无法加载应用配置 '{alias}': {str(e)}")
+            log.warning("无法加载应用配置 '%s': %s", alias, e)
             # 尝试在开发环境中查找
-            dev_path = Path(__file__).parent.parent / 'apps' / resource_path
+            dev_path = Path(__file__).parent / 'apps' / resource_path
             if dev_path.exists():
-                print(f"在开发环境中找到: {dev_path}")
+                log.info("在开发环境中找到: %s", dev_path)
                 return str(dev_path)
             else:
                 raise FileNotFoundError(f"应用配置未找到: {resource_path}")
@@ -56,6 +61,24 @@ def resolve_config_path(config_arg: str):
     return str(config_path.absolute())
 
 
+def parse_mount(spec: str):
+    """
+    解析 server 子命令挂载的应用 "<路径前缀>=<配置>" 或 "<配置>"，
+    返回 (路径前缀, 配置文件路径)。未指定前缀时使用应用别名，
+    或配置文件所在目录名的小写
+    """
+    prefix, sep, config = spec.partition('=')
+    if not sep:
+        prefix, config = '', spec
+    config_path = resolve_config_path(config)
+    if not os.path.exists(config_path):
+        raise FileNotFoundError(f"配置文件不存在: {config_path}")
+    if not prefix:
+        prefix = config.lower() if config.lower() in APP_ALIASES \
+            else Path(config_path).parent.name.lower()
+    return '/' + prefix.strip('/'), config_path
+
+
 def main():
     """命令行入口函数"""
     parser = argparse.ArgumentParser(
@@ -66,8 +89,19 @@ def main():
   %(prog)s server desc-tags                    # 使用App-DescTags应用别名
   %(prog)s server task-score                   # 使用App-TaskScore应用别名
   %(prog)s server ./App-DescTags/config.yaml   # 使用配置文件路径
+  %(prog)s server desc-tags -w 4               # 4 个工作进程
+  %(prog)s server desc-tags task-score         # 两个应用挂载在 /desc-tags/ 与 /task-score/
+  %(prog)s server /tags=desc-tags /score=./App-TaskScore/config.yaml  # 指定路径前缀
   %(prog)s clean-cache desc-tags               # 清理缓存
   %(prog)s clean-uploads task-score            # 清理低置信度的上传文件
+  %(prog)s migrate-keys desc-tags              # 旧缓存键加上分析器指纹
+  %(prog)s batch task-score ./sheets -j 4 -o results.jsonl  # 批量分析目录
+  %(prog)s bench desc-tags -n 1000 -c 16       # 使用模拟分析器压测
+  %(prog)s microbench desc-tags --history h.jsonl  # 热点函数微基准
+  %(prog)s analytics task-score --cohorts       # 评价结果分组统计
+  %(prog)s export task-score -o results.csv.gz  # 导出缓存结果
+  %(prog)s bundle-export desc-tags -o cache.tar.gz --uploads  # 打包缓存
+  %(prog)s bundle-import desc-tags cache.tar.gz    # 合并打包的缓存
 
 支持的别名:
   desc-tags     - App-DescTags图片分析应用
@@ -78,8 +112,12 @@ def main():
     subparsers = parser.add_subparsers(dest='command', help='子命令')
     # server 子命令
     server_parser = subparsers.add_parser('server', help='启动服务器')
-    server_parser.add_argument("config", type=str,
-                               help="配置文件路径或应用别名 (desc-tags, task-score)")
+    server_parser.add_argument("config", type=str, nargs='+',
+                               help="配置文件路径或应用别名 (desc-tags, task-score)，"
+                               "多个时按路径前缀挂载在同一服务器中，"
+                               "可写作 <路径前缀>=<配置>")
+    server_parser.add_argument("-w", "--workers", type=int, default=None,
+                               help="工作进程数 (默认: 配置中的 server.workers)")
     # clean-cache 子命令
     cache_parser = subparsers.add_parser('clean-cache', help='清理过期缓存')
     cache_parser.add_argument("config", type=str,
@@ -92,21 +130,191 @@ def main():
                                 help="置信度阈值，低于此值的文件将被清理 (默认: 0.5)")
     uploads_parser.add_argument("--dry-run", action="store_true",
                                 help="模拟运行，不实际删除文件")
+    # migrate-keys 子命令
+    migrate_parser = subparsers.add_parser(
+        'migrate-keys', help='旧缓存改为包含分析器指纹的缓存键')
+    migrate_parser.add_argument("config", type=str,
+                                help="配置文件路径或应用别名")
+    migrate_parser.add_argument("--dry-run", action="store_true",
+                                help="模拟运行，不实际修改文件")
+    # batch 子命令
+    batch_parser = subparsers.add_parser('batch', help='离线批量分析图片')
+    batch_parser.add_argument("config", type=str,
+                              help="配置文件路径或应用别名")
+    batch_parser.add_argument("target", type=str,
+                              help="图片目录或通配符，如 './sheets/*.jpg'")
+    batch_parser.add_argument("-o", "--output", type=str,
+                              default="batch-results.jsonl",
+                              help="结果文件，.jsonl 或 .csv，已存在时续跑 "
+                              "(默认: batch-results.jsonl)")
+    batch_parser.add_argument("-j", "--jobs", type=int, default=4,
+                              help="并发分析数 (默认: 4)")
+    batch_parser.add_argument("-r", "--recursive", action="store_true",
+                              help="递归查找子目录")
+    batch_parser.add_argument("-p", "--pack", type=int, default=1,
+                              help="每次请求打包的图片数，>1 时节省提示词 "
+                              "token 与往返次数 (默认: 1，不打包)")
+    # bench 子命令
+    bench_parser = subparsers.add_parser('bench', help='端到端压测与基准测试')
+    bench_parser.add_argument("config", type=str,
+                              help="配置文件路径或应用别名")
+    bench_parser.add_argument("-n", "--requests", type=int, default=500,
+                              help="请求总数 (默认: 500)")
+    bench_parser.add_argument("-c", "--concurrency", type=int, default=8,
+                              help="并发数 (默认: 8)")
+    bench_parser.add_argument("--mix", type=str, default=None,
+                              help="流量配比，如 unique=2,duplicate=4,results=2,"
+                              "static=1,health=1 (即默认值)")
+    bench_parser.add_argument("--image-size", type=float, default=200,
+                              help="上传图片大小，单位 KB (默认: 200)")
+    bench_parser.add_argument("--dup-pool", type=int, default=8,
+                              help="重复上传的图片池大小 (默认: 8)")
+    bench_parser.add_argument("--seed", type=int, default=0,
+                              help="随机种子 (默认: 0)")
+    bench_parser.add_argument("--analyzer", type=str, default="FakeAnalyzer",
+                              help="替换使用的分析器，keep 表示沿用配置 "
+                              "(默认: FakeAnalyzer)")
+    bench_parser.add_argument("--fake-ttft", type=float, default=0.05,
+                              help="模拟首 token 延迟，秒 (默认: 0.05)")
+    bench_parser.add_argument("--fake-token-delay", type=float, default=0.0,
+                              help="模拟分片延迟，秒 (默认: 0)")
+    bench_parser.add_argument("--fake-error-rate", type=float, default=0.0,
+                              help="模拟服务商错误比例 (默认: 0)")
+    bench_parser.add_argument("-o", "--output", type=str, default=None,
+                              help="报告输出文件，默认打印到标准输出")
+    bench_parser.add_argument("--baseline", type=str, default=None,
+                              help="与基线报告比较，出现回归时返回码为 1")
+    bench_parser.add_argument("--tolerance", type=float, default=0.1,
+                              help="回归判定的相对阈值 (默认: 0.1)")
+    bench_parser.add_argument("--save-baseline", type=str, default=None,
+                              help="将本次报告保存为基线")
+    bench_parser.add_argument("--keep-workdir", action="store_true",
+                              help="保留压测临时目录")
+    bench_parser.add_argument("-v", "--verbose", action="store_true",
+                              help="输出服务器日志")
+    # microbench 子命令
+    micro_parser = subparsers.add_parser('microbench', help='热点函数微基准')
+    micro_parser.add_argument("config", type=str,
+                              help="配置文件路径或应用别名")
+    micro_parser.add_argument("--cases", type=str, default=None,
+                              help="要运行的用例，逗号分隔 (默认: 全部)")
+    micro_parser.add_argument("--sizes", type=str, default=None,
+                              help="图片大小列表 (默认: 100K,1M,5M,20M)")
+    micro_parser.add_argument("--entries", type=str, default=None,
+                              help="缓存条目数列表，最多可到 1M "
+                              "(默认: 1K,10K)")
+    micro_parser.add_argument("--upload-entries", type=str, default=None,
+                              help="上传文件数列表 (默认: 同 --entries)")
+    micro_parser.add_argument("--repeat", type=int, default=5,
+                              help="每个用例重复测量的轮数 (默认: 5)")
+    micro_parser.add_argument("--min-time", type=float, default=0.1,
+                              help="每轮最少耗时，秒 (默认: 0.1)")
+    micro_parser.add_argument("--history", type=str, default=None,
+                              help="追加结果的历史文件 (JSONL)，"
+                              "并与上一条记录比较")
+    micro_parser.add_argument("--label", type=str, default=None,
+                              help="本次记录的标签，如版本号")
+    micro_parser.add_argument("--import-budget", type=float, default=50,
+                              help="清理命令导入耗时预算，毫秒，超出或加载了"
+                              "服务商 SDK 时返回码为 1 (默认: 50，0 不检查)")
+    micro_parser.add_argument("-v", "--verbose", action="store_true",
+                              help="输出服务器日志")
+    # analytics 子命令
+    analytics_parser = subparsers.add_parser('analytics', help='评价结果统计')
+    analytics_parser.add_argument("config", type=str,
+                                  help="配置文件路径或应用别名")
+    analytics_parser.add_argument("--cohorts", action="store_true",
+                                  help="只列出按评价表标题分组的人数与平均总分")
+    analytics_parser.add_argument("--title", type=str, default=None,
+                                  help="只统计此标题的评价表 (默认: 全部)")
+    analytics_parser.add_argument("--rater", type=str, default="teacher",
+                                  choices=["self", "peer", "teacher"],
+                                  help="统计的评分者 (默认: teacher)")
+    analytics_parser.add_argument("--bins", type=int, default=10,
+                                  help="总分直方图的分组数 (默认: 10)")
+    analytics_parser.add_argument("--threshold", type=float, default=3.5,
+                                  help="异常值的稳健 z 分数阈值 (默认: 3.5)")
+    analytics_parser.add_argument("-o", "--output", type=str, default=None,
+                                  help="报告输出文件，默认打印到标准输出")
+    analytics_parser.add_argument("--all-apps", action="store_true",
+                                  help="包含共用缓存目录中其他分析器配置的结果 "
+                                  "(默认: 只含当前配置)")
+    # export 子命令
+    export_parser = subparsers.add_parser('export', help='导出缓存结果')
+    export_parser.add_argument("config", type=str,
+                               help="配置文件路径或应用别名")
+    export_parser.add_argument("-o", "--output", type=str,
+                               default="export.jsonl",
+                               help="输出文件，- 为标准输出，以 .gz 结尾时 gzip "
+                               "压缩 (默认: export.jsonl)")
+    export_parser.add_argument("-f", "--format", type=str, default=None,
+                               choices=["jsonl", "csv", "parquet"],
+                               help="导出格式 (默认: 按输出文件扩展名，否则 jsonl)")
+    export_parser.add_argument("--since", type=str, default=None,
+                               help="起始时间，Unix 时间戳或 ISO 日期时间")
+    export_parser.add_argument("--until", type=str, default=None,
+                               help="截止时间 (不含)，Unix 时间戳或 ISO 日期时间")
+    export_parser.add_argument("--min-confidence", type=float, default=None,
+                               help="置信度下限")
+    export_parser.add_argument("--tag", type=str, default=None,
+                               help="只导出包含此标签的结果")
+    export_parser.add_argument("-z", "--gzip", action="store_true",
+                               help="gzip 压缩输出")
+    export_parser.add_argument("--all-apps", action="store_true",
+                               help="包含共用缓存目录中其他分析器配置的结果 "
+                               "(默认: 只含当前配置)")
+    # bundle-export 子命令
+    bexport_parser = subparsers.add_parser(
+        'bundle-export', help='打包缓存与上传文件，用于迁移到其他节点')
+    bexport_parser.add_argument("config", type=str,
+                                help="配置文件路径或应用别名")
+    bexport_parser.add_argument("-o", "--output", type=str,
+                                default="aimglyze-bundle.tar.gz",
+                                help="bundle 文件 (默认: aimglyze-bundle.tar.gz)")
+    bexport_parser.add_argument("--uploads", action="store_true",
+                                help="同时打包上传文件")
+    bexport_parser.add_argument("--since", type=str, default=None,
+                                help="只打包此时间之后写入的条目，"
+                                "Unix 时间戳或 ISO 日期时间")
+    bexport_parser.add_argument("--all-apps", action="store_true",
+                                help="包含共用缓存目录中其他分析器配置的结果 "
+                                "(默认: 只含当前配置)")
+    # bundle-import 子命令
+    bimport_parser = subparsers.add_parser(
+        'bundle-import', help='把 bundle 合并到本地缓存')
+    bimport_parser.add_argument("config", type=str,
+                                help="配置文件路径或应用别名")
+    bimport_parser.add_argument("bundle", type=str, help="bundle 文件")
+    bimport_parser.add_argument("--dry-run", action="store_true",
+                                help="只校验并统计，不写入文件")
 
     args = parser.parse_args()
     if not args.command:
         parser.print_help()
         sys.exit(1)
+    setup_logging()
+
+    if args.command == 'server':
+        if len(args.config) > 1 or '=' in args.config[0]:
+            # 一个服务器挂载多个应用
+            from .hosting import run_host
+            try:
+                mounts = [parse_mount(spec) for spec in args.config]
+            except Exception as e:
+                log.error("%s", e)
+                sys.exit(1)
+            run_host(mounts, args.workers)
+        args.config = args.config[0]
 
     try:
         # 解析配置文件路径
         config_path = resolve_config_path(args.config)
     except Exception as e:
-        print(f"错误: {str(e)}")
+        log.error("%s", e)
         sys.exit(1)
     # 检查配置文件是否存在
     if not os.path.exists(config_path):
-        print(f"错误: 配置文件不存在: {config_path}")
+        log.error("配置文件不存在: %s", config_path)
         sys.exit(1)
     # 检查文件扩展名
     config_path_obj = Path(config_path)
@@ -114,26 +322,63 @@ def main():
         print(f"警告: 配置文件可能不是 YAML 格式: {config_path_obj}")
         choice = input("是否继续? (y/N): ").strip().lower()
         if choice != 'y':
-            print("操作已取消")
+            log.info("操作已取消")
             sys.exit(0)
+    # 子命令的 *_main(args) 从 args.config 读取配置，使用解析后的路径
+    args.config = config_path
 
     # 执行相应命令
     if args.command == 'server':
         # 启动服务器
-        run_server(config_path)
+        from .server import run_server
+        run_server(config_path, args.workers)
     elif args.command == 'clean-cache':
         # 清理缓存
-        print("清理过期缓存...")
+        from .storage import cleanup_cache
+        log.info("清理过期缓存...")
         cleanup_cache(config_path)
-        print("缓存清理完成")
+        log.info("缓存清理完成")
     elif args.command == 'clean-uploads':
         # 清理低置信度的上传文件
-        print(f"清理置信度低于 {args.confidence} 的上传文件...")
+        from .storage import cleanup_low_confidence_uploads
+        log.info("清理置信度低于 %s 的上传文件...", args.confidence)
         if args.dry_run:
-            print("模拟运行模式 - 不会实际删除文件")
+            log.info("模拟运行模式 - 不会实际删除文件")
         cleanup_low_confidence_uploads(config_path,
                                        args.confidence, args.dry_run)
-        print("上传文件清理完成")
+        log.info("上传文件清理完成")
+    elif args.command == 'migrate-keys':
+        # 迁移旧缓存键
+        from .storage import migrate_cache_keys
+        migrate_cache_keys(config_path, args.dry_run)
+    elif args.command == 'batch':
+        # 批量分析
+        from .batch import batch_main
+        sys.exit(batch_main(args))
+    elif args.command == 'bench':
+        # 压测
+        from .bench import bench_main
+        sys.exit(bench_main(args))
+    elif args.command == 'microbench':
+        # 微基准
+        from .microbench import microbench_main
+        sys.exit(microbench_main(args))
+    elif args.command == 'analytics':
+        # 评价结果统计
+        from .analytics import analytics_main
+        sys.exit(analytics_main(args))
+    elif args.command == 'export':
+        # 导出缓存结果
+        from .export import export_main
+        sys.exit(export_main(args))
+    elif args.command == 'bundle-export':
+        # 打包缓存
+        from .bundle import bundle_export_main
+        sys.exit(bundle_export_main(args))
+    elif args.command == 'bundle-import':
+        # 合并打包的缓存
+        from .bundle import bundle_import_main
+        sys.exit(bundle_import_main(args))
 
 
 if __name__ == "__main__":
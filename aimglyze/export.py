@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import io
+import os
+import sys
+import csv
+import json
+import zlib
+import itertools
+import logging
+from datetime import datetime
+
+from .search import normalize_tag
+
+log = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('jsonl', 'csv', 'parquet')
+CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+    'parquet': 'application/vnd.apache.parquet',
+}
+# 展平后的列: 评价表每个评分要点一行，图片描述每条结果一行
+TASK_SCORE_FIELDS = [
+    'cache_key', 'timestamp', 'confidence', 'table_title',
+    'total_self', 'total_peer', 'total_teacher',
+    'dimension', 'dimension_score', 'point', 'point_score',
+    'self', 'peer', 'teacher',
+]
+DESC_TAGS_FIELDS = ['cache_key', 'timestamp', 'confidence',
+                    'name', 'desc', 'tags']
+STRING_FIELDS = {'cache_key', 'table_title', 'dimension', 'point',
+                 'name', 'desc', 'tags'}
+# JSONL/CSV 缓冲达到此大小时输出一块
+CHUNK_SIZE = 64 * 1024
+# Parquet 每个行组的行数
+PARQUET_ROWS = 5000
+
+
+def import_pyarrow():
+    """延迟导入 pyarrow，未安装时给出安装提示"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("导出 Parquet 需要 pyarrow: pip install pyarrow") \
+            from None
+    return pyarrow
+
+
+def parse_time(text):
+    """解析时间参数: Unix 时间戳或 ISO 格式日期时间，空值返回 None"""
+    if text is None or str(text).strip() == '':
+        return None
+    text = str(text).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise ValueError(f"Invalid time: {text}") from None
+
+
+def to_number(value):
+    """分数字段转为浮点数，无法转换时返回 None"""
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_cache_entries(context, since=None, until=None,
+                       min_confidence=None, tag=None, owns=None):
+    """
+    逐条读取持久缓存层 (StorageContext.cache_entries) 并按条件筛选，生成缓存数据:
+    - owns: 只保留 owns(cache_key) 为真的缓存，通常为 StorageContext.owns_key，
+      即当前分析器配置的结果；None 时包含共用缓存目录中所有配置的结果
+    - since/until: 结果时间戳范围 [since, until)
+    - min_confidence: 置信度下限
+    - tag: 结果须包含此标签 (不区分大小写)
+    边遍历边读取，不预先收集条目列表，内存占用与条目数无关
+    """
+    tag = normalize_tag(tag) if tag else None
+    for cache_key, cache_data in context.cache_entries(since, owns):
+        result = cache_data.get('result')
+        if not isinstance(result, dict):
+            continue
+        timestamp = to_number(cache_data.get('timestamp')) or 0.0
+        if since is not None and timestamp < since:
+            continue
+        if until is not None and timestamp >= until:
+            continue
+        if min_confidence is not None:
+            confidence = to_number(result.get('confidence'))
+            if confidence is None or confidence < min_confidence:
+                continue
+        if tag is not None and tag not in {
+                normalize_tag(t) for t in result.get('tags') or []}:
+            continue
+        cache_data.setdefault('cache_key', cache_key)
+        yield cache_data
+
+
+def detect_schema(cache_data):
+    """按结果结构判断展平方式: task-score 或 desc-tags"""
+    if cache_data and isinstance(cache_data['result'].get('dimensions'),
+                                 list):
+        return 'task-score'
+    return 'desc-tags'
+
+
+def flatten(cache_data, schema):
+    """把一条缓存展平为若干行"""
+    result = cache_data['result']
+    base = dict(cache_key=cache_data.get('cache_key'),
+                timestamp=to_number(cache_data.get('timestamp')),
+                confidence=to_number(result.get('confidence')))
+    if schema != 'task-score':
+        tags = result.get('tags')
+        return [dict(base, name=result.get('name'), desc=result.get('desc'),
+                     tags=';'.join(map(str, tags))
+                     if isinstance(tags, list) else tags)]
+    totals = result.get('total_score')
+    if not isinstance(totals, list) or len(totals) != 3:
+        totals = [None] * 3
+    base.update(table_title=result.get('table_title'),
+                total_self=to_number(totals[0]),
+                total_peer=to_number(totals[1]),
+                total_teacher=to_number(totals[2]))
+    rows = []
+    for dim in result.get('dimensions') or []:
+        if not isinstance(dim, dict):
+            continue
+        row = dict(base, dimension=dim.get('desc'),
+                   dimension_score=to_number(dim.get('score')))
+        points = [p for p in dim.get('points') or [] if isinstance(p, dict)]
+        for point in points:
+            rows.append(dict(
+                row, point=point.get('desc'),
+                point_score=to_number(point.get('score')),
+                self=to_number(point.get('self')),
+                peer=to_number(point.get('peer')),
+                teacher=to_number(point.get('teacher'))))
+        if not points:
+            rows.append(row)
+    return rows or [base]
+
+
+def iter_rows(entries):
+    """展平缓存条目，按第一条结果确定列，返回 (列名, 行生成器)"""
+    entries = iter(entries)
+    first = next(entries, None)
+    schema = detect_schema(first)
+    fields = TASK_SCORE_FIELDS if schema == 'task-score' \
+        else DESC_TAGS_FIELDS
+    if first is None:
+        return fields, iter(())
+    rows = (row for cache_data in itertools.chain([first], entries)
+            for row in flatten(cache_data, schema))
+    return fields, rows
+
+
+class ChunkSink(object):
+    """收集 Parquet 写出的字节，按块取走，供流式输出"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_export(entries, fmt='jsonl'):
+    """
+    把缓存条目转为导出格式，逐块生成字节:
+    - jsonl: 每行一条完整的缓存数据
+    - csv/parquet: 展平后的表格，评价表每个评分要点一行
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if fmt == 'jsonl':
+        lines, size = [], 0
+        for cache_data in entries:
+            line = (json.dumps(cache_data, ensure_ascii=False)
+                    + '\n').encode('utf-8')
+            lines.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield b''.join(lines)
+                lines, size = [], 0
+        yield b''.join(lines)
+        return
+    if fmt == 'parquet':
+        pa = import_pyarrow()
+    fields, rows = iter_rows(entries)
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields,
+                                extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() >= CHUNK_SIZE:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode('utf-8')
+        return
+    schema = pa.schema([
+        (name, pa.string() if name in STRING_FIELDS else pa.float64())
+        for name in fields])
+    sink = ChunkSink()
+    writer = pa.parquet.ParquetWriter(sink, schema)
+    try:
+        while True:
+            batch = list(itertools.islice(rows, PARQUET_ROWS))
+            if not batch:
+                break
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def gzip_chunks(chunks, level=6):
+    """以 gzip 格式逐块压缩"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def guess_format(path):
+    """按输出文件扩展名判断格式，忽略 .gz 后缀"""
+    root = path[:-3] if path.lower().endswith('.gz') else path
+    ext = os.path.splitext(root)[1].lower().lstrip('.')
+    return ext if ext in EXPORT_FORMATS else 'jsonl'
+
+
+def export_main(args):
+    """aimglyze export 子命令"""
+    from .storage import StorageContext
+    from .logger import setup_logging
+    if args.output == '-':
+        # 结果写到标准输出，日志改到标准错误
+        setup_logging(stream=sys.stderr)
+    fmt = args.format or guess_format(args.output)
+    try:
+        since, until = parse_time(args.since), parse_time(args.until)
+        if fmt == 'parquet':
+            import_pyarrow()
+    except (ValueError, ImportError) as e:
+        log.error("%s", e)
+        return 1
+    context = StorageContext(args.config)
+    try:
+        context.require_persistent()
+    except ValueError as e:
+        log.error("%s", e)
+        return 1
+    exported = dict(count=0)
+
+    def count(entries):
+        for cache_data in entries:
+            exported['count'] += 1
+            yield cache_data
+
+    entries = count(iter_cache_entries(
+        context, since, until, args.min_confidence, args.tag,
+        None if args.all_apps else context.owns_key))
+    chunks = iter_export(entries, fmt)
+    if args.gzip or args.output.lower().endswith('.gz'):
+        chunks = gzip_chunks(chunks)
+    if args.output == '-':
+        fp = sys.stdout.buffer
+    else:
+        fp = open(args.output, 'wb')
+    try:
+        for chunk in chunks:
+            fp.write(chunk)
+        fp.flush()
+    finally:
+        if fp is not sys.stdout.buffer:
+            fp.close()
+    log.info("已导出 %s 条结果 (%s)%s", exported['count'], fmt,
+             f": {args.output}" if args.output != '-' else '')
+    return 0
@@ -3,16 +3,31 @@
 # Copyright (c) 2025 shmilee
 
 import os
+import re
 import sys
+import json
+import time
+import queue
 import signal
+import secrets
 import subprocess
 import threading
+import urllib.request
 from pathlib import Path
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext, filedialog
 
 # 版本信息
 VERSION = "0.2.4"
+# 日志框刷新间隔（毫秒）与保留的最大行数
+LOG_POLL_INTERVAL = 100
+LOG_MAX_LINES = 5000
+# 管理接口令牌环境变量，与 aimglyze.admin.ADMIN_TOKEN_ENV 一致
+ADMIN_TOKEN_ENV = 'AIMGLYZE_ADMIN_TOKEN'
+# 停止服务器时等待排空的最长时间（秒），应大于服务器的 drain_timeout
+STOP_TIMEOUT = 40
+# 服务器启动日志中的地址
+SERVER_URL_PATTERN = re.compile(r'服务器启动在 (http://\S+)')
 
 
 class ApplicationGUI(object):
@@ -41,8 +56,14 @@ class ApplicationGUI(object):
         self.custom_config_path = tk.StringVar()
         # 服务器进程
         self.server_process = None
+        # 运行中服务器的地址与管理令牌，用于调用管理接口
+        self.server_url = None
+        self.admin_token = None
+        # 待显示的日志行，由后台线程写入，主线程批量插入文本框
+        self.log_queue = queue.SimpleQueue()
         # 初始化界面
         self.setup_ui()
+        self.root.after(LOG_POLL_INTERVAL, self.flush_log_queue)
 
     def get_icon_path(self):
         """获取图标路径"""
@@ -322,10 +343,26 @@ class ApplicationGUI(object):
             return app_alias
 
     def log_message(self, message):
-        """添加日志消息"""
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.update()
+        """添加日志消息（线程安全，延迟批量显示）"""
+        self.log_queue.put(message)
+
+    def flush_log_queue(self):
+        """将队列中的日志一次性插入文本框"""
+        lines = []
+        try:
+            while True:
+                lines.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if lines:
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            # 限制日志行数，避免文本框无限增长
+            line_count = int(self.log_text.index('end-1c').split('.')[0])
+            if line_count > LOG_MAX_LINES:
+                self.log_text.delete(
+                    1.0, f"{line_count - LOG_MAX_LINES + 1}.0")
+            self.log_text.see(tk.END)
+        self.root.after(LOG_POLL_INTERVAL, self.flush_log_queue)
 
     def clear_log(self):
         """清空日志"""
@@ -378,9 +415,13 @@ class ApplicationGUI(object):
             # 构建命令
             command = [sys.executable, "-u", "-X", "utf8", "-m",
                        "aimglyze.cli", "server", config_arg]
+            # 为本次启动生成管理令牌，清理操作通过管理接口完成
+            self.admin_token = secrets.token_urlsafe(16)
+            env = dict(os.environ, **{ADMIN_TOKEN_ENV: self.admin_token})
             # 启动子进程
             self.server_process = subprocess.Popen(
                 command,
+                env=env,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
                 text=True,
@@ -394,10 +435,15 @@ class ApplicationGUI(object):
             # 实时读取输出
             for line in iter(self.server_process.stdout.readline, ''):
                 if line:
-                    self.log_message(line.strip())
+                    self.log_message(line.rstrip())
+                    match = SERVER_URL_PATTERN.search(line)
+                    if match:
+                        self.server_url = match.group(1).replace(
+                            '://0.0.0.0:', '://127.0.0.1:')
             # 进程结束时
             return_code = self.server_process.wait()
             self.server_process = None
+            self.server_url = None
             # 在GUI线程中更新状态
             self.root.after(0, self.on_server_stopped, return_code)
         except Exception as e:
@@ -423,28 +469,36 @@ class ApplicationGUI(object):
         self.start_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
 
-    def stop_server(self):
-        """停止服务器"""
+    def stop_server(self, wait=False):
+        """
+        停止服务器：发送终止信号，服务器等待进行中的分析完成后退出，
+        超过 STOP_TIMEOUT 秒仍未退出时强制终止。
+        wait 为 False 时在后台等待，进程结束后由 on_server_stopped 更新状态。
+        """
         if self.server_process and self.server_process.poll() is None:
-            self.log_message("正在停止服务器...")
+            self.log_message("正在停止服务器（等待进行中的分析完成）...")
             self.update_service_status("停止中...", "orange")
-            # 发送终止信号
-            self.server_process.terminate()
-            # 等待进程结束（超时5秒）
-            try:
-                self.server_process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                # 强制终止
-                self.server_process.kill()
-                self.log_message("强制终止服务器进程")
-            self.log_message("服务器已停止")
-            self.update_service_status("已停止", "orange")
-            # 恢复按钮状态
-            self.start_button.config(state=tk.NORMAL)
             self.stop_button.config(state=tk.DISABLED)
+            # 发送终止信号
+            process = self.server_process
+            process.terminate()
+            if wait:
+                self.wait_server_exit(process)
+            else:
+                threading.Thread(target=self.wait_server_exit,
+                                 args=(process,), daemon=True).start()
         else:
             messagebox.showinfo("提示", "服务器未在运行")
 
+    def wait_server_exit(self, process):
+        """等待服务器进程结束，超时强制终止"""
+        try:
+            process.wait(timeout=STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            # 强制终止
+            process.kill()
+            self.log_message("强制终止服务器进程")
+
     def clean_cache(self):
         """清理缓存"""
         # 获取配置参数
@@ -454,11 +508,11 @@ class ApplicationGUI(object):
         self.log_message("清理缓存...")
         self.update_clean_status("清理中...", "yellow")
         # 在新线程中执行清理操作
-        thread = threading.Thread(
-            target=self.run_clean_command,
-            args=("clean-cache", config_arg),
-            daemon=True
-        )
+        if self.server_running():
+            target, args = self.run_admin_task, ("clean-cache", {})
+        else:
+            target, args = self.run_clean_command, ("clean-cache", config_arg)
+        thread = threading.Thread(target=target, args=args, daemon=True)
         thread.start()
 
     def clean_uploads(self):
@@ -477,11 +531,13 @@ class ApplicationGUI(object):
         self.log_message("清理上传文件...")
         self.update_clean_status("清理中...", "yellow")
         # 在新线程中执行清理操作
-        thread = threading.Thread(
-            target=self.run_clean_command,
-            args=("clean-uploads", config_arg),
-            daemon=True
-        )
+        if self.server_running():
+            target, args = self.run_admin_task, (
+                "clean-uploads", {"threshold": 0.5})
+        else:
+            target, args = self.run_clean_command, (
+                "clean-uploads", config_arg)
+        thread = threading.Thread(target=target, args=args, daemon=True)
         thread.start()
 
     def run_clean_command(self, command_type, config_arg):
@@ -507,6 +563,45 @@ class ApplicationGUI(object):
         except Exception as e:
             self.root.after(0, self.on_clean_error, command_type, str(e))
 
+    def server_running(self):
+        """服务器是否由本界面启动并在运行"""
+        return bool(self.server_process and self.server_process.poll() is None
+                    and self.server_url and self.admin_token)
+
+    def admin_request(self, path, data=None):
+        """调用运行中服务器的管理接口"""
+        request = urllib.request.Request(
+            self.server_url + path,
+            data=json.dumps(data).encode('utf-8') if data is not None else None,
+            headers={'Authorization': f'Bearer {self.admin_token}',
+                     'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def run_admin_task(self, kind, params):
+        """通过管理接口执行清理，服务器内存中的缓存映射同步更新"""
+        try:
+            task = self.admin_request(
+                '/api/admin/tasks', {'kind': kind, 'params': params})
+            self.log_message(f"已提交维护任务 {kind} [{task['id']}]")
+            while task['status'] in ('queued', 'running'):
+                time.sleep(0.5)
+                task = self.admin_request(f"/api/admin/tasks/{task['id']}")
+                if task['total']:
+                    self.root.after(0, self.update_clean_status,
+                                    f"清理中 {task['progress']:.0%}", "yellow")
+            if task['status'] == 'done':
+                self.root.after(0, self.on_admin_task_completed, task)
+            else:
+                self.root.after(0, self.on_clean_error, kind, task['error'])
+        except Exception as e:
+            self.root.after(0, self.on_clean_error, kind, str(e))
+
+    def on_admin_task_completed(self, task):
+        """管理任务完成时的回调"""
+        self.log_message(f"{task['kind']} 完成: {task['result']}")
+        self.update_clean_status("清理完成", "green")
+
     def on_clean_completed(self, command_type, result):
         """清理完成时的回调"""
         if result.returncode == 0:
@@ -540,7 +635,7 @@ def main():
                 )
                 if response:
                     # 停止服务器
-                    app.stop_server()
+                    app.stop_server(wait=True)
                     root.destroy()
             else:
                 root.destroy()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import re
+import sys
+import html
+import time
+import signal
+import threading
+import contextlib
+import logging
+from urllib.parse import urlparse
+
+from .logger import setup_logging
+from .storage import StorageContext
+from .server import (AnalysisServer, RequestHandler, make_http_server,
+                     serve)
+
+log = logging.getLogger(__name__)
+
+# 挂载路径: 以 / 开头、不以 / 结尾的一级或多级路径，不能以 /api 开头
+PREFIX_RE = re.compile(r'^(/[0-9A-Za-z_.-]+)+$')
+
+
+class AppHost(object):
+    """
+    一个进程中按路径前缀挂载多个应用，mounts 为 [(前缀, 配置文件), ...]。
+    每个应用保留自己的分析器设置、缓存与前端，共用:
+    - 监听端口与请求线程 (多进程模式下为同一组工作进程)
+    - 服务商客户端及其连接池 (相同服务商与 API_KEY，见 analyzer.shared_client)
+    - 上传文件目录，按图片哈希保存，取第一个启用上传保存的应用的目录
+    - 访问日志与健康检查统计
+    服务器与日志配置 (host、port、threaded、drain_timeout 等) 取自第一个应用
+    """
+
+    def __init__(self, mounts, worker_id=None):
+        self.apps = {}
+        for prefix, config_path in mounts:
+            if not PREFIX_RE.match(prefix) or prefix.split('/')[1] == 'api':
+                raise ValueError(f"无效的挂载路径: {prefix}")
+            if prefix in self.apps:
+                raise ValueError(f"挂载路径重复: {prefix}")
+            log.info("挂载应用: %s/ -> %s", prefix, config_path)
+            self.apps[prefix] = AnalysisServer(config_path, worker_id)
+        if not self.apps:
+            raise ValueError("没有挂载任何应用")
+        self.worker_id = worker_id
+        self.config = next(iter(self.apps.values())).config
+        self.share_uploads()
+        self._draining = False
+        self.inflight = 0
+        self.inflight_cond = threading.Condition()
+
+    def share_uploads(self):
+        """启用上传保存的应用共用一个上传目录与哈希映射"""
+        apps = [app for app in self.apps.values() if app.save_upload]
+        if len(apps) < 2:
+            return
+        store = apps[0]
+        for app in apps[1:]:
+            # 各应用原有的上传文件仍在原目录，映射中保留其路径
+            for file_hash, path in app.file_hash_map.items():
+                store.file_hash_map.setdefault(file_hash, path)
+            app.file_hash_map = store.file_hash_map
+            app.upload_dir = store.upload_dir
+        log.info("共用上传目录: %s", store.upload_dir)
+
+    @property
+    def draining(self):
+        return self._draining
+
+    @draining.setter
+    def draining(self, value):
+        self._draining = value
+        for app in self.apps.values():
+            app.draining = value
+
+    @contextlib.contextmanager
+    def tracking(self):
+        """记录进行中的请求，停止时等待其完成"""
+        with self.inflight_cond:
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self.inflight_cond:
+                self.inflight -= 1
+                self.inflight_cond.notify_all()
+
+    def drain(self, timeout):
+        """等待进行中的请求，再依次排空各应用，共用 timeout 秒"""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        with self.inflight_cond:
+            idle = self.inflight_cond.wait_for(
+                lambda: self.inflight == 0, timeout)
+        for app in self.apps.values():
+            idle = app.drain(max(0.0, deadline - time.monotonic())) and idle
+        return idle
+
+    def start_background(self, resume=True):
+        """按各应用的配置启动后台过期清理与任务恢复"""
+        for app in self.apps.values():
+            if app.config['cache']['sweep']:
+                app.start_sweeper()
+            if resume:
+                app.resume_jobs()
+
+    def reload_config(self):
+        """依次重新加载各应用的配置，返回是否都已重新加载"""
+        return all([app.reload_config() for app in self.apps.values()])
+
+    def watch_config(self):
+        for app in self.apps.values():
+            app.watch_config()
+
+    def get_cache_stats(self, detail=False):
+        """各应用的统计及其合计"""
+        apps = {prefix: app.get_cache_stats(detail)
+                for prefix, app in self.apps.items()}
+        total = {}
+        for stats in apps.values():
+            for name, value in stats.items():
+                if isinstance(value, int) and not isinstance(value, bool):
+                    total[name] = total.get(name, 0) + value
+        # 共用的上传目录只计一次
+        maps = {id(app.file_hash_map): app.file_hash_map
+                for app in self.apps.values() if app.save_upload}
+        total['upload_files_count'] = sum(map(len, maps.values()))
+        return dict(total, apps=apps)
+
+
+class HostRequestHandler(RequestHandler):
+    """按路径前缀把请求交给挂载的应用，前缀之外只提供应用列表与健康检查"""
+
+    def __init__(self, *args, **kwargs):
+        self.host = kwargs['server_instance']
+        super().__init__(*args, **kwargs)
+
+    def handle_one_request(self):
+        # 长连接上的每个请求重新按前缀选择应用
+        self.server_instance = self.host
+        super().handle_one_request()
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        parsed = urlparse(self.path)
+        for prefix, app in self.host.apps.items():
+            if parsed.path == prefix:
+                # 前端使用相对路径，需以 / 结尾
+                location = prefix + '/' + (f"?{parsed.query}"
+                                           if parsed.query else '')
+                self.send_response(301)
+                self.send_header('Location', location)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return False
+            if parsed.path.startswith(prefix + '/'):
+                self.mount = prefix
+                self.server_instance = app
+                self.path = self.path[len(prefix):]
+                break
+        return True
+
+    def do_GET(self):
+        if self.mount:
+            super().do_GET()
+            return
+        path = urlparse(self.path).path
+        if path == '/':
+            self.send_index()
+        elif path == '/api/health':
+            self.send_health_check()
+        elif path == '/favicon.ico':
+            self.server_instance = next(iter(self.host.apps.values()))
+            self.send_favicon()
+        else:
+            self.send_error(404, "Not Found")
+
+    def do_POST(self):
+        if self.mount:
+            super().do_POST()
+        else:
+            self.send_error(404, "Not Found")
+
+    def send_index(self):
+        """挂载的应用列表"""
+        items = ''.join(
+            f'<li><a href="{html.escape(prefix[1:])}/">'
+            f'{html.escape(app.config["frontend"]["title"])}</a> '
+            f'<code>{html.escape(prefix)}/</code></li>'
+            for prefix, app in self.host.apps.items())
+        content = ('<!DOCTYPE html><html><head><meta charset="utf-8">'
+                   '<title>aimglyze</title></head><body><h1>应用</h1>'
+                   f'<ul>{items}</ul></body></html>').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def run_host(mounts, workers=None):
+    """启动挂载多个应用的服务器，workers 默认为第一个应用的 server.workers"""
+    try:
+        context = StorageContext(mounts[0][1])
+        workers = workers or context.config['server']['workers']
+        if workers > 1 and not hasattr(os, 'fork'):
+            log.warning("当前平台不支持多进程模式，使用单进程")
+            workers = 1
+        if workers > 1:
+            from .prefork import run_prefork
+            setup_logging(**context.config['log'])
+            sys.exit(run_prefork(context, workers, mounts))
+        host = AppHost(mounts)
+        setup_logging(**host.config['log'])
+        host.start_background()
+        httpd = make_http_server(host, handler=HostRequestHandler)
+        address, port = httpd.server_address[:2]
+        for prefix in host.apps:
+            log.info("🌐 %s: http://%s:%s%s/", prefix, address, port, prefix)
+        log.info("⌨  按 Ctrl+C 停止服务器")
+        serve(host, httpd, (signal.SIGTERM, signal.SIGINT))
+        log.info("服务器已停止")
+        sys.exit(0)
+    except Exception as e:
+        log.exception("启动服务器失败: %s", e)
+        sys.exit(1)
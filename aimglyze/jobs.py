@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import time
+import sqlite3
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+# 任务状态
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    cache_key TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    mime_type TEXT,
+    image BLOB,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+
+class JobStore(object):
+    """
+    持久化的分析任务队列 (SQLite)，以图片哈希为任务 ID。
+
+    任务在调用服务商之前写入 (queued)，开始时累加尝试次数 (running)，
+    结果写入缓存后才确认完成 (done)，出错记为 failed。
+    服务器重启后，未完成的 queued/running 任务从保存的图片数据恢复。
+    完成或失败的任务不再保存图片数据。
+    """
+
+    def __init__(self, path, max_attempts=3):
+        self.path = str(path)
+        self.max_attempts = max(1, int(max_attempts))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False,
+                                    isolation_level=None)
+        # WAL 模式下进程崩溃不丢失已提交的任务
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def execute(self, sql, *args):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def enqueue(self, cache_key, image_data, mime_type):
+        now = time.time()
+        # 已完成的任务重新入队时重置尝试次数
+        self.execute(
+            "INSERT INTO jobs (cache_key, state, attempts, mime_type, image, "
+            "created, updated) VALUES (?, ?, 0, ?, ?, ?, ?) "
+            "ON CONFLICT (cache_key) DO UPDATE SET state = excluded.state, "
+            "attempts = CASE WHEN jobs.state = 'done' THEN 0 "
+            "ELSE jobs.attempts END, mime_type = excluded.mime_type, "
+            "image = excluded.image, error = NULL, updated = excluded.updated",
+            cache_key, QUEUED, mime_type, sqlite3.Binary(image_data),
+            now, now)
+
+    def start(self, cache_key):
+        self.execute(
+            "UPDATE jobs SET state = ?, attempts = attempts + 1, updated = ? "
+            "WHERE cache_key = ?", RUNNING, time.time(), cache_key)
+
+    def finish(self, cache_key):
+        """结果已写入缓存，确认完成"""
+        self.execute(
+            "UPDATE jobs SET state = ?, image = NULL, error = NULL, "
+            "updated = ? WHERE cache_key = ?", DONE, time.time(), cache_key)
+
+    def fail(self, cache_key, error):
+        self.execute(
+            "UPDATE jobs SET state = ?, image = NULL, error = ?, updated = ? "
+            "WHERE cache_key = ?", FAILED, str(error), time.time(), cache_key)
+
+    def pending(self):
+        """未完成的任务 [(cache_key, attempts), ...]，按创建时间排序"""
+        return self.execute(
+            "SELECT cache_key, attempts FROM jobs WHERE state IN (?, ?) "
+            "ORDER BY created", QUEUED, RUNNING)
+
+    def load(self, cache_key):
+        """读取任务保存的 (图片数据, mime_type)，不存在时返回 None"""
+        rows = self.execute(
+            "SELECT image, mime_type FROM jobs WHERE cache_key = ? "
+            "AND image IS NOT NULL", cache_key)
+        return (bytes(rows[0][0]), rows[0][1]) if rows else None
+
+    def prune(self, max_age):
+        """删除 max_age 秒之前结束的任务记录"""
+        with self.lock:
+            return self.conn.execute(
+                "DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?",
+                (DONE, FAILED, time.time() - max_age)).rowcount
+
+    def counts(self):
+        return dict(self.execute(
+            "SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
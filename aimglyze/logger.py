@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+ROOT_LOGGER = 'aimglyze'
+ACCESS_LOGGER = 'aimglyze.access'
+CONSOLE_FORMAT = '%(asctime)s %(levelname).1s %(message)s'
+CONSOLE_DATEFMT = '%H:%M:%S'
+
+# 当前的后台日志线程 {name: QueueListener}
+_listeners = {}
+
+
+class JSONFormatter(logging.Formatter):
+    """结构化访问日志，每条记录一行 JSON"""
+
+    def format(self, record):
+        data = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                  time.localtime(record.created)),
+        }
+        data.update(getattr(record, 'access', None)
+                    or {'message': record.getMessage()})
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _stop_listener(name):
+    listener = _listeners.pop(name, None)
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+def _attach_queue(logger, name, *handlers):
+    """
+    给 logger 挂上 QueueHandler，真正的输出由后台 QueueListener 线程完成，
+    请求线程只做入队，不会阻塞在终端或文件 I/O 上。
+    """
+    _stop_listener(name)
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+        h.close()
+    q = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    listener = logging.handlers.QueueListener(
+        q, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners[name] = listener
+
+
+def setup_logging(level='INFO', access_log=None,
+                  max_bytes=10 * 1024 * 1024, backup_count=5, stream=None,
+                  **kwargs):
+    """
+    配置 aimglyze 日志，可重复调用以更新配置。
+
+    - 控制台日志: 按 level 输出到 stream (默认 stdout)，经队列异步写出
+    - 访问日志: access_log 非空时，JSON 行写入滚动文件
+    """
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    logger.propagate = False
+    console = logging.StreamHandler(stream or sys.stdout)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT, CONSOLE_DATEFMT))
+    _attach_queue(logger, ROOT_LOGGER, console)
+
+    access = logging.getLogger(ACCESS_LOGGER)
+    access.setLevel(logging.INFO)
+    access.propagate = False
+    access.disabled = not access_log
+    if access_log:
+        handler = logging.handlers.RotatingFileHandler(
+            access_log, maxBytes=max_bytes, backupCount=backup_count,
+            encoding='utf-8')
+        handler.setFormatter(JSONFormatter())
+        _attach_queue(access, ACCESS_LOGGER, handler)
+    else:
+        _stop_listener(ACCESS_LOGGER)
+        for h in list(access.handlers):
+            access.removeHandler(h)
+    return logger
+
+
+def shutdown_logging():
+    """停止后台日志线程，写出队列中剩余的日志"""
+    for name in list(_listeners):
+        _stop_listener(name)
+
+
+atexit.register(shutdown_logging)
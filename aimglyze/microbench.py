@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import statistics
+import subprocess
+
+from .server import AnalysisServer, parse_multipart, encode_json
+from .bench import prepare_config, make_image, make_multipart
+
+log = logging.getLogger(__name__)
+
+# 默认的参数规模
+DEFAULT_IMAGE_SIZES = [100 * 1024, 1024 * 1024, 5 * 1024 * 1024,
+                       20 * 1024 * 1024]
+DEFAULT_CACHE_ENTRIES = [1000, 10000]
+ALL_CASES = ['multipart', 'file_hash', 'img_msg', 'cache_save', 'cache_load',
+             'scan_cache', 'scan_uploads', 'json_repair', 'send_json',
+             'import_cli']
+# 维护命令的导入路径，及其不应加载的重量级模块
+MAINTENANCE_IMPORTS = ['aimglyze.cli', 'aimglyze.storage']
+HEAVY_MODULES = ['openai', 'zai', 'google.genai', 'json_repair', 'yaml',
+                 'http.server', 'aimglyze.server', 'aimglyze.analyzer']
+# 维护命令导入耗时预算（毫秒）
+IMPORT_BUDGET_MS = 50
+
+
+def human_size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f"{n:g}{unit}" if unit == 'B' else f"{n:.3g}{unit}"
+        n /= 1024
+
+
+def get_version():
+    try:
+        from importlib.metadata import version
+        return version('aimglyze')
+    except Exception:
+        return None
+
+
+def timeit(func, repeat=5, min_time=0.1):
+    """
+    重复测量 func 的单次耗时（毫秒），每轮循环次数自动校准到 min_time 秒以上
+    """
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    number = max(1, int(min_time / first)) if first > 0 else 1000
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number * 1000)
+    return dict(number=number, repeat=repeat,
+                best_ms=round(min(samples), 6),
+                median_ms=round(statistics.median(samples), 6))
+
+
+def measure_import(modules=None, repeat=5):
+    """
+    在全新的子进程中测量导入耗时（毫秒，不含解释器启动），
+    并检查是否加载了重量级模块
+    """
+    modules = modules or MAINTENANCE_IMPORTS
+    code = (
+        "import sys, time, json\n"
+        "t = time.perf_counter()\n"
+        + "".join(f"import {m}\n" for m in modules)
+        + "ms = (time.perf_counter() - t) * 1000\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps(dict(ms=ms, heavy=heavy)))\n"
+    )
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [package_root, env.get('PYTHONPATH')]))
+    samples, heavy = [], []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], env=env,
+                             capture_output=True, text=True, check=True)
+        data = json.loads(out.stdout)
+        samples.append(data['ms'])
+        heavy = data['heavy']
+    return dict(number=1, repeat=repeat,
+                best_ms=round(min(samples), 6),
+                median_ms=round(statistics.median(samples), 6),
+                heavy_modules=heavy)
+
+
+def typical_outputs(sample_file):
+    """构造典型的服务商输出: 正常、带代码块、尾逗号、截断"""
+    with open(sample_file, 'r', encoding='utf-8') as f:
+        text = json.dumps(json.load(f), ensure_ascii=False, indent=2)
+    return dict(
+        clean=text,
+        fenced=f"```json\n{text}\n```",
+        trailing_comma=text.replace('\n}', ',\n}'),
+        truncated=text[:int(len(text) * 0.9)],
+    )
+
+
+class MicroBench(object):
+    """热点函数的微基准"""
+
+    def __init__(self, config_path, workdir, repeat=5, min_time=0.1):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.min_time = min_time
+        # 上传扫描需要开启上传保存
+        bench_config = prepare_config(
+            config_path, workdir, 'FakeAnalyzer', save_upload=True)
+        self.server = AnalysisServer(bench_config)
+        self.rng = random.Random(0)
+        sample_file = self.server.sample_file
+        if sample_file is not None:
+            with open(sample_file, 'r', encoding='utf-8') as f:
+                self.sample = json.load(f)
+            self.outputs = typical_outputs(sample_file)
+        else:
+            self.sample = self.server.analyzer.synthesize('0' * 40)
+            self.outputs = dict(clean=json.dumps(self.sample))
+
+    def measure(self, func):
+        return timeit(func, self.repeat, self.min_time)
+
+    def populate_cache(self, entries):
+        """填充 entries 个缓存文件"""
+        cache_dir = self.server.cache_dir
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        cache_dir.mkdir(parents=True)
+        text = json.dumps(dict(result=self.sample, timestamp=time.time(),
+                               cache_key=''), ensure_ascii=False)
+        for i in range(entries):
+            key = f"{i:040x}"
+            with open(cache_dir / f"{key}.json", 'w', encoding='utf-8') as f:
+                f.write(text)
+        self.server.scan_cache_files()
+
+    def populate_uploads(self, entries, size=1024):
+        """填充 entries 个以哈希命名的上传文件"""
+        upload_dir = self.server.upload_dir
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        upload_dir.mkdir(parents=True)
+        for i in range(entries):
+            data = i.to_bytes(8, 'big') + self.rng.randbytes(size - 8)
+            key = self.server.get_file_hash(data)
+            with open(upload_dir / f"{key}.png", 'wb') as f:
+                f.write(data)
+
+    def run(self, cases=None, image_sizes=None, cache_entries=None,
+            upload_entries=None):
+        cases = cases or ALL_CASES
+        image_sizes = image_sizes or DEFAULT_IMAGE_SIZES
+        cache_entries = cache_entries or DEFAULT_CACHE_ENTRIES
+        upload_entries = upload_entries or cache_entries
+        server = self.server
+        results = {}
+
+        def record(name, stats, nbytes=None):
+            if nbytes:
+                stats['mb_per_s'] = round(
+                    nbytes / 1024 / 1024 / (stats['median_ms'] / 1000), 2)
+            results[name] = stats
+            log.info("%-32s median %12.4f ms%s", name, stats['median_ms'],
+                     f"  {stats['mb_per_s']:>10.1f} MB/s" if nbytes else '')
+
+        for size in image_sizes:
+            if not {'multipart', 'file_hash', 'img_msg'} & set(cases):
+                break
+            image_data = make_image(self.rng, size)
+            tag = human_size(size)
+            if 'multipart' in cases:
+                body, content_type = make_multipart(image_data)
+                record(f"multipart[{tag}]", self.measure(
+                    lambda: parse_multipart(content_type, body)), size)
+            if 'file_hash' in cases:
+                record(f"file_hash[{tag}]", self.measure(
+                    lambda: server.get_file_hash(image_data)), size)
+            if 'img_msg' in cases:
+                record(f"img_msg[{tag}]", self.measure(
+                    lambda: server.analyzer._create_img_msg(
+                        image_data, 'image/png')), size)
+
+        for entries in cache_entries:
+            if not {'cache_save', 'cache_load', 'scan_cache'} & set(cases):
+                break
+            self.populate_cache(entries)
+            key = f"{entries // 2:040x}"
+            if 'cache_save' in cases:
+                record(f"cache_save[{entries}]", self.measure(
+                    lambda: server.save_to_cache(key, self.sample)))
+            if 'cache_load' in cases:
+                record(f"cache_load[{entries}]", self.measure(
+                    lambda: server.load_from_cache(key)))
+            if 'scan_cache' in cases:
+                record(f"scan_cache[{entries}]", timeit(
+                    server.scan_cache_files, self.repeat, 0))
+
+        if 'scan_uploads' in cases:
+            for entries in upload_entries:
+                self.populate_uploads(entries)
+                record(f"scan_uploads[{entries}]", timeit(
+                    server.scan_existing_files, self.repeat, 0))
+
+        if 'json_repair' in cases:
+            import json_repair
+            for name, text in self.outputs.items():
+                record(f"json_repair[{name}]", self.measure(
+                    lambda: json_repair.repair_json(
+                        text, return_objects=True, ensure_ascii=False)),
+                    len(text.encode('utf-8')))
+
+        if 'send_json' in cases:
+            data = {'result': self.sample, 'cache_key': '0' * 40}
+            record("send_json[result]", self.measure(
+                lambda: encode_json(data)), len(encode_json(data)))
+
+        if 'import_cli' in cases:
+            record("import_cli", measure_import(repeat=self.repeat))
+        return results
+
+
+def parse_sizes(text):
+    """解析大小列表，如 '100K,1M,20M'"""
+    units = dict(K=1024, M=1024 * 1024, G=1024 ** 3)
+    sizes = []
+    for item in text.split(','):
+        item = item.strip().upper().rstrip('B')
+        if not item:
+            continue
+        if item[-1] in units:
+            sizes.append(int(float(item[:-1]) * units[item[-1]]))
+        else:
+            sizes.append(int(item))
+    return sizes
+
+
+def microbench_main(args):
+    """aimglyze microbench 子命令"""
+    if not args.verbose:
+        for name in ('aimglyze.server', 'aimglyze.storage',
+                     'aimglyze.analyzer'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='aimglyze-microbench-')
+    try:
+        bench = MicroBench(args.config, workdir, args.repeat, args.min_time)
+        results = bench.run(
+            cases=args.cases.split(',') if args.cases else None,
+            image_sizes=parse_sizes(args.sizes) if args.sizes else None,
+            cache_entries=parse_sizes(args.entries) if args.entries else None,
+            upload_entries=(parse_sizes(args.upload_entries)
+                            if args.upload_entries else None))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    code = 0
+    if 'import_cli' in results:
+        # 导入耗时预算检查
+        stats = results['import_cli']
+        budget = args.import_budget
+        if stats['heavy_modules']:
+            log.error("维护命令导入了重量级模块: %s", stats['heavy_modules'])
+            code = 1
+        if budget and stats['best_ms'] > budget:
+            log.error("维护命令导入耗时 %.1fms 超出预算 %sms", stats['best_ms'], budget)
+            code = 1
+    record = dict(
+        timestamp=time.time(),
+        label=args.label,
+        version=get_version(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        results=results,
+    )
+    if args.history:
+        # 与历史记录中的上一次结果比较
+        previous = None
+        if os.path.exists(args.history):
+            with open(args.history, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        previous = json.loads(line)
+        if previous:
+            for name, stats in results.items():
+                old = previous['results'].get(name)
+                if old and old.get('median_ms'):
+                    change = stats['median_ms'] / old['median_ms'] - 1
+                    log.info("%-32s %+.1f%% vs %s",
+                             name, change * 100, previous.get('label') or previous.get('version'))
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        log.info("结果已追加到历史文件: %s", args.history)
+    else:
+        print(json.dumps(record, ensure_ascii=False, indent=2))
+    return code
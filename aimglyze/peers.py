@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import json
+import time
+import bisect
+import hashlib
+import logging
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+log = logging.getLogger(__name__)
+
+# 每个节点在哈希环上的虚拟节点数，使键在节点间分布均匀
+VNODES = 64
+# 所有者节点后台拉取结果的超时，单位秒
+REPLICATE_TIMEOUT = 5.0
+
+
+def ring_hash(text):
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8], 'big')
+
+
+def normalize_url(url):
+    """节点地址统一为 scheme://host:port[/prefix]，不带结尾的 /"""
+    url = str(url).strip().rstrip('/')
+    if '://' not in url:
+        url = f"http://{url}"
+    return url
+
+
+class HashRing(object):
+    """一致性哈希环: 增删节点时只有相邻区间的键改变所有者"""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        self.nodes = list(dict.fromkeys(nodes))
+        self.points = sorted((ring_hash(f"{node}#{i}"), node)
+                             for node in self.nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in self.points]
+
+    def owners(self, key, count):
+        """从键的位置顺时针取 count 个不同节点，第一个为所有者"""
+        count = min(count, len(self.nodes))
+        idx = bisect.bisect(self.hashes, ring_hash(key))
+        owners = []
+        while len(owners) < count:
+            node = self.points[idx % len(self.points)][1]
+            if node not in owners:
+                owners.append(node)
+            idx += 1
+        return owners
+
+
+class PeerCache(object):
+    """
+    对等节点缓存层: 本地未命中时，向键在哈希环上的所有者及其后继
+    (共 fanout 个节点，不含本节点) 并行请求 /api/results/<cache_key>，
+    在 timeout 秒内取第一个有效结果。
+    所有节点应配置相同的 peers 列表 (含自身)，使同一键的所有者一致；
+    self_url 为本节点在列表中的地址。设置 self_url 后，本节点分析出
+    不属于自己的键时，通知所有者从本节点拉取结果，使每个键都存放在所有者上。
+    """
+
+    def __init__(self, peers, self_url='', timeout=0.5, fanout=2,
+                 count=None):
+        self.self_url = normalize_url(self_url) if self_url else None
+        nodes = [normalize_url(peer) for peer in peers]
+        if self.self_url and self.self_url not in nodes:
+            nodes.append(self.self_url)
+        self.ring = HashRing(nodes)
+        self.timeout = float(timeout)
+        self.fanout = max(1, int(fanout))
+        self.count = count or (lambda name: None)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(4, 2 * len(nodes)),
+            thread_name_prefix='aimglyze-peer')
+
+    def candidates(self, cache_key):
+        """需要查询的节点"""
+        return [node for node in self.ring.owners(cache_key, self.fanout)
+                if node != self.self_url]
+
+    def owner(self, cache_key):
+        return self.ring.owners(cache_key, 1)[0]
+
+    def request(self, peer, method, path, timeout, body=None):
+        """向节点发送请求，返回 (状态码, 响应体)"""
+        parts = urlsplit(peer)
+        connection_class = http.client.HTTPSConnection \
+            if parts.scheme == 'https' else http.client.HTTPConnection
+        conn = connection_class(parts.netloc, timeout=timeout)
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            conn.request(method, f"{parts.path}{path}", body, headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def fetch(self, peer, cache_key, timeout):
+        """向一个节点请求缓存结果，未命中返回 None"""
+        status, body = self.request(
+            peer, 'GET', f"/api/results/{cache_key}", timeout)
+        if status == 404:
+            return None
+        if status != 200:
+            raise ValueError(f"HTTP {status}")
+        data = json.loads(body)
+        if not isinstance(data, dict) or data.get('cache_key') != cache_key \
+                or 'result' not in data:
+            raise ValueError("invalid result")
+        return data
+
+    def lookup(self, cache_key, max_age, timeout=None):
+        """
+        并行查询各节点，返回 (节点, 缓存数据)；
+        都未命中、结果已过期或超时返回 (None, None)。
+        timeout 为调用方剩余的时间，取与配置中较小的一个
+        """
+        peers = self.candidates(cache_key)
+        if not peers:
+            return None, None
+        if timeout is not None:
+            timeout = min(self.timeout, timeout)
+        else:
+            timeout = self.timeout
+        futures = {self.executor.submit(self.fetch, peer, cache_key, timeout):
+                   peer for peer in peers}
+        deadline = time.monotonic() + timeout
+        pending = set(futures)
+        while pending:
+            done, pending = wait(
+                pending, timeout=max(0.0, deadline - time.monotonic()),
+                return_when=FIRST_COMPLETED)
+            if not done:
+                # 超时，未完成的请求由各自的套接字超时结束
+                log.debug("对等节点查询超时: %s", cache_key)
+                self.count('peer_errors')
+                break
+            for future in done:
+                peer = futures[future]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    log.debug("对等节点查询失败: %s, %s", peer, e)
+                    self.count('peer_errors')
+                    continue
+                if data is None:
+                    continue
+                try:
+                    age = time.time() - float(data.get('timestamp'))
+                except (TypeError, ValueError):
+                    continue
+                if age < max_age:
+                    return peer, data
+        return None, None
+
+    def notify(self, cache_key):
+        """本节点分析出不属于自己的键后，后台通知所有者来拉取结果"""
+        if not self.self_url:
+            return
+        owner = self.owner(cache_key)
+        if owner != self.self_url:
+            self.executor.submit(self._notify, owner, cache_key)
+
+    def _notify(self, owner, cache_key):
+        try:
+            status, _ = self.request(
+                owner, 'POST', '/api/peers/replicate', self.timeout,
+                dict(cache_key=cache_key, source=self.self_url))
+            if status != 202:
+                raise ValueError(f"HTTP {status}")
+        except Exception as e:
+            log.debug("通知所有者节点失败: %s, %s", owner, e)
+            self.count('peer_errors')
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import threading
+import logging
+from io import BytesIO
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+
+def dhash(image_data, hash_size=8):
+    """
+    差值哈希 (dHash): 缩放为 (hash_size+1)×hash_size 的灰度图，
+    比较相邻像素的明暗，返回 hash_size² 位整数。
+    重新压缩、缩放后的同一张图片哈希相同或只差几位。
+    Pillow 未安装或图片无法解码时返回 None。
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    try:
+        with Image.open(BytesIO(image_data)) as img:
+            # JPEG 直接按缩小尺寸解码，大图也很快
+            img.draft('L', (hash_size * 16, hash_size * 16))
+            img = ImageOps.exif_transpose(img).convert('L').resize(
+                (hash_size + 1, hash_size), Image.LANCZOS)
+            pixels = list(img.getdata())
+    except Exception as e:
+        log.debug("计算感知哈希失败: %s", e)
+        return None
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] >
+                                    pixels[offset + col + 1])
+    return value
+
+
+class PHashIndex(object):
+    """
+    感知哈希的多索引 Hamming 查找。
+
+    64 位哈希切分为 max_distance+1 段，由抽屉原理，距离不超过
+    max_distance 的两个哈希至少有一段完全相同，所以只需比较
+    在某一段上相同的候选，百万条目时每次查找也只比较几百个候选。
+
+    索引持久化为追加写入的文本文件，每行 "<16进制哈希> <cache_key>"，
+    删除记为 "- <cache_key>"，加载时无效行过多则压缩重写。
+    多进程共享 (shared) 时不压缩，由 sync 读取其他进程追加的行。
+    """
+
+    def __init__(self, path, max_distance=4):
+        self.path = Path(path)
+        self.max_distance = max(0, min(int(max_distance), HASH_BITS - 1))
+        # 各段的 (位移, 掩码)
+        count = self.max_distance + 1
+        self.segments = []
+        shift = 0
+        for i in range(count):
+            bits = HASH_BITS // count + (i < HASH_BITS % count)
+            self.segments.append((shift, (1 << bits) - 1))
+            shift += bits
+        # 每段一张表 {段值: [cache_key, ...]}，列表比集合省内存
+        self.tables = [{} for _ in self.segments]
+        # {cache_key: 哈希}
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.fp = None
+        # 已读取到的文件位置
+        self.offset = 0
+        self.shared = False
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _insert(self, cache_key, value):
+        self._delete(cache_key)
+        self.hashes[cache_key] = value
+        for table, (shift, mask) in zip(self.tables, self.segments):
+            table.setdefault((value >> shift) & mask, []).append(cache_key)
+
+    def _delete(self, cache_key):
+        value = self.hashes.pop(cache_key, None)
+        if value is None:
+            return False
+        for table, (shift, mask) in zip(self.tables, self.segments):
+            part = (value >> shift) & mask
+            keys = table.get(part)
+            if keys is not None and cache_key in keys:
+                keys.remove(cache_key)
+                if not keys:
+                    del table[part]
+        return True
+
+    def _write(self, line):
+        if self.fp is None:
+            self.fp = open(self.path, 'a', encoding='utf-8')
+        self.fp.write(line + '\n')
+        self.fp.flush()
+
+    def _apply(self, line):
+        parts = line.split()
+        if len(parts) != 2:
+            return
+        if parts[0] == '-':
+            self._delete(parts[1])
+            return
+        try:
+            self._insert(parts[1], int(parts[0], 16))
+        except ValueError:
+            pass
+
+    def load(self):
+        """从索引文件加载，返回条目数"""
+        lines = 0
+        with self.lock:
+            if self.path.exists():
+                with open(self.path, 'rb') as f:
+                    for line in f:
+                        lines += 1
+                        self._apply(line.decode('utf-8', 'replace'))
+                    self.offset = f.tell()
+            if not self.shared and lines > 2 * len(self.hashes) + 1000:
+                self._compact()
+        log.info("感知哈希索引: %s 条", len(self.hashes))
+        return len(self.hashes)
+
+    def sync(self):
+        """读取其他进程追加到索引文件的完整行，返回读取的行数"""
+        with self.lock:
+            try:
+                size = self.path.stat().st_size
+            except FileNotFoundError:
+                return 0
+            if size <= self.offset:
+                return 0
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(size - self.offset)
+            end = data.rfind(b'\n') + 1
+            self.offset += end
+            lines = data[:end].decode('utf-8', 'replace').splitlines()
+            # 本进程写入的行会再读到一次，重复应用不影响结果
+            for line in lines:
+                self._apply(line)
+            return len(lines)
+
+    def _compact(self):
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for cache_key, value in self.hashes.items():
+                f.write(f"{value:016x} {cache_key}\n")
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        os.replace(tmp_path, self.path)
+        self.offset = self.path.stat().st_size
+
+    def compact(self):
+        """
+        重写索引文件，去掉已删除和被覆盖的行。
+        多进程共享时其他进程仍在追加旧文件，不压缩，返回 False
+        """
+        with self.lock:
+            if self.shared:
+                return False
+            self._compact()
+            return True
+
+    def add(self, cache_key, value):
+        with self.lock:
+            if self.hashes.get(cache_key) == value:
+                return
+            self._insert(cache_key, value)
+            self._write(f"{value:016x} {cache_key}")
+
+    def remove(self, cache_key):
+        with self.lock:
+            if self._delete(cache_key):
+                self._write(f"- {cache_key}")
+
+    def query(self, value, max_distance=None):
+        """
+        查找距离不超过 max_distance 的条目，
+        返回按距离排序的 [(cache_key, distance), ...]
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        matches, seen = {}, set()
+        with self.lock:
+            for table, (shift, mask) in zip(self.tables, self.segments):
+                for cache_key in table.get((value >> shift) & mask, ()):
+                    if cache_key in seen:
+                        continue
+                    seen.add(cache_key)
+                    distance = (self.hashes[cache_key] ^ value).bit_count()
+                    if distance <= max_distance:
+                        matches[cache_key] = distance
+        return sorted(matches.items(), key=lambda item: item[1])
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import time
+import signal
+import socket
+import threading
+import contextlib
+import logging
+from pathlib import Path
+
+from .analyzer import check_limits
+from .logger import setup_logging, shutdown_logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# 变更日志超过此大小时由主工作进程截断
+EVENTS_MAX_SIZE = 1024 * 1024
+# 等待键锁时的轮询间隔（秒）
+KEY_LOCK_POLL = 0.1
+# 工作进程启动后在此时间内异常退出，视为无法启动，不再重启
+MIN_UPTIME = 5.0
+
+
+class CacheEvents(object):
+    """
+    多进程共享的缓存变更日志，每行 "<pid> <+|-> <cache_key>"，
+    + 为写入缓存，- 为删除缓存。各进程定期读取其他进程追加的行，
+    使本进程的内存缓存和文件映射失效。
+    日志以追加方式写入，每行一次 write，多进程同时写入不会交错。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.fp = open(self.path, 'a', encoding='utf-8')
+        # 只关心启动之后的变更，之前的已由启动时扫描得到
+        self.offset = os.path.getsize(self.path)
+
+    def publish(self, op, cache_key):
+        with self.lock:
+            self.fp.write(f"{self.pid} {op} {cache_key}\n")
+            self.fp.flush()
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def poll(self):
+        """
+        读取其他进程追加的完整行，返回 [(op, cache_key), ...]。
+        日志已被截断、可能漏掉变更时返回 None，调用方应清空内存缓存
+        """
+        size = self.size()
+        if size < self.offset:
+            self.offset = size
+            return None
+        if size == self.offset:
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        pid, events = str(self.pid), []
+        for line in data[:end].decode('utf-8', 'replace').splitlines():
+            parts = line.split()
+            if len(parts) == 3 and parts[0] != pid and parts[1] in ('+', '-'):
+                events.append((parts[1], parts[2]))
+        return events
+
+    def truncate(self):
+        """清空日志，其他进程下次读取时清空各自的内存缓存"""
+        with self.lock:
+            os.truncate(self.path, 0)
+            self.offset = 0
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+class KeyLocks(object):
+    """
+    跨进程的进行中缓存键锁: 每个键一个锁文件 (flock)，
+    同一图片同时只有一个进程（线程）调用服务商，
+    其他请求等待锁释放后直接读取刚写入的缓存。
+    """
+
+    def __init__(self, directory):
+        if fcntl is None:
+            raise RuntimeError("当前平台不支持文件锁")
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+    def acquire(self, path):
+        """取得锁文件的排他锁，返回文件描述符与是否等待过"""
+        waited = False
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        waited = True
+                        # 等待期间同样遵守请求截止时间与客户端断开
+                        check_limits()
+                        time.sleep(KEY_LOCK_POLL)
+                # 上一个持有者释放前已删除锁文件时，重新打开
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd, waited
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def hold(self, cache_key):
+        """持有键锁，返回是否等待过其他持有者"""
+        path = self.dir / f"{cache_key}.lock"
+        fd, waited = self.acquire(path)
+        try:
+            yield waited
+        finally:
+            # 持有锁时删除，锁文件不会积累
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            os.close(fd)
+
+
+def worker_log_config(log_config, worker_id):
+    """每个工作进程写各自的访问日志，避免多进程同时滚动同一文件"""
+    access_log = log_config['access_log']
+    if not access_log:
+        return log_config
+    root, ext = os.path.splitext(access_log)
+    return dict(log_config, access_log=f"{root}.{worker_id}{ext}")
+
+
+def serve_worker(config_path, sock, worker_id, log_config, resume,
+                 mounts=None):
+    """
+    工作进程: 在共享的监听套接字上处理请求，
+    mounts 不为 None 时按路径前缀挂载多个应用，见 hosting.AppHost
+    """
+    from .server import AnalysisServer, make_http_server, serve
+    # 停止信号由主进程转发为 SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, 'SIGHUP'):
+        # 由 serve 安装重新加载配置的处理函数，之前忽略
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    setup_logging(**worker_log_config(log_config, worker_id))
+    if mounts is not None:
+        from .hosting import AppHost, HostRequestHandler
+        server = AppHost(mounts, worker_id=worker_id)
+        handler = HostRequestHandler
+        apps = list(server.apps.values())
+    else:
+        from .server import RequestHandler as handler
+        server = AnalysisServer(config_path, worker_id=worker_id)
+        apps = [server]
+    # 后台清理与任务恢复只在 0 号工作进程中运行
+    if worker_id == 0:
+        for app in apps:
+            if app.config['cache']['sweep']:
+                app.start_sweeper()
+            if resume:
+                app.resume_jobs()
+    httpd = make_http_server(server, sock, handler)
+    log.info("工作进程 %s 已启动 (pid %s)", worker_id, os.getpid())
+    serve(server, httpd, (signal.SIGTERM,))
+    return 0
+
+
+def run_prefork(context, workers, mounts=None):
+    """
+    预先 fork 的多进程服务器: 主进程监听端口后 fork 出 workers 个
+    工作进程，共享同一个监听套接字，由内核分配连接。
+    主进程只负责重启异常退出的工作进程，并把停止信号转发给工作进程。
+    mounts 为挂载的多个应用 [(前缀, 配置文件), ...]，context 为第一个应用。
+    返回退出码。
+    """
+    config = context.config
+    server_config = config['server']
+    contexts = [context] if mounts is None else \
+        [context] + [type(context)(path) for _, path in mounts[1:]]
+    for ctx in contexts:
+        if ctx.config['cache']['phash']:
+            # 共享索引运行时不压缩，启动前先压缩一次
+            from .phash import PHashIndex
+            index = PHashIndex(ctx.cache_dir / 'phash.idx',
+                               ctx.config['cache']['phash_distance'])
+            index.load()
+            index.close()
+    sock = socket.create_server(
+        (server_config['host'], server_config['port']), backlog=128)
+    host, port = sock.getsockname()[:2]
+    children = {}  # {pid: (worker_id, 启动时间)}
+    state = dict(stopping=False, failed=False)
+
+    def spawn(worker_id, resume=False):
+        # 后台日志线程不能跨 fork，fork 前停止，之后重新启动
+        shutdown_logging()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = serve_worker(context.config_path, sock, worker_id,
+                                    config['log'], resume, mounts)
+            except BaseException:
+                log.exception("工作进程 %s 出错", worker_id)
+            finally:
+                shutdown_logging()
+                os._exit(code)
+        setup_logging(**config['log'])
+        children[pid] = (worker_id, time.monotonic())
+
+    def on_signal(signum, frame):
+        if state['stopping']:
+            log.warning("再次收到停止信号，工作进程立即退出")
+        else:
+            log.info("收到 %s，等待 %s 个工作进程停止...", signal.Signals(signum).name, len(children))
+        state['stopping'] = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def on_reload(signum, frame):
+        log.info("收到 SIGHUP，通知工作进程重新加载配置")
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    for i in range(workers):
+        spawn(i, resume=True)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, on_signal)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, on_reload)
+    log.info("🌐 服务器启动在 http://%s:%s", host, port)
+    log.info("👷 %s 个工作进程 (主进程 pid %s)", workers, os.getpid())
+    log.info("⌨  按 Ctrl+C 停止服务器")
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        worker_id, started = children.pop(pid)
+        code = os.waitstatus_to_exitcode(status)
+        if state['stopping']:
+            continue
+        log.warning("工作进程 %s (pid %s) 退出，退出码 %s", worker_id, pid, code)
+        if code != 0 and time.monotonic() - started < MIN_UPTIME:
+            log.error("工作进程 %s 无法启动，停止服务器", worker_id)
+            state['failed'] = True
+            on_signal(signal.SIGTERM, None)
+            continue
+        spawn(worker_id)
+    sock.close()
+    log.info("服务器已停止")
+    return 1 if state['failed'] else 0
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import re
+import json
+import sqlite3
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+# 每页最多返回的结果数
+MAX_PAGE_SIZE = 100
+# 中日韩文字: 假名、CJK 统一表意文字（含扩展 A、兼容）、谚文
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN_RE = re.compile(rf'([{CJK}]+)|([^\W{CJK}]+)')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    cache_key TEXT NOT NULL UNIQUE,
+    name TEXT,
+    tags TEXT,
+    timestamp REAL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    PRIMARY KEY (tag, doc)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tag_counts (
+    tag TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS text USING fts5(name, desc);
+CREATE VIRTUAL TABLE IF NOT EXISTS text_vocab USING fts5vocab(text, 'row');
+"""
+
+
+def tokenize(text):
+    """
+    切分为检索词: 拉丁字母与数字按词切分并转为小写，
+    中日韩文字没有空格分词，按相邻两字切分 (bigram)，单字保留
+    """
+    tokens = []
+    for cjk, word in TOKEN_RE.findall(str(text or '').lower()):
+        if word:
+            tokens.append(word)
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return tokens
+
+
+def match_query(text, prefix=False):
+    """
+    把查询文本转换为 FTS5 查询: 每个词（中文按相邻两字组成短语）都要匹配，
+    prefix 为 True 时最后一个词按前缀匹配。
+    返回 (查询, 可用于估计结果数的完整检索词)
+    """
+    terms, exact = [], []
+    for cjk, word in TOKEN_RE.findall(str(text or '').lower()):
+        if word:
+            terms.append(f'"{word}"')
+            exact.append([word])
+        elif len(cjk) == 1:
+            # 单字只能匹配以它开头的两字组合
+            terms.append(f'"{cjk}" OR "{cjk}"*')
+        else:
+            grams = [cjk[i:i + 2] for i in range(len(cjk) - 1)]
+            terms.append('"' + ' '.join(grams) + '"')
+            exact.append(grams)
+    if terms and prefix and terms[-1].endswith('"'):
+        terms[-1] += '*'
+        if exact:
+            exact[-1] = exact[-1][:-1]
+    return (' AND '.join(f'({t})' for t in terms),
+            [t for grams in exact for t in grams])
+
+
+def normalize_tag(tag):
+    return str(tag).strip().lower()
+
+
+class SearchIndex(object):
+    """
+    缓存结果 (name, desc, tags) 的持久化倒排索引 (SQLite)。
+
+    - tags 表以 (标签, 文档) 为主键，标签的 AND/OR 与前缀查询
+      只读取相应标签的倒排列表；
+    - name/desc 切分后写入 FTS5 全文索引；
+    - 随缓存的写入与删除增量更新，查询不扫描缓存目录。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def execute(self, sql, *args):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def __len__(self):
+        return self.execute("SELECT COUNT(*) FROM docs")[0][0]
+
+    @staticmethod
+    def extract(result):
+        """取出可索引的字段，不含 name/desc/tags 的结果返回 None"""
+        if not isinstance(result, dict):
+            return None
+        tags = result.get('tags')
+        tags = [str(t) for t in tags if str(t).strip()] \
+            if isinstance(tags, list) else []
+        name, desc = result.get('name'), result.get('desc')
+        if not (tags or isinstance(name, str) or isinstance(desc, str)):
+            return None
+        return (name if isinstance(name, str) else '',
+                desc if isinstance(desc, str) else '', tags)
+
+    def _remove(self, cache_key):
+        row = self.conn.execute("SELECT id, tags FROM docs WHERE cache_key = ?",
+                                (cache_key,)).fetchone()
+        if row is None:
+            return False
+        doc, tags = row
+        tags = {normalize_tag(t) for t in json.loads(tags or '[]')}
+        self.conn.executemany("DELETE FROM tags WHERE tag = ? AND doc = ?",
+                              [(t, doc) for t in tags])
+        self.conn.executemany(
+            "UPDATE tag_counts SET n = n - 1 WHERE tag = ?",
+            [(t,) for t in tags])
+        self.conn.execute("DELETE FROM text WHERE rowid = ?", (doc,))
+        self.conn.execute("DELETE FROM docs WHERE id = ?", (doc,))
+        return True
+
+    def _add(self, cache_key, fields, timestamp):
+        name, desc, tags = fields
+        self._remove(cache_key)
+        doc = self.conn.execute(
+            "INSERT INTO docs (cache_key, name, tags, timestamp) "
+            "VALUES (?, ?, ?, ?)", (cache_key, name,
+                                    json.dumps(tags, ensure_ascii=False),
+                                    timestamp)).lastrowid
+        tags = {normalize_tag(t) for t in tags}
+        self.conn.executemany("INSERT INTO tags (tag, doc) VALUES (?, ?)",
+                              [(t, doc) for t in tags])
+        # 各标签的文档数，查询时用于选择最少的倒排列表
+        self.conn.executemany(
+            "INSERT INTO tag_counts (tag, n) VALUES (?, 1) "
+            "ON CONFLICT (tag) DO UPDATE SET n = n + 1", [(t,) for t in tags])
+        self.conn.execute(
+            "INSERT INTO text (rowid, name, desc) VALUES (?, ?, ?)",
+            (doc, ' '.join(tokenize(name)), ' '.join(tokenize(desc))))
+
+    def add(self, cache_key, result, timestamp):
+        """索引（或更新）一条缓存结果，返回是否可索引"""
+        fields = self.extract(result)
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if fields is None:
+                    self._remove(cache_key)
+                else:
+                    self._add(cache_key, fields, timestamp)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return fields is not None
+
+    def remove(self, cache_key):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                removed = self._remove(cache_key)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return removed
+
+    def sync(self, cache_files, load, batch_size=500):
+        """
+        与缓存文件映射对齐: 删除已不存在的条目，补充未索引的缓存，
+        load(cache_key) 返回缓存数据或 None。返回 (补充数, 删除数)
+        """
+        indexed = {}
+        for doc, cache_key in self.execute("SELECT id, cache_key FROM docs"):
+            indexed[cache_key] = doc
+        stale = [key for key in indexed if key not in cache_files]
+        for key in stale:
+            self.remove(key)
+        added, batch = 0, []
+        for cache_key in list(cache_files):
+            if cache_key in indexed:
+                continue
+            cache_data = load(cache_key)
+            if cache_data is None:
+                continue
+            fields = self.extract(cache_data.get('result'))
+            if fields is not None:
+                batch.append((cache_key, fields, cache_data.get('timestamp')))
+            if len(batch) >= batch_size:
+                added += self._add_many(batch)
+                batch = []
+        added += self._add_many(batch)
+        return added, len(stale)
+
+    def _add_many(self, batch):
+        if not batch:
+            return 0
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for cache_key, fields, timestamp in batch:
+                    self._add(cache_key, fields, timestamp)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return len(batch)
+
+    def count_tags(self, where, args):
+        return self.conn.execute(
+            f"SELECT COALESCE(SUM(n), 0) FROM tag_counts WHERE {where}",
+            args).fetchone()[0]
+
+    def count_terms(self, terms):
+        """包含全部检索词的文档数的上界，无法估计时返回 None"""
+        counts = [self.conn.execute(
+            "SELECT doc FROM text_vocab WHERE term = ?", (t,)).fetchone()
+            for t in terms]
+        return min((c[0] if c else 0) for c in counts) if counts else None
+
+    def plan(self, tags, mode, prefix, query, terms):
+        """
+        每个条件为 (估计文档数, 表, 文档 ID 表达式, 过滤, 参数, 是否去重, 探测)，
+        探测为以 {doc} 为文档 ID 的 EXISTS 子查询
+        """
+        conditions = []
+        if tags and mode == 'and':
+            for tag in tags:
+                conditions.append((
+                    self.count_tags("tag = ?", [tag]), "tags AS d", "d.doc",
+                    "d.tag = ?", [tag], False,
+                    "EXISTS (SELECT 1 FROM tags WHERE tag = ? AND doc = {doc})"))
+        elif tags:
+            marks = ', '.join('?' * len(tags))
+            conditions.append((
+                self.count_tags(f"tag IN ({marks})", tags), "tags AS d",
+                "d.doc", f"d.tag IN ({marks})", tags, True,
+                f"EXISTS (SELECT 1 FROM tags WHERE tag IN ({marks}) "
+                "AND doc = {doc})"))
+        if prefix:
+            # 前缀范围查询，只读取主键索引中相应的一段
+            bounds = [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+            conditions.append((
+                self.count_tags("tag >= ? AND tag < ?", bounds), "tags AS d",
+                "d.doc", "d.tag >= ? AND d.tag < ?", bounds, True,
+                "EXISTS (SELECT 1 FROM tags WHERE tag >= ? AND tag < ? "
+                "AND doc = {doc})"))
+        if query:
+            estimate = self.count_terms(terms)
+            conditions.append((
+                float('inf') if estimate is None else estimate, "text AS d",
+                "d.rowid", "d.text MATCH ?", [query], False,
+                "EXISTS (SELECT 1 FROM text WHERE text MATCH ? "
+                "AND rowid = {doc})"))
+        return conditions
+
+    def search(self, tags=(), mode='and', prefix=None, text=None,
+               text_prefix=False, page=1, size=20, key_glob=None):
+        """
+        查询缓存结果，各条件之间为 AND:
+        - tags: 标签列表，mode 为 'and' 时全部包含，'or' 时包含任一；
+        - prefix: 以此开头的任一标签；
+        - text: name/desc 全文检索，text_prefix 为 True 时最后一个词按前缀匹配；
+        - key_glob: 缓存键须匹配此 GLOB 模式 (共用缓存目录时只取当前分析器
+          配置的结果，见 StorageContext.key_glob)，None 时不筛选。
+        从估计结果最少的条件出发按文档 ID 逆序（从新到旧）读取，
+        其他条件逐个文档按主键探测。返回 {'total': ..., 'results': [...]}
+        """
+        page, size = max(1, int(page)), max(1, min(int(size), MAX_PAGE_SIZE))
+        response = {'total': 0, 'page': page, 'size': size, 'results': []}
+        tags = [t for t in dict.fromkeys(map(normalize_tag, tags)) if t]
+        prefix = normalize_tag(prefix or '')
+        query, terms = match_query(text, text_prefix) if text else ('', [])
+        if text and not query:
+            return response
+        with self.lock:
+            conditions = self.plan(tags, mode, prefix, query, terms)
+            if conditions:
+                conditions.sort(key=lambda c: c[0])
+                if conditions[0][0] == 0:
+                    return response
+                _, table, doc, where, args, distinct, _ = conditions[0]
+                args = list(args)
+                for c in conditions[1:]:
+                    where += " AND " + c[6].format(doc=doc)
+                    args.extend(c[4])
+            else:
+                table, doc, where, args, distinct = \
+                    "docs AS d", "d.id", "1", [], False
+            if key_glob is not None:
+                where += (f" AND EXISTS (SELECT 1 FROM docs WHERE id = {doc} "
+                          "AND cache_key GLOB ?)")
+                args.append(key_glob)
+            core = (f"SELECT {'DISTINCT ' if distinct else ''}{doc} AS doc "
+                    f"FROM {table} WHERE {where}")
+            response['total'] = self.conn.execute(
+                f"SELECT COUNT(*) FROM ({core})", args).fetchone()[0]
+            ids = [row[0] for row in self.conn.execute(
+                f"{core} ORDER BY doc DESC LIMIT ? OFFSET ?",
+                args + [size, (page - 1) * size])]
+            rows = {row[0]: row[1:] for row in self.conn.execute(
+                "SELECT id, cache_key, name, tags, timestamp FROM docs "
+                f"WHERE id IN ({', '.join('?' * len(ids))})", ids)}
+        for doc_id in ids:
+            if doc_id in rows:
+                cache_key, name, tags, timestamp = rows[doc_id]
+                response['results'].append({
+                    'cache_key': cache_key, 'name': name,
+                    'tags': json.loads(tags or '[]'), 'timestamp': timestamp})
+        return response
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -4,62 +4,131 @@
 # Copyright (c) 2025 shmilee
 
 import os
+import re
 import sys
 import json
+import math
 import locale
-import yaml
 import base64
 import mimetypes
-import hashlib
 import time
-import shutil
 from pathlib import Path
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 from io import BytesIO
 import threading
+import logging
+import queue
+import signal
+import contextlib
+import uuid
+import select
+import socket
 # 导入现有的分析器模块
-from .analyzer import get_analyzer_config, AnalyzerMap
-import functools
-print = functools.partial(print, flush=True)
-
-
-class AnalysisServer(object):
-    """分析服务器"""
-
-    def __init__(self, config_path):
-        if config_path is None or not os.path.exists(config_path):
-            raise FileNotFoundError(f"配置文件未找到: {config_path}")
-        self.config_path = os.path.abspath(config_path)
-        self.config_dir = os.path.dirname(self.config_path)
-        print(f"配置文件: {self.config_path}")
-        # 从配置文件中读取或默认
-        self.config = self.load_config(self.config_path)
+from .analyzer import (get_analyzer_config, AnalyzerMap,
+                       AnalysisCancelled, call_limits, remaining_time)
+from .logger import setup_logging, ACCESS_LOGGER
+from .admin import TaskManager, get_admin_token, check_token
+from .prefork import CacheEvents, KeyLocks, EVENTS_MAX_SIZE
+from .peers import PeerCache, normalize_url, REPLICATE_TIMEOUT
+from .export import (CONTENT_TYPES, EXPORT_FORMATS, import_pyarrow,
+                     iter_cache_entries, iter_export, gzip_chunks, parse_time)
+from .storage import (StorageContext, cleanup_cache,
+                      cleanup_low_confidence_uploads, image_hash,
+                      analyzer_fingerprint)
+
+log = logging.getLogger(__name__)
+access_log = logging.getLogger(ACCESS_LOGGER)
+# 等待分析期间检查客户端是否断开的间隔（秒）
+DISCONNECT_CHECK_INTERVAL = 0.5
+# 多进程模式下读取其他进程缓存变更的间隔（秒）
+WORKER_SYNC_INTERVAL = 1.0
+# 重新加载配置时不能在运行中更改的设置，需要重启才能生效
+RESTART_KEYS = {
+    'cache': ('dir', 'backends', 'memory_size', 'redis_url', 'redis_prefix',
+              'redis_timeout', 'fingerprint', 'phash', 'phash_distance',
+              'search', 'job_queue', 'job_max_attempts',
+              'refresh_queue_size', 'refresh_workers', 'sweep',
+              'cleanup_on_start', 'peers', 'peer_self', 'peer_fanout'),
+    'server': ('host', 'port', 'threaded', 'workers', 'debug',
+               'frontend_root', 'sample_file', 'save_upload', 'upload_dir',
+               'reload_interval'),
+    'log': ('level', 'access_log', 'max_bytes', 'backup_count'),
+}
+
+
+class AnalysisServer(StorageContext):
+    """分析服务器，worker_id 不为 None 时作为多进程模式的工作进程"""
+
+    def __init__(self, config_path, worker_id=None):
+        super().__init__(config_path)
+        self.worker_id = worker_id
 
         # 初始化分析器
-        analyzer_config = get_analyzer_config(self.config_path)
-        analyzer_class = AnalyzerMap[analyzer_config['analyzer']]
-        self.analyzer = analyzer_class(**analyzer_config['setting'])
-        # 内存缓存
-        self.results_cache = {}
-
-        # 初始化缓存配置
-        cache_dir = self.config['cache'].get('dir')
-        if not os.path.isabs(cache_dir):
-            cache_dir = os.path.join(self.config_dir, cache_dir)
-        self.cache_dir = Path(cache_dir)
-        self.cache_max_age = self.config['cache'].get('max_age')
-        self.cleanup_on_start = self.config['cache'].get('cleanup_on_start')
-
-        # 创建缓存目录
-        self.cache_dir.mkdir(parents=True, exist_ok=True)
-        print(f"缓存目录: {self.cache_dir}")
-        print(f"缓存有效期: {self.cache_max_age / 86400:.1f} 天")
+        self.analyzer = self.create_analyzer(
+            get_analyzer_config(self.config_path), self.config,
+            self.fingerprint)
+        # 配置热加载: 修改时间用于轮询，重新加载时整体替换分析器与配置
+        self.config_mtime = os.stat(self.config_path).st_mtime_ns
+        self.reload_lock = threading.Lock()
+        self.config_watcher = None
+        # 缓存命中统计
+        self.stats = dict(memory_hits=0, disk_hits=0, near_hits=0,
+                          stale_hits=0, misses=0, errors=0,
+                          refreshes=0, refresh_errors=0, refresh_dropped=0,
+                          cancelled=0, abandoned=0, coalesced=0,
+                          peer_hits=0, peer_misses=0, peer_errors=0)
+        self.stats_lock = threading.Lock()
+        # 过期结果的后台刷新，同一缓存键同时只刷新一次
+        self.refresh_queue = queue.Queue(
+            maxsize=self.config['cache']['refresh_queue_size'])
+        self.refreshing = set()
+        self.refresh_lock = threading.Lock()
+        self.refresh_started = False
+        if self.stale_window > 0:
+            self.start_refresh_workers()
+
         # 启动时扫描缓存目录
         self.scan_cache_files()
+        # 感知哈希索引，用于查找重新压缩、缩放后的近似重复图片
+        if self.config['cache']['phash']:
+            from .phash import PHashIndex
+            self.phash_index = PHashIndex(
+                self.cache_dir / 'phash.idx',
+                self.config['cache']['phash_distance'])
+            self.phash_index.shared = worker_id is not None
+            self.phash_index.load()
+        else:
+            self.phash_index = None
+        # 检索索引与缓存文件对齐（补充未索引的缓存，删除已不存在的），
+        # 多进程模式下只在 0 号工作进程中进行
+        if self.search_index is not None and worker_id in (None, 0):
+            threading.Thread(target=self.sync_search_index, daemon=True,
+                             name='aimglyze-search-sync').start()
+        # 持久化的分析任务，服务器重启后恢复未完成的任务
+        if self.config['cache']['job_queue']:
+            from .jobs import JobStore
+            self.jobs = JobStore(self.cache_dir / 'jobs.sqlite3',
+                                 self.config['cache']['job_max_attempts'])
+            self.jobs.prune(self.cache_max_age)
+        else:
+            self.jobs = None
+        # 对等节点缓存层，本地未命中时先查询其他节点
+        cache_config = self.config['cache']
+        if cache_config['peers']:
+            self.peer_cache = PeerCache(
+                cache_config['peers'], cache_config['peer_self'],
+                cache_config['peer_timeout'], cache_config['peer_fanout'],
+                count=self.count)
+            log.info("对等节点: %s", ', '.join(self.peer_cache.ring.nodes))
+        else:
+            self.peer_cache = None
+        # 评价结果统计的列式表，首次请求时创建 (需要 NumPy)
+        self.analytics = None
+        self.analytics_lock = threading.Lock()
         # 如果配置了启动时清理，执行清理
         if self.cleanup_on_start:
-            print("启动时清理过期缓存...")
+            log.info("启动时清理过期缓存...")
             self.clean_cache_files()
 
         # 前端根目录可以是绝对路径或相对于配置文件所在目录的相对路径
@@ -67,7 +136,7 @@ class AnalysisServer(object):
         if not os.path.isabs(frontend_root):
             frontend_root = os.path.join(self.config_dir, frontend_root)
         self.frontend_root = Path(frontend_root)
-        print(f"前端根目录: {self.frontend_root}")
+        log.info("前端根目录: %s", self.frontend_root)
         # 确保前端目录存在
         if not os.path.exists(self.frontend_root):
             raise FileNotFoundError(f"前端目录不存在: {self.frontend_root}")
@@ -78,327 +147,655 @@ class AnalysisServer(object):
             sample_file = Path(os.path.join(self.config_dir, sample_file))
         self.sample_file = Path(sample_file)
         if not os.path.exists(self.sample_file):
-            print(f"警告, 示例文件不存在: {self.sample_file}")
+            log.warning("示例文件不存在: %s", self.sample_file)
             self.sample_file = None
 
-        # 获取上传保存配置
-        self.save_upload = self.config['server'].get('save_upload')
-        # 存储文件哈希映射
-        self.file_hash_map = {}
-        # 如果启用上传保存功能，确保上传目录存在并扫描已有文件
+        # 如果启用上传保存功能，启动时扫描已有文件，重建哈希映射
         if self.save_upload:
-            upload_dir = self.config['server'].get('upload_dir')
-            if not os.path.isabs(upload_dir):
-                upload_dir = Path(os.path.join(self.config_dir, upload_dir))
-            self.upload_dir = Path(upload_dir)
-            self.upload_dir.mkdir(parents=True, exist_ok=True)
-            print(f"上传目录: {self.upload_dir}")
-            # 启动时扫描已有文件，重建哈希映射
             self.scan_existing_files()
-        else:
-            self.upload_dir = None
-            print("上传保存功能已禁用，上传的文件将不会被保存")
-
-    def load_config(self, config_path):
-        """加载配置文件"""
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
-
-        # 设置缓存默认值
-        cache_config = config.get('cache', {})
-        cache_config.setdefault('dir', './cache')
-        cache_config.setdefault('max_age', 2592000)  # 30天
-        cache_config.setdefault('cleanup_on_start', False)
-
-        # 设置服务器默认值
-        server_config = config.get('server', {})
-        server_config.setdefault('host', '127.0.0.1')
-        server_config.setdefault('port', 8080)
-        server_config.setdefault('frontend_root', './frontend')
-        server_config.setdefault('sample_file', './sample-msg.json')
-        server_config.setdefault('save_upload', False)  # 上传保存开关
-        server_config.setdefault('upload_dir', './uploads')
-        server_config.setdefault('max_upload_size', 10)
-        server_config.setdefault('allowed_extensions', [
-                                 '.jpg', '.jpeg', '.png', '.webp'])
-        server_config.setdefault('debug', False)  # 调试开关
-
-        # 设置前端默认值
-        frontend_config = config.get('frontend', {})
-        frontend_config.setdefault('title', '图片分析系统')
-        frontend_config.setdefault('subtitle', '基于AI的图片分析与描述')
-        frontend_config.setdefault('theme', 'light')
-        frontend_config.setdefault('show_sample_data', True)
-
-        config['cache'] = cache_config
-        config['server'] = server_config
-        config['frontend'] = frontend_config
-
-        return config
-
-    def get_file_hash(self, image_data):
-        """计算文件的哈希值"""
-        return hashlib.sha1(image_data).hexdigest()
-
-    def scan_cache_files(self):
-        """扫描缓存目录中的已有缓存文件"""
-        print(f"正在扫描缓存目录 ...")
-        self.cache_files = {}
-        for file_path in self.cache_dir.iterdir():
-            if file_path.is_file() and file_path.suffix.lower() == '.json':
-                cache_key = file_path.stem  # 文件名作为缓存键
-                self.cache_files[cache_key] = {
-                    'path': str(file_path),
-                    'mtime': file_path.stat().st_mtime
-                }
-                print(f"找到缓存文件: {cache_key}")
-        print(f"扫描完成，找到 {len(self.cache_files)} 个缓存文件")
-
-    def scan_existing_files(self):
-        """扫描上传目录中已存在的文件，重建文件哈希映射"""
-        if not self.save_upload or self.upload_dir is None:
-            return
-
-        print(f"正在扫描上传目录 ...")
-        # 获取允许的文件扩展名
-        allowed_extensions = self.config['server']['allowed_extensions']
-        # 遍历上传目录中的所有文件
-        for file_path in self.upload_dir.iterdir():
-            if file_path.is_file():
-                # 检查文件扩展名是否在允许的列表中
-                file_ext = file_path.suffix.lower()
-                if allowed_extensions and file_ext not in allowed_extensions:
-                    print(f"跳过非允许扩展名文件: {file_path.name}")
-                    continue
-                # 从文件名中提取哈希值（{hash}{extension}）
-                file_stem = file_path.stem  # 获取不带扩展名的文件名
-                # 读取文件内容计算哈希值进行验证
-                try:
-                    with open(file_path, 'rb') as f:
-                        file_data = f.read()
-                    actual_hash = self.get_file_hash(file_data)
-                    # 验证文件名中的哈希值是否与实际文件内容匹配
-                    if file_stem != actual_hash:
-                        print(f"警告: 文件 {file_path.name} 的哈希值不匹配，跳过")
-                        continue
-                    # 添加到哈希映射中
-                    self.file_hash_map[actual_hash] = str(file_path)
-                    print(f"已添加到哈希映射: {actual_hash} -> {file_path}")
-                except Exception as e:
-                    print(f"处理文件 {file_path.name} 时出错: {str(e)}")
-        print(f"扫描完成，找到 {len(self.file_hash_map)} 个有效文件")
 
-    def save_uploaded_file(self, image_data, mime_type, file_hash):
-        """保存上传的文件，如果已存在则不重复保存"""
-        # 如果上传保存功能禁用，直接返回None
-        if not self.save_upload:
-            return None
-        # 检查是否已存在相同哈希的文件
-        if file_hash in self.file_hash_map:
-            existing_file = self.file_hash_map[file_hash]
-            print(f"文件已存在，使用现有文件: {existing_file}")
-            return existing_file
-        # 生成文件名
-        extension = mimetypes.guess_extension(mime_type) or '.jpg'
-        filename = f"{file_hash}{extension}"
-        filepath = self.upload_dir / filename
-        # 保存文件
-        with open(filepath, 'wb') as f:
-            f.write(image_data)
-        # 更新哈希映射
-        self.file_hash_map[file_hash] = str(filepath)
-        print(f"文件已保存: {filepath}")
-        return str(filepath)
-
-    def get_cache_file_path(self, cache_key):
-        """获取缓存文件路径"""
-        return self.cache_dir / f"{cache_key}.json"
-
-    def load_from_cache(self, cache_key):
-        """从缓存文件加载结果"""
-        cache_file = self.get_cache_file_path(cache_key)
-        if cache_file.exists():
+        # 多进程模式: 缓存变更日志使其他进程的内存缓存失效，
+        # 键锁使同一图片同时只在一个进程中分析
+        if worker_id is not None:
+            self.events = CacheEvents(self.cache_dir / 'events.log')
+            self.key_locks = KeyLocks(self.cache_dir / 'inflight')
+            threading.Thread(target=self.sync_worker, daemon=True,
+                             name='aimglyze-sync').start()
+        else:
+            self.key_locks = None
+
+        # 管理接口与后台维护任务，多进程模式下任务状态写入共享目录
+        self.admin_token = get_admin_token(self.config)
+        self.admin = TaskManager(
+            self, state_dir=self.cache_dir / 'admin-tasks'
+            if worker_id is not None else None)
+
+        # 停止时的排空状态，及进行中的请求与后台分析数
+        self.draining = False
+        self.inflight = 0
+        self.inflight_cond = threading.Condition()
+
+    @staticmethod
+    def create_analyzer(analyzer_config, config, fingerprint):
+        """
+        创建分析器，并记下其配置对应的缓存键指纹。
+        请求开始时取用 self.analyzer，整个请求使用同一个分析器及指纹，
+        不受期间重新加载配置的影响
+        """
+        analyzer_class = AnalyzerMap[analyzer_config['analyzer']]
+        analyzer = analyzer_class(**analyzer_config['setting'])
+        analyzer.echo_tokens = config['log']['echo_tokens']
+        analyzer.fingerprint = fingerprint
+        return analyzer
+
+    def reload_config(self):
+        """
+        重新加载配置文件: 新的请求使用新的分析器 (模型、提示词等) 与限制，
+        进行中的请求继续使用开始时的分析器。不重新扫描缓存与上传目录；
+        RESTART_KEYS 中的设置保留原值，需要重启才能生效。
+        配置无效时保留原配置，返回是否已重新加载
+        """
+        with self.reload_lock:
             try:
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                # 检查缓存是否过期
-                cache_time = cache_data.get('timestamp', 0)
-                if time.time() - cache_time < self.cache_max_age:
-                    return cache_data
-                else:
-                    print(f"缓存已过期: {cache_key}")
-                    # 过期文件不删除，由清理任务处理
-                    return None
+                mtime = os.stat(self.config_path).st_mtime_ns
+                config = self.load_config(self.config_path)
+                analyzer_config = dict(
+                    analyzer=config.get('analyzer') or 'default',
+                    setting=config.get('setting') or {})
+                fingerprint = analyzer_fingerprint(config) \
+                    if self.fingerprint else None
+                analyzer = self.create_analyzer(
+                    analyzer_config, config, fingerprint)
+            except Exception as e:
+                log.error("重新加载配置失败，继续使用原配置: %s", e)
+                return False
+            old = self.config
+            pending = []
+            for section, names in RESTART_KEYS.items():
+                for name in names:
+                    if config[section].get(name) != old[section].get(name):
+                        pending.append(f"{section}.{name}")
+                    config[section][name] = old[section].get(name)
+            if pending:
+                log.warning("以下设置需要重启才能生效: %s", ', '.join(pending))
+            if fingerprint != self.fingerprint:
+                log.info("分析器指纹: %s -> %s", self.fingerprint, fingerprint)
+            # 各自整体替换，正在处理的请求仍持有原来的分析器
+            self.analyzer = analyzer
+            self.fingerprint = fingerprint
+            self.config = config
+            self.config_mtime = mtime
+            self.cache_max_age = config['cache']['max_age']
+            self.stale_window = config['cache']['stale_while_revalidate'] or 0
+            self.admin_token = get_admin_token(config)
+            if self.stale_window > 0:
+                self.start_refresh_workers()
+            if self.peer_cache is not None:
+                self.peer_cache.timeout = float(config['cache']['peer_timeout'])
+            if self.sweeper is not None:
+                # 有效期改变时按内存中的文件映射重新计算过期时间
+                self.sweeper.reschedule(config['cache']['sweep_batch'],
+                                        config['cache']['sweep_interval'])
+            log.info("配置已重新加载: %s", self.config_path)
+            return True
+
+    def watch_config(self):
+        """按 server.reload_interval 轮询配置文件的修改时间，0 为不轮询"""
+        interval = self.config['server']['reload_interval']
+        if interval > 0 and self.config_watcher is None:
+            self.config_watcher = threading.Thread(
+                target=self.config_watch_worker, args=(interval,),
+                daemon=True, name='aimglyze-config-watch')
+            self.config_watcher.start()
+
+    def config_watch_worker(self, interval):
+        while not self.draining:
+            time.sleep(interval)
+            try:
+                mtime = os.stat(self.config_path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime != self.config_mtime:
+                # 无效的配置不反复重试，等待下一次修改
+                self.config_mtime = mtime
+                log.info("配置文件已修改，重新加载...")
+                self.reload_config()
+
+    def start_refresh_workers(self):
+        """启动后台刷新线程"""
+        with self.refresh_lock:
+            if self.refresh_started:
+                return
+            self.refresh_started = True
+        for i in range(max(1, self.config['cache']['refresh_workers'])):
+            threading.Thread(target=self.refresh_worker, daemon=True,
+                             name=f"aimglyze-refresh-{i}").start()
+
+    def get_cache_stats(self, detail=False):
+        """缓存统计，detail 为 True 时附加后台队列等信息"""
+        stats = {
+            'memory_cache_count': len(self.results_cache),
+            'disk_cache_count': len(self.cache_files),
+            'upload_files_count': len(self.file_hash_map) if self.save_upload else 0,
+            **self.stats,
+        }
+        if detail:
+            stats.update(
+                phash_count=len(self.phash_index)
+                if self.phash_index is not None else None,
+                search_count=len(self.search_index)
+                if self.search_index is not None else None,
+                peers=self.peer_cache.ring.nodes
+                if self.peer_cache is not None else None,
+                cache_backends=self.config['cache']['backends'],
+                refresh_queue=self.refresh_queue.qsize(),
+                refreshing=len(self.refreshing),
+                sweeper_pending=len(self.sweeper.heap)
+                if self.sweeper is not None else None,
+                jobs=self.jobs.counts() if self.jobs is not None else None,
+                cache_max_age=self.cache_max_age,
+                stale_window=self.stale_window,
+            )
+        return stats
+
+    @contextlib.contextmanager
+    def tracking(self):
+        """记录进行中的请求或后台分析，停止时等待其完成"""
+        with self.inflight_cond:
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self.inflight_cond:
+                self.inflight -= 1
+                self.inflight_cond.notify_all()
+
+    def drain(self, timeout):
+        """
+        等待进行中的分析完成并写入缓存（最多 timeout 秒），
+        然后停止后台清理，关闭感知哈希索引与任务队列
+        """
+        self.draining = True
+        with self.inflight_cond:
+            if self.inflight:
+                log.info("等待 %s 个进行中的请求完成（最多 %s 秒）...", self.inflight, timeout)
+            idle = self.inflight_cond.wait_for(
+                lambda: self.inflight == 0, timeout)
+        if not idle:
+            log.warning("等待超时，仍有 %s 个请求未完成%s", self.inflight,
+                        "，未完成的分析将在下次启动时恢复" if self.jobs is not None else "")
+        if self.sweeper is not None:
+            self.sweeper.stop()
+        if self.phash_index is not None:
+            self.phash_index.close()
+        if self.jobs is not None and idle:
+            self.jobs.close()
+        return idle
+
+    def count(self, name):
+        """累加命中统计"""
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def sync_worker(self):
+        """多进程模式: 定期应用其他进程的缓存变更"""
+        while True:
+            time.sleep(WORKER_SYNC_INTERVAL)
+            try:
+                self.apply_cache_events()
             except Exception as e:
-                print(f"读取缓存文件失败: {cache_key}, 错误: {str(e)}")
-                return None
+                log.warning("同步缓存变更失败: %s", e)
+
+    def apply_cache_events(self):
+        events = self.events.poll()
+        if events is None:
+            log.info("缓存变更日志已截断，清空内存缓存")
+            self.results_cache.clear()
+            events = []
+        for op, cache_key in events:
+            self.results_cache.pop(cache_key, None)
+            if op == '-':
+                self.cache_files.pop(cache_key, None)
+                continue
+            cache_file = self.get_cache_file_path(cache_key)
+            try:
+                mtime = cache_file.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            self.cache_files[cache_key] = {'path': str(cache_file),
+                                           'mtime': mtime}
+            if self.sweeper is not None:
+                self.sweeper.push(cache_key, mtime)
+        if self.phash_index is not None:
+            self.phash_index.sync()
+        if self.worker_id == 0 and self.events.size() > EVENTS_MAX_SIZE:
+            self.events.truncate()
+
+    def sync_search_index(self):
+        max_age = self.cache_max_age + self.stale_window
+        try:
+            added, removed = self.search_index.sync(
+                self.cache_index(),
+                lambda cache_key: self.load_from_cache(cache_key, max_age))
+        except Exception as e:
+            log.warning("同步检索索引失败: %s", e)
+            return
+        if added or removed:
+            log.info("检索索引: 补充 %s 条，删除 %s 条", added, removed)
+
+    def get_analytics(self):
+        """
+        返回与缓存文件对齐的统计表，只解析新增或修改的缓存，
+        未安装 NumPy 时抛出 ImportError
+        """
+        with self.analytics_lock:
+            if self.analytics is None:
+                from .analytics import ScoreTable
+                self.analytics = ScoreTable(self.cache_dir / 'analytics.npz')
+        # 统计包含全部尚未清理的缓存，不论是否过期
+        added, removed = self.analytics.refresh(
+            self.cache_index(),
+            lambda cache_key: self.load_from_cache(cache_key, math.inf))
+        if added or removed:
+            log.info("统计快照: 新增 %s 条，删除 %s 条", added, removed)
+        return self.analytics
+
+    def hold_key(self, cache_key):
+        """多进程模式下持有缓存键锁，返回是否等待过其他进程"""
+        if self.key_locks is None:
+            return contextlib.nullcontext(False)
+        return self.key_locks.hold(cache_key)
+
+    def lookup_cache(self, cache_key, stat=True):
+        """
+        依次查找内存缓存和持久缓存层，未命中返回None。
+        已过期但仍在 stale_while_revalidate 窗口内的结果也会返回，
+        由 is_stale 判断是否需要后台刷新。
+        """
+        max_age = self.cache_max_age + self.stale_window
+        # 首先检查内存缓存
+        cached_result = self.results_cache.get(cache_key)
+        if cached_result is not None:
+            # 检查内存缓存是否过期
+            if time.time() - cached_result['timestamp'] < max_age:
+                log.debug("使用内存缓存结果: %s", cache_key)
+                if stat:
+                    self.count('stale_hits' if self.is_stale(cached_result)
+                               else 'memory_hits')
+                return cached_result
+            else:
+                # 内存缓存过期，删除
+                self.results_cache.pop(cache_key, None)
+        # 然后检查磁盘缓存
+        cache_data = self.load_from_cache(cache_key, max_age)
+        if cache_data:
+            log.debug("使用磁盘缓存结果: %s", cache_key)
+            if stat:
+                self.count('stale_hits' if self.is_stale(cache_data)
+                           else 'disk_hits')
+            # 更新到内存缓存
+            self.results_cache[cache_key] = cache_data
+            return cache_data
         return None
 
-    def save_to_cache(self, cache_key, result):
-        """保存结果到缓存文件"""
-        cache_data = {
-            'result': result,
-            'timestamp': time.time(),
-            'cache_key': cache_key
-        }
-        cache_file = self.get_cache_file_path(cache_key)
+    def forget_cache(self, cache_key):
+        super().forget_cache(cache_key)
+        if self.phash_index is not None:
+            self.phash_index.remove(image_hash(cache_key))
+
+    def is_stale(self, cache_data):
+        """结果是否已超过缓存有效期（仍在 stale_while_revalidate 窗口内）"""
+        return time.time() - cache_data['timestamp'] >= self.cache_max_age
+
+    def schedule_refresh(self, cache_key, image_data, mime_type, analyzer):
+        """
+        将过期结果加入后台刷新队列，由生成缓存键的分析器刷新，
+        同一缓存键同时只刷新一次，队列已满时放弃，下次请求再尝试
+        """
+        with self.refresh_lock:
+            if cache_key in self.refreshing:
+                return False
+            try:
+                self.refresh_queue.put_nowait(
+                    (cache_key, image_data, mime_type, analyzer))
+            except queue.Full:
+                log.debug("刷新队列已满，跳过: %s", cache_key)
+                self.count('refresh_dropped')
+                return False
+            self.refreshing.add(cache_key)
+        log.info("返回过期结果，后台刷新: %s", cache_key)
+        return True
+
+    def refresh_worker(self):
+        """后台刷新线程"""
+        while True:
+            cache_key, image_data, mime_type, analyzer = \
+                self.refresh_queue.get()
+            if self.draining:
+                # 停止时不再开始新的刷新
+                with self.refresh_lock:
+                    self.refreshing.discard(cache_key)
+                continue
+            try:
+                with self.tracking():
+                    result, attempts = analyzer.chat_detail(
+                        image_data, mime_type)
+                    self.store_result(cache_key, result, attempts)
+                self.count('refreshes')
+                log.info("后台刷新完成: %s", cache_key)
+            except Exception as e:
+                log.warning("后台刷新失败: %s, 错误: %s", cache_key, e)
+                self.count('refresh_errors')
+            finally:
+                with self.refresh_lock:
+                    self.refreshing.discard(cache_key)
+
+    def lookup_peers(self, cache_key):
+        """
+        本地未命中时查询对等节点，命中的结果连同原时间戳保存到本地缓存，
+        返回缓存数据，未启用或未命中返回 None
+        """
+        if self.peer_cache is None:
+            return None
+        peer, cache_data = self.peer_cache.lookup(
+            cache_key, self.cache_max_age, remaining_time())
+        if cache_data is None:
+            self.count('peer_misses')
+            return None
+        log.info("对等节点命中: %s <- %s", cache_key, peer)
+        self.count('peer_hits')
+        return self.store_peer_result(cache_key, cache_data, peer)
+
+    def store_peer_result(self, cache_key, cache_data, peer):
+        """保存其他节点的结果，保留原时间戳，不因转存而延长有效期"""
+        cache_data = self.save_to_cache(
+            cache_key, cache_data['result'],
+            timestamp=float(cache_data['timestamp']), peer=peer)
+        self.results_cache[cache_key] = cache_data
+        return cache_data
+
+    def replicate_from_peer(self, cache_key, source):
+        """作为所有者，从分析出结果的节点拉取并保存"""
+        if self.lookup_cache(cache_key, stat=False):
+            return
         try:
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False, indent=2)
-            print(f"结果已保存到缓存: {cache_file}")
-            # 更新缓存文件映射
-            self.cache_files[cache_key] = {
-                'path': str(cache_file),
-                'mtime': cache_file.stat().st_mtime
+            cache_data = self.peer_cache.fetch(
+                source, cache_key, REPLICATE_TIMEOUT)
+        except Exception as e:
+            log.warning("从对等节点拉取失败: %s <- %s, 错误: %s", cache_key, source, e)
+            self.count('peer_errors')
+            return
+        if cache_data is not None:
+            self.store_peer_result(cache_key, cache_data, source)
+            log.info("已从对等节点拉取: %s <- %s", cache_key, source)
+
+    def lookup_similar(self, image_data, fingerprint=None):
+        """
+        按感知哈希查找近似重复图片在 fingerprint (默认为当前指纹) 下的缓存结果，
+        返回 (感知哈希, 结果)，未启用、无法计算或未命中时结果为 None
+        """
+        if self.phash_index is None:
+            return None, None
+        from .phash import dhash
+        value = dhash(image_data)
+        if value is None:
+            return None, None
+        # 索引按图片哈希记录，与分析器配置无关，可在多个应用间复用
+        for file_hash, distance in self.phash_index.query(value):
+            cache_key = self.result_key(file_hash, fingerprint)
+            cache_data = self.lookup_cache(cache_key, stat=False)
+            if cache_data is None:
+                # 当前配置下没有结果，或已过期
+                continue
+            log.info("近似重复图片: %s, 距离 %s", cache_key, distance)
+            self.count('near_hits')
+            return value, {
+                'result': cache_data['result'],
+                'cache_key': cache_key,
+                'near_duplicate': {'cache_key': cache_key,
+                                   'distance': distance},
             }
+        return value, None
+
+    def begin_job(self, cache_key, image_data, mime_type):
+        """调用服务商之前记录持久化任务"""
+        if self.jobs is not None:
+            self.jobs.enqueue(cache_key, image_data, mime_type)
+            self.jobs.start(cache_key)
+
+    def store_result(self, cache_key, result, attempts):
+        """
+        结果写入磁盘缓存和内存缓存，写入成功后才确认持久化任务完成，
+        返回缓存数据
+        """
+        try:
+            cache_data = self.save_to_cache(
+                cache_key, result, strict=True, attempts=attempts)
         except Exception as e:
-            print(f"保存缓存文件失败: {str(e)}")
-
-    def analyze_image(self, image_data, mime_type):
-        """分析图片并返回结果"""
+            if self.jobs is not None:
+                self.jobs.fail(cache_key, f"保存缓存失败: {str(e)}")
+            cache_data = {'result': result, 'timestamp': time.time(),
+                          'cache_key': cache_key, 'attempts': attempts}
+        else:
+            if self.jobs is not None:
+                self.jobs.finish(cache_key)
+        self.results_cache[cache_key] = cache_data
+        return cache_data
+
+    def resume_jobs(self):
+        """后台恢复上次未完成的分析任务"""
+        if self.jobs is None:
+            return
+        # 共享缓存目录时，只恢复当前分析器配置的任务
+        pending = [(cache_key, tried) for cache_key, tried
+                   in self.jobs.pending() if self.owns_key(cache_key)]
+        if pending:
+            log.info("恢复 %s 个未完成的分析任务", len(pending))
+            threading.Thread(target=self.run_pending_jobs, args=(pending,),
+                             daemon=True, name='aimglyze-resume').start()
+
+    def run_pending_jobs(self, pending):
+        for cache_key, tried in pending:
+            if self.draining:
+                return
+            if self.lookup_cache(cache_key, stat=False):
+                # 结果已写入缓存，只是未确认
+                self.jobs.finish(cache_key)
+                continue
+            if tried >= self.jobs.max_attempts:
+                self.jobs.fail(cache_key, f"已尝试 {tried} 次")
+                log.warning("任务尝试次数过多，不再恢复: %s", cache_key)
+                continue
+            job = self.jobs.load(cache_key)
+            if job is None:
+                self.jobs.fail(cache_key, "缺少图片数据")
+                continue
+            image_data, mime_type = job
+            with self.tracking():
+                self.jobs.start(cache_key)
+                try:
+                    result, attempts = self.analyzer.chat_detail(
+                        image_data, mime_type)
+                except Exception as e:
+                    log.error("恢复任务失败: %s, 错误: %s", cache_key, e)
+                    self.jobs.fail(cache_key, str(e))
+                    continue
+                self.store_result(cache_key, result, attempts)
+            log.info("已恢复任务: %s", cache_key)
+
+    def analyze_image(self, image_data, mime_type, file_hash=None,
+                      analyzer=None):
+        """
+        分析图片并返回结果，file_hash 为已计算好的图片哈希，
+        analyzer 默认为当前的分析器
+        """
+        cache_key = None
+        # 整个请求使用同一个分析器，重新加载配置不影响进行中的请求
+        analyzer = analyzer or self.analyzer
         try:
             # 生成缓存键
-            cache_key = self.get_file_hash(image_data)
-            # 首先检查内存缓存
-            if cache_key in self.results_cache:
-                cached_result = self.results_cache[cache_key]
-                # 检查内存缓存是否过期
-                if time.time() - cached_result['timestamp'] < self.cache_max_age:
-                    print(f"使用内存缓存结果: {cache_key}")
-                    return {'result': cached_result['result'], 'cache_key': cache_key}
-                else:
-                    # 内存缓存过期，删除
-                    del self.results_cache[cache_key]
-            # 然后检查磁盘缓存
-            cache_data = self.load_from_cache(cache_key)
+            file_hash = file_hash or self.get_file_hash(image_data)
+            cache_key = self.result_key(file_hash, analyzer.fingerprint)
+            cache_data = self.lookup_cache(cache_key)
             if cache_data:
-                print(f"使用磁盘缓存结果: {cache_key}")
-                # 更新到内存缓存
-                self.results_cache[cache_key] = cache_data
+                if self.is_stale(cache_data):
+                    self.schedule_refresh(cache_key, image_data, mime_type,
+                                          analyzer)
                 return {'result': cache_data['result'], 'cache_key': cache_key}
-
-            # 执行分析
-            print("开始分析图片...")
-            start_time = time.time()
-            result = self.analyzer.chat(image_data, mime_type)
-            if self.config['server'].get('debug', False):
-                print("[D] image_data:", image_data[:15], " ...")
-                print("[D] result:", result)
-            elapsed = time.time() - start_time
-            print(f"分析完成，耗时: {elapsed:.2f}秒")
-
-            # 保存到内存缓存
-            cache_data = {
-                'result': result,
-                'timestamp': time.time(),
-                'cache_key': cache_key
-            }
-            self.results_cache[cache_key] = cache_data
-            # 保存到磁盘缓存
-            self.save_to_cache(cache_key, result)
+            phash, similar = self.lookup_similar(
+                image_data, analyzer.fingerprint)
+            if similar:
+                return similar
+
+            with self.hold_key(cache_key):
+                # 取得锁后再查一次，其他进程可能刚写入结果
+                if self.key_locks is not None:
+                    cache_data = self.lookup_cache(cache_key, stat=False)
+                    if cache_data:
+                        self.count('coalesced')
+                        return {'result': cache_data['result'],
+                                'cache_key': cache_key}
+
+                # 其他节点可能已分析过
+                cache_data = self.lookup_peers(cache_key)
+                if cache_data:
+                    result = cache_data['result']
+                else:
+                    # 执行分析
+                    log.info("开始分析图片...")
+                    self.count('misses')
+                    self.begin_job(cache_key, image_data, mime_type)
+                    start_time = time.time()
+                    result, attempts = analyzer.chat_detail(
+                        image_data, mime_type)
+                    log.debug("[D] image_data: %r ...", image_data[:15])
+                    log.debug("[D] result: %s", result)
+                    elapsed = time.time() - start_time
+                    log.info("分析完成，耗时: %.2f秒", elapsed)
+
+                    # 保存到磁盘缓存和内存缓存，记录每次服务商调用
+                    self.store_result(cache_key, result, attempts)
+                    if self.peer_cache is not None:
+                        self.peer_cache.notify(cache_key)
+            if phash is not None:
+                self.phash_index.add(file_hash, phash)
 
             return {'result': result, 'cache_key': cache_key}
 
+        except AnalysisCancelled as e:
+            # 已取消的任务不再恢复
+            log.warning("分析已取消: %s, 原因: %s", cache_key, e)
+            self.count('cancelled')
+            if self.jobs is not None and cache_key:
+                self.jobs.fail(cache_key, str(e))
+            return {'error': str(e), 'cancelled': e.reason}
         except Exception as e:
-            print(f"分析失败: {str(e)}")
+            log.error("分析失败: %s", e)
+            self.count('errors')
+            if self.jobs is not None and cache_key:
+                self.jobs.fail(cache_key, str(e))
             return {'error': str(e)}
 
-    def clean_cache_files(self):
-        """清理过期的缓存文件"""
-        print("清理过期缓存文件...")
-        now = time.time()
-        expired_files = []
-
-        for cache_key, cache_info in list(self.cache_files.items()):
-            cache_file = Path(cache_info['path'])
-            if cache_file.exists():
-                # 检查文件修改时间
-                file_mtime = cache_file.stat().st_mtime
-                if now - file_mtime > self.cache_max_age:
-                    try:
-                        # 读取文件获取确切的时间戳
-                        with open(cache_file, 'r', encoding='utf-8') as f:
-                            cache_data = json.load(f)
-                        cache_time = cache_data.get('timestamp', file_mtime)
-
-                        if now - cache_time > self.cache_max_age:
-                            expired_files.append(cache_file)
-                    except:
-                        # 如果读取失败，使用文件修改时间
-                        if now - file_mtime > self.cache_max_age:
-                            expired_files.append(cache_file)
-
-        # 删除过期文件
-        deleted_count = 0
-        for cache_file in expired_files:
+    def analyze_images(self, items):
+        """
+        多图打包分析，items 为 [(image_data, mime_type, file_hash), ...]，
+        返回与 items 对应的结果列表。每张图片的结果分别按哈希缓存，
+        打包结果格式错误或单张结果无效时，退回逐张分析。
+        """
+        results = [None] * len(items)
+        todo, phashes = [], {}
+        analyzer = self.analyzer
+        for idx, (image_data, mime_type, file_hash) in enumerate(items):
+            file_hash = file_hash or self.get_file_hash(image_data)
+            cache_key = self.result_key(file_hash, analyzer.fingerprint)
+            cache_data = self.lookup_cache(cache_key)
+            if cache_data:
+                if self.is_stale(cache_data):
+                    self.schedule_refresh(cache_key, image_data, mime_type,
+                                          analyzer)
+                results[idx] = {'result': cache_data['result'],
+                                'cache_key': cache_key}
+                continue
+            phashes[idx], results[idx] = self.lookup_similar(
+                image_data, analyzer.fingerprint)
+            if results[idx] is not None:
+                continue
+            cache_data = self.lookup_peers(cache_key)
+            if cache_data:
+                if phashes[idx] is not None:
+                    self.phash_index.add(file_hash, phashes[idx])
+                results[idx] = {'result': cache_data['result'],
+                                'cache_key': cache_key}
+                continue
+            todo.append((idx, image_data, mime_type, file_hash, cache_key))
+        if len(todo) > 1 and not analyzer.supports_packing:
+            log.info("%s 不支持多图打包，逐张分析", analyzer.__class__.__name__)
+        elif len(todo) > 1:
+            log.info("开始打包分析 %s 张图片...", len(todo))
+            for _, image_data, mime_type, _, cache_key in todo:
+                self.begin_job(cache_key, image_data, mime_type)
+            start_time = time.time()
             try:
-                cache_file.unlink()
-                cache_key = cache_file.stem
-                if cache_key in self.cache_files:
-                    del self.cache_files[cache_key]
-                if cache_key in self.results_cache:
-                    del self.results_cache[cache_key]
-                print(f"删除过期缓存: {cache_file.name}")
-                deleted_count += 1
+                packed, attempts = analyzer.chat_many_detail(
+                    [(image_data, mime_type)
+                     for _, image_data, mime_type, _, _ in todo])
             except Exception as e:
-                print(f"删除缓存文件失败: {cache_file}, 错误: {str(e)}")
-        print(f"清理完成，删除了 {deleted_count} 个过期缓存文件")
-        return deleted_count
-
-    def clean_low_confidence_uploads(self, confidence_threshold=0.5, dry_run=False):
-        """清理低置信度的上传文件"""
-        if not self.save_upload or self.upload_dir is None:
-            print("上传保存功能未启用，无法清理上传文件")
-            return 0
-        print(f"清理置信度低于 {confidence_threshold} 的上传文件...")
-        if dry_run:
-            print("模拟运行模式 - 不会实际删除文件")
-
-        deleted_count = 0
-        # 获取允许的文件扩展名
-        allowed_extensions = self.config['server']['allowed_extensions']
-        # 遍历上传目录中的所有文件
-        for file_path in self.upload_dir.iterdir():
-            if file_path.is_file():
-                # 检查文件扩展名是否在允许的列表中
-                file_ext = file_path.suffix.lower()
-                if allowed_extensions and file_ext not in allowed_extensions:
+                log.warning("打包分析失败，逐张分析: %s", e)
+                packed, attempts = [None] * len(todo), None
+            for n, (idx, _, _, file_hash, cache_key) in enumerate(todo):
+                result = packed[n]
+                if result is None:
                     continue
-                # 从文件名中提取哈希值
-                file_stem = file_path.stem
-                # 查找对应的缓存文件
-                cache_file = self.get_cache_file_path(file_stem)
-                if cache_file.exists():
-                    try:
-                        with open(cache_file, 'r', encoding='utf-8') as f:
-                            cache_data = json.load(f)
-                        # 获取置信度
-                        result = cache_data.get('result', {})
-                        confidence = result.get('confidence', 1.0)
-                        if confidence < confidence_threshold:
-                            print(
-                                f"文件 {file_path.name} 置信度 {confidence:.2f} 低于阈值 {confidence_threshold}")
-                            if not dry_run:
-                                # 删除上传文件
-                                file_path.unlink()
-                                print(f"已删除上传文件: {file_path.name}")
-                                # 从哈希映射中移除
-                                if file_stem in self.file_hash_map:
-                                    del self.file_hash_map[file_stem]
-                                # 删除缓存文件
-                                cache_file.unlink()
-                                print(f"已删除缓存文件: {cache_file.name}")
-                                # 从内存缓存中移除
-                                if file_stem in self.results_cache:
-                                    del self.results_cache[file_stem]
-                                # 从缓存文件映射中移除
-                                if file_stem in self.cache_files:
-                                    del self.cache_files[file_stem]
-                            deleted_count += 1
-                    except Exception as e:
-                        print(f"处理文件 {file_path.name} 时出错: {str(e)}")
-        print(f"找到 {deleted_count} 个低置信度文件" + (" (模拟运行)" if dry_run else ""))
-        return deleted_count
+                self.count('misses')
+                self.store_result(cache_key, result, attempts[n])
+                if self.peer_cache is not None:
+                    self.peer_cache.notify(cache_key)
+                if phashes[idx] is not None:
+                    self.phash_index.add(file_hash, phashes[idx])
+                results[idx] = {'result': result, 'cache_key': cache_key}
+            done = sum(1 for result in packed if result is not None)
+            log.info("打包分析完成 %s/%s 张，耗时: %.2f秒",
+                     done, len(todo), time.time() - start_time)
+        for idx, image_data, mime_type, file_hash, _ in todo:
+            if results[idx] is None:
+                results[idx] = self.analyze_image(
+                    image_data, mime_type, file_hash, analyzer)
+        return results
+
+
+def parse_multipart(content_type, post_data):
+    """
+    从 multipart/form-data 请求体中提取 file 字段，返回 (image_data, mime_type)
+    """
+    # 简化的multipart解析（实际应用中建议使用email.parser或第三方库）
+    boundary = content_type.split('boundary=')[1].encode()
+    parts = post_data.split(b'--' + boundary)
+
+    image_data = None
+    mime_type = None
+    for part in parts:
+        if b'Content-Disposition: form-data; name="file"' in part:
+            # 提取文件数据
+            header_end = part.find(b'\r\n\r\n')
+            if header_end != -1:
+                image_data = part[header_end + 4:]
+                # 去掉结尾的\r\n
+                if image_data.endswith(b'\r\n'):
+                    image_data = image_data[:-2]
+                # 提取MIME类型
+                headers = part[:header_end].decode(
+                    'utf-8', errors='ignore')
+                for line in headers.split('\r\n'):
+                    if line.lower().startswith('content-type:'):
+                        mime_type = line.split(': ')[1].strip()
+                        break
+                break
+    return image_data, mime_type
+
+
+def encode_json(data):
+    """序列化 JSON 响应体"""
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
 
 
 # aimglyze-light-16x16.ico
@@ -438,6 +835,32 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.server_instance = kwargs.pop('server_instance')
         super().__init__(*args, **kwargs)
 
+    def handle_one_request(self):
+        """处理单个请求，结束后记录访问日志"""
+        self.request_id = uuid.uuid4().hex[:16]
+        self.request_start = time.perf_counter()
+        self.response_status = None
+        self.response_size = 0
+        self.disconnected = False
+        self.disconnect_checked = 0.0
+        # 一个进程挂载多个应用时请求所属应用的路径前缀，见 hosting.AppHost
+        self.mount = ''
+        with self.server_instance.tracking():
+            super().handle_one_request()
+        if self.response_status is not None:
+            self.log_access()
+
+    def send_response(self, code, message=None):
+        """记录状态码，并附加请求 ID"""
+        self.response_status = code
+        super().send_response(code, message)
+        self.send_header('X-Request-ID', self.request_id)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.response_size = int(value)
+        super().send_header(keyword, value)
+
     def do_GET(self):
         """处理GET请求"""
         parsed_path = urlparse(self.path)
@@ -451,6 +874,14 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.send_health_check()
         elif path.startswith('/api/results/'):
             self.get_cached_result(path)
+        elif path == '/api/search':
+            self.handle_search(parsed_path.query)
+        elif path == '/api/analytics':
+            self.handle_analytics(parsed_path.query)
+        elif path == '/api/export':
+            self.handle_export(parsed_path.query)
+        elif path.startswith('/api/admin/'):
+            self.handle_admin('GET', path)
         else:
             if path == '/favicon.ico':
                 self.send_favicon()
@@ -460,8 +891,13 @@ class RequestHandler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         """处理POST请求"""
-        if self.path == '/api/analyze':
+        path = urlparse(self.path).path
+        if path == '/api/analyze':
             self.handle_upload()
+        elif path.startswith('/api/admin/'):
+            self.handle_admin('POST', path)
+        elif path == '/api/peers/replicate':
+            self.handle_peer_replicate()
         else:
             self.send_error(404, "Not Found")
 
@@ -557,27 +993,27 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.send_error(500, f"Failed to load sample data: {str(e)}")
 
     def send_health_check(self):
-        """发送健康检查响应"""
+        """发送健康检查响应，停止排空时返回 503，便于负载均衡摘除节点"""
+        server = self.server_instance
         response = {
-            'status': 'ok',
+            'status': 'draining' if server.draining else 'ok',
             'timestamp': time.time(),
-            'cache_stats': {
-                'memory_cache_count': len(self.server_instance.results_cache),
-                'disk_cache_count': len(self.server_instance.cache_files),
-                'upload_files_count': len(self.server_instance.file_hash_map) if self.server_instance.save_upload else 0
-            }
+            'in_flight': server.inflight,
+            'cache_stats': server.get_cache_stats()
         }
-        self.send_json(response)
+        if server.worker_id is not None:
+            response['worker'] = {'id': server.worker_id, 'pid': os.getpid()}
+        self.send_json(response, 503 if server.draining else 200)
 
     def get_cached_result(self, path):
         """获取缓存的分析结果"""
         try:
             cache_key = path.split('/')[-1]
-            if cache_key in self.server_instance.results_cache:
-                data = self.server_instance.results_cache[cache_key]
+            data = self.server_instance.results_cache.get(cache_key)
+            if data is not None:
                 self.send_json(data)
             else:
-                # 尝试从磁盘加载
+                # 尝试从持久缓存层加载
                 cache_data = self.server_instance.load_from_cache(cache_key)
                 if cache_data:
                     # 更新到内存缓存
@@ -588,8 +1024,148 @@ class RequestHandler(BaseHTTPRequestHandler):
         except Exception as e:
             self.send_error(500, str(e))
 
+    def handle_search(self, query_string):
+        """
+        检索缓存结果:
+        - tags: 标签，逗号分隔或重复参数；mode: and (默认) 或 or
+        - tag_prefix: 以此开头的任一标签
+        - q: name/desc 全文检索，以 * 结尾时最后一个词按前缀匹配
+        - page, size: 分页，默认第 1 页，每页 20 条（最多 100）
+        - all=1: 包含共用缓存目录中其他分析器配置的结果，默认只含当前配置
+        """
+        search_index = self.server_instance.search_index
+        if search_index is None:
+            self.send_error(404, "Search disabled")
+            return
+        params = parse_qs(query_string)
+        tags = [t for value in params.get('tags', [])
+                for t in value.split(',')]
+        mode = params.get('mode', ['and'])[0].lower()
+        text = params.get('q', [''])[0].strip()
+        key_glob = None if params.get('all', ['0'])[0] not in ('0', '') \
+            else self.server_instance.key_glob()
+        try:
+            if mode not in ('and', 'or'):
+                raise ValueError("mode must be 'and' or 'or'")
+            result = search_index.search(
+                tags=tags, mode=mode,
+                prefix=params.get('tag_prefix', [''])[0],
+                text=text.rstrip('*'), text_prefix=text.endswith('*'),
+                page=int(params.get('page', ['1'])[0]),
+                size=int(params.get('size', ['20'])[0]), key_glob=key_glob)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            log.error("检索失败: %s", e)
+            self.send_error(500, str(e))
+            return
+        self.send_json(result)
+
+    def handle_analytics(self, query_string):
+        """
+        评价结果统计:
+        - cohorts=1: 按评价表标题分组的人数与平均总分
+        - title: 只统计此标题的评价表，默认全部
+        - rater: self, peer 或 teacher (默认)
+        - bins: 总分直方图的分组数，默认 10
+        - threshold: 异常值的稳健 z 分数阈值，默认 3.5
+        - all=1: 包含共用缓存目录中其他分析器配置的结果，默认只含当前配置
+        """
+        params = parse_qs(query_string)
+        owns = None if params.get('all', ['0'])[0] not in ('0', '') \
+            else self.server_instance.owns_key
+        try:
+            table = self.server_instance.get_analytics()
+            if params.get('cohorts', ['0'])[0] not in ('0', ''):
+                cohorts = table.cohorts(owns)
+                result = dict(count=sum(c['count'] for c in cohorts),
+                              cohorts=cohorts)
+            else:
+                result = table.report(
+                    title=params.get('title', [None])[0],
+                    rater=params.get('rater', ['teacher'])[0].lower(),
+                    bins=int(params.get('bins', ['10'])[0]),
+                    threshold=float(params.get('threshold', ['3.5'])[0]),
+                    owns=owns)
+        except ImportError as e:
+            log.warning("%s", e)
+            self.send_error(501, "Analytics requires NumPy")
+            return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            log.error("统计失败: %s", e)
+            self.send_error(500, str(e))
+            return
+        self.send_json(result)
+
+    def handle_export(self, query_string):
+        """
+        流式导出缓存结果:
+        - format: jsonl (默认), csv 或 parquet
+        - since, until: 时间戳范围，Unix 时间戳或 ISO 日期时间
+        - min_confidence: 置信度下限；tag: 须包含的标签
+        - all=1: 包含共用缓存目录中其他分析器配置的结果，默认只含当前配置
+        客户端接受 gzip 时压缩 JSONL/CSV，Parquet 已按列压缩
+        """
+        params = parse_qs(query_string)
+        fmt = params.get('format', ['jsonl'])[0].lower()
+        try:
+            if fmt not in EXPORT_FORMATS:
+                raise ValueError(
+                    f"format must be one of {', '.join(EXPORT_FORMATS)}")
+            since = parse_time(params.get('since', [None])[0])
+            until = parse_time(params.get('until', [None])[0])
+            min_confidence = params.get('min_confidence', [''])[0]
+            min_confidence = float(min_confidence) if min_confidence \
+                else None
+            if fmt == 'parquet':
+                import_pyarrow()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except ImportError as e:
+            log.warning("%s", e)
+            self.send_error(501, "Parquet export requires pyarrow")
+            return
+        owns = None if params.get('all', ['0'])[0] not in ('0', '') \
+            else self.server_instance.owns_key
+        entries = iter_cache_entries(
+            self.server_instance, since, until, min_confidence,
+            params.get('tag', [None])[0], owns)
+        chunks = iter_export(entries, fmt)
+        compress = fmt != 'parquet' and 'gzip' in self.headers.get(
+            'Accept-Encoding', '')
+        if compress:
+            chunks = gzip_chunks(chunks)
+        # 长度未知，写完后关闭连接表示结束
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[fmt])
+        self.send_header('Content-Disposition',
+                         f'attachment; filename="aimglyze-export.{fmt}"')
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(chunk)
+                    self.response_size += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            log.info("客户端已断开，停止导出")
+        except Exception as e:
+            # 响应头已发出，只能中断输出
+            log.error("导出失败: %s", e)
+
     def handle_upload(self):
         """处理文件上传和分析"""
+        if self.server_instance.draining:
+            self.send_error(503, "Server is draining")
+            return
         try:
             # 检查内容类型
             content_type = self.headers.get('Content-Type', '')
@@ -604,29 +1180,7 @@ class RequestHandler(BaseHTTPRequestHandler):
 
             # 解析multipart/form-data
             post_data = self.rfile.read(content_length)
-            # 简化的multipart解析（实际应用中建议使用email.parser或第三方库）
-            boundary = content_type.split('boundary=')[1].encode()
-            parts = post_data.split(b'--' + boundary)
-
-            image_data = None
-            mime_type = None
-            for part in parts:
-                if b'Content-Disposition: form-data; name="file"' in part:
-                    # 提取文件数据
-                    header_end = part.find(b'\r\n\r\n')
-                    if header_end != -1:
-                        image_data = part[header_end + 4:]
-                        # 去掉结尾的\r\n
-                        if image_data.endswith(b'\r\n'):
-                            image_data = image_data[:-2]
-                        # 提取MIME类型
-                        headers = part[:header_end].decode(
-                            'utf-8', errors='ignore')
-                        for line in headers.split('\r\n'):
-                            if line.lower().startswith('content-type:'):
-                                mime_type = line.split(': ')[1].strip()
-                                break
-                        break
+            image_data, mime_type = parse_multipart(content_type, post_data)
 
             if not image_data or not mime_type:
                 self.send_error(400, "No file uploaded")
@@ -648,7 +1202,15 @@ class RequestHandler(BaseHTTPRequestHandler):
                     image_data, mime_type, file_hash)
 
             # 分析图片
-            result = self.server_instance.analyze_image(image_data, mime_type)
+            result = self.run_analysis(image_data, mime_type, file_hash)
+            if result.get('cancelled') == 'disconnected':
+                # 客户端已断开，不再发送响应，访问日志记为 499
+                self.close_connection = True
+                self.response_status = 499
+                return
+            if result.get('cancelled') == 'timeout':
+                self.send_error(504, result['error'])
+                return
             # 在结果中添加文件信息
             if 'result' in result:
                 result['file_info'] = {
@@ -663,14 +1225,149 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.send_json(result)
 
         except Exception as e:
-            print(f"上传处理失败: {str(e)}")
+            log.error("上传处理失败: %s", e)
             self.send_error(500, str(e))
 
-    def send_json(self, data):
+    def client_disconnected(self):
+        """
+        客户端是否已断开: 请求体已读完，连接可读且读到 EOF 表示对端已关闭。
+        每 DISCONNECT_CHECK_INTERVAL 秒最多检查一次
+        """
+        now = time.monotonic()
+        if self.disconnected or now - self.disconnect_checked \
+                < DISCONNECT_CHECK_INTERVAL:
+            return self.disconnected
+        self.disconnect_checked = now
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                self.disconnected = not self.connection.recv(
+                    1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            self.disconnected = True
+        return self.disconnected
+
+    def run_analysis(self, image_data, mime_type, file_hash):
+        """
+        按请求截止时间 (server.request_timeout) 与客户端断开策略
+        (server.on_disconnect) 分析图片:
+        - cancel: 在请求线程中分析，超时或客户端断开时立即取消服务商调用；
+        - finish: 在后台线程中分析，超时或客户端断开时请求线程只停止等待，
+          分析完成后结果照常写入缓存。
+        取消或放弃时返回 {'error': ..., 'cancelled': 'timeout|disconnected'}
+        """
+        server = self.server_instance
+        config = server.config['server']
+        deadline = time.time() + config['request_timeout'] \
+            if config['request_timeout'] > 0 else None
+        if config['on_disconnect'] == 'cancel':
+            with call_limits(deadline, self.client_disconnected):
+                return server.analyze_image(image_data, mime_type, file_hash)
+
+        box = {}
+        done = threading.Event()
+
+        def work():
+            with server.tracking():
+                try:
+                    box['result'] = server.analyze_image(
+                        image_data, mime_type, file_hash)
+                finally:
+                    done.set()
+
+        threading.Thread(target=work, daemon=True,
+                         name=f"aimglyze-analyze-{self.request_id}").start()
+        while not done.wait(DISCONNECT_CHECK_INTERVAL):
+            if self.client_disconnected():
+                reason, message = 'disconnected', "客户端已断开"
+            elif deadline is not None and time.time() >= deadline:
+                reason, message = 'timeout', "超过请求截止时间"
+            else:
+                continue
+            server.count('abandoned')
+            log.warning("%s，分析在后台继续并写入缓存: %s", message, file_hash)
+            return {'error': message, 'cancelled': reason}
+        return box['result']
+
+    def handle_admin(self, method, path):
+        """
+        管理接口，需要令牌认证 (Authorization: Bearer <token>):
+        - GET /api/admin/stats: 缓存统计
+        - GET /api/admin/tasks[/<id>]: 维护任务列表或进度
+        - POST /api/admin/tasks: 提交维护任务，
+          {"kind": "clean-cache|clean-uploads|compact", "params": {...}}
+        """
+        server = self.server_instance
+        if not server.admin_token:
+            self.send_error(404, "Admin API disabled")
+            return
+        auth = self.headers.get('Authorization', '')
+        token = auth[7:] if auth.startswith('Bearer ') \
+            else self.headers.get('X-Admin-Token', '')
+        if not check_token(server.admin_token, token):
+            self.send_error(401, "Unauthorized")
+            return
+        if method == 'GET' and path == '/api/admin/stats':
+            self.send_json(server.get_cache_stats(detail=True))
+        elif method == 'GET' and path == '/api/admin/tasks':
+            self.send_json({'tasks': server.admin.list()})
+        elif method == 'GET' and path.startswith('/api/admin/tasks/'):
+            task = server.admin.get(path.split('/')[-1])
+            if task is None:
+                self.send_error(404, "Task not found")
+            else:
+                self.send_json(task.to_dict())
+        elif method == 'POST' and path == '/api/admin/tasks':
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(content_length) or b'{}')
+                params = body.get('params') or {}
+                if not isinstance(params, dict):
+                    raise ValueError("params must be an object")
+                task = server.admin.submit(body.get('kind'), params)
+            except ValueError as e:
+                self.send_error(400, str(e))
+            except RuntimeError as e:
+                self.send_error(409, str(e))
+            else:
+                self.send_json(task.to_dict(), 202)
+        else:
+            self.send_error(404, "Not Found")
+
+    def handle_peer_replicate(self):
+        """
+        其他节点通知本节点 (键的所有者) 拉取结果:
+        {"cache_key": "...", "source": "<节点地址>"}，
+        只从 peers 列表中的节点拉取，在后台进行
+        """
+        server = self.server_instance
+        peer_cache = server.peer_cache
+        if peer_cache is None:
+            self.send_error(404, "Peers disabled")
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(content_length) or b'{}')
+            cache_key = str(body.get('cache_key', ''))
+            source = normalize_url(body.get('source', ''))
+            if not re.match(r'^[0-9A-Za-z_-]+$', cache_key):
+                raise ValueError("invalid cache_key")
+        except (ValueError, AttributeError) as e:
+            self.send_error(400, str(e))
+            return
+        if source not in peer_cache.ring.nodes \
+                or source == peer_cache.self_url:
+            self.send_error(403, "Unknown peer")
+            return
+        peer_cache.executor.submit(
+            server.replicate_from_peer, cache_key, source)
+        self.send_json({'accepted': True}, 202)
+
+    def send_json(self, data, code=200):
         """发送JSON响应"""
-        response = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        response = encode_json(data)
 
-        self.send_response(200)
+        self.send_response(code)
         self.send_header('Content-Type', 'application/json; charset=utf-8')
         self.send_header('Content-Length', str(len(response)))
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -691,77 +1388,151 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         self.wfile.write(json.dumps(error_data).encode())
 
+    def log_request(self, code='-', size='-'):
+        """请求日志改由 log_access 在请求结束时统一记录"""
+        pass
+
     def log_message(self, format, *args):
         """自定义日志格式"""
-        # 检查是否为健康检查请求
-        parsed_path = urlparse(self.path)
-        if parsed_path.path == '/api/health':
-            # 只有在调试模式下才打印健康检查日志
-            if self.server_instance.config['server'].get('debug', False):
-                print(f"[{self.log_date_time_string()}] {format % args}")
-        else:
-            # 其他请求正常打印日志
-            print(f"[{self.log_date_time_string()}] {format % args}")
-
-
-def run_server(config_path):
-    """启动服务器"""
+        log.info("%s - %s", self.address_string(), format % args)
+
+    def log_access(self):
+        """记录访问日志：控制台摘要 + JSON 结构化访问日志"""
+        path = self.mount + urlparse(self.path).path
+        latency = (time.perf_counter() - self.request_start) * 1000
+        # 健康检查请求只在调试级别输出
+        level = logging.DEBUG if path.endswith('/api/health') else logging.INFO
+        if log.isEnabledFor(level):
+            log.log(level, '%s "%s %s" %s %.1fms [%s]',
+                    self.address_string(), self.command, path,
+                    self.response_status, latency, self.request_id)
+        if access_log.isEnabledFor(logging.INFO):
+            access_log.info('', extra={'access': {
+                'request_id': self.request_id,
+                'client': self.client_address[0],
+                'method': self.command,
+                'path': path,
+                'status': self.response_status,
+                'latency_ms': round(latency, 3),
+                'bytes': self.response_size,
+                'user_agent': self.headers.get('User-Agent', ''),
+            }})
+
+
+def make_http_server(server, sock=None, handler=RequestHandler):
+    """
+    根据配置创建 HTTP 服务器（port 为 0 时自动分配端口），
+    sock 为多进程模式下主进程创建的监听套接字
+    """
+    server_config = server.config['server']
+    handler_class = lambda *args, **kwargs: handler(
+        *args, **kwargs, server_instance=server)
+    if server_config['threaded']:
+        httpd_class = ThreadingHTTPServer
+    else:
+        httpd_class = HTTPServer
+    address = (server_config['host'], server_config['port'])
+    if sock is None:
+        return httpd_class(address, handler_class)
+    httpd = httpd_class(address, handler_class, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = sock
+    httpd.server_address = sock.getsockname()
+    httpd.server_name, httpd.server_port = httpd.server_address[:2]
+    return httpd
+
+
+def install_drain_handlers(server, httpd,
+                           signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    SIGTERM/SIGINT 时进入排空状态: 健康检查返回 503，拒绝新的分析请求，
+    drain_grace 秒后停止接受新连接，serve_forever 随之返回。
+    再次收到信号时立即退出。
+    """
+    grace = server.config['server']['drain_grace']
+
+    def stop_accepting():
+        if grace > 0:
+            time.sleep(grace)
+        httpd.shutdown()
+
+    def on_signal(signum, frame):
+        if server.draining:
+            log.warning("再次收到停止信号，立即退出")
+            raise SystemExit(1)
+        server.draining = True
+        log.info("收到 %s，服务器正在停止...", signal.Signals(signum).name)
+        # shutdown 会等待 serve_forever 返回，不能在主线程中调用
+        threading.Thread(target=stop_accepting, daemon=True).start()
+
+    for signum in signals:
+        signal.signal(signum, on_signal)
+
+
+def install_reload_handler(server):
+    """SIGHUP 时在后台线程中重新加载配置 (仅 Linux/macOS)"""
+    if not hasattr(signal, 'SIGHUP'):
+        return
+
+    def on_signal(signum, frame):
+        log.info("收到 SIGHUP，重新加载配置...")
+        threading.Thread(target=server.reload_config, daemon=True,
+                         name='aimglyze-reload').start()
+
+    signal.signal(signal.SIGHUP, on_signal)
+
+
+def serve(server, httpd, signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    处理请求直到收到停止信号，然后等待进行中的分析完成；
+    运行期间配置文件修改或收到 SIGHUP 时重新加载配置
+    """
+    install_drain_handlers(server, httpd, signals)
+    install_reload_handler(server)
+    server.watch_config()
+    httpd.serve_forever()
+    # 已停止接受新连接，等待进行中的分析完成
+    httpd.server_close()
+    server.drain(server.config['server']['drain_timeout'])
+
+
+def run_server(config_path, workers=None):
+    """启动服务器，workers 默认为配置中的 server.workers"""
     # debug 编码检测
-    print("Locale preferred encoding:", locale.getpreferredencoding())
-    print("sys default encoding:", sys.getdefaultencoding())
+    log.debug("Locale preferred encoding: %s", locale.getpreferredencoding())
+    log.debug("sys default encoding: %s", sys.getdefaultencoding())
 
     try:
+        workers = workers or StorageContext.load_config(
+            config_path)['server']['workers']
+        if workers > 1 and not hasattr(os, 'fork'):
+            log.warning("当前平台不支持多进程模式，使用单进程")
+            workers = 1
+        if workers > 1:
+            from .prefork import run_prefork
+            context = StorageContext(config_path)
+            setup_logging(**context.config['log'])
+            sys.exit(run_prefork(context, workers))
         # 创建服务器实例
         server = AnalysisServer(config_path)
-        server_config = server.config['server']
+        setup_logging(**server.config['log'])
+        if server.config['cache']['sweep']:
+            server.start_sweeper()
+        server.resume_jobs()
         # 创建HTTP服务器
-        handler_class = lambda *args, **kwargs: RequestHandler(
-            *args, **kwargs, server_instance=server)
-        httpd = HTTPServer(
-            (server_config['host'], server_config['port']), handler_class)
-        print(
-            f"\n🌐 服务器启动在 http://{server_config['host']}:{server_config['port']}")
-        print("⌨  按 Ctrl+C 停止服务器")
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n服务器正在停止...")
-            httpd.server_close()
-            print("服务器已停止")
-            sys.exit(0)
+        httpd = make_http_server(server)
+        host, port = httpd.server_address[:2]
+        log.info("🌐 服务器启动在 http://%s:%s", host, port)
+        if server.admin_token:
+            log.info("🔑 管理接口已启用: /api/admin/")
+        log.info("⌨  按 Ctrl+C 停止服务器")
+        serve(server, httpd)
+        log.info("服务器已停止")
+        sys.exit(0)
     except Exception as e:
-        import traceback
-        print(f"启动服务器失败: {str(e)}")
-        traceback.print_exc()
+        log.exception("启动服务器失败: %s", e)
         sys.exit(1)
 
 
-def cleanup_cache(config_path):
-    """清理过期缓存"""
-    try:
-        # 创建服务器实例以访问配置
-        server = AnalysisServer(config_path)
-        # 清理缓存文件
-        deleted_count = server.clean_cache_files()
-        return deleted_count
-    except Exception as e:
-        print(f"清理缓存失败: {str(e)}")
-        return 0
-
-
-def cleanup_low_confidence_uploads(config_path, confidence_threshold=0.5, dry_run=False):
-    """清理低置信度的上传文件"""
-    try:
-        # 创建服务器实例以访问配置
-        server = AnalysisServer(config_path)
-        # 清理低置信度文件
-        deleted_count = server.clean_low_confidence_uploads(
-            confidence_threshold, dry_run)
-        return deleted_count
-    except Exception as e:
-        print(f"清理上传文件失败: {str(e)}")
-        return 0
-
-
 if __name__ == "__main__":
     run_server('./aimglyze/apps/App-DescTags/config.yaml')
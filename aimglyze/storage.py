@@ -0,0 +1,771 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+import os
+import re
+import json
+import time
+import heapq
+import hashlib
+import mimetypes
+import threading
+import logging
+from pathlib import Path
+
+from .backends import create_backends
+
+log = logging.getLogger(__name__)
+
+
+def analyzer_fingerprint(config):
+    """
+    分析器指纹: 分析器类名与影响结果的设置的哈希，取前 12 位。
+    设置由分析器类的 fingerprint_setting 给出，修改后使用新的缓存键
+    """
+    # 维护命令只在计算指纹时才导入分析器模块 (服务商 SDK 仍在创建客户端时导入)
+    from .analyzer import Analyzer, AnalyzerMap
+    name = config.get('analyzer') or 'default'
+    setting = config.get('setting') or {}
+    # 未知的分析器由创建分析器时报错，维护命令只按通用字段计算
+    analyzer_class = AnalyzerMap.get(name, Analyzer)
+    data = dict(analyzer=name, **analyzer_class.fingerprint_setting(setting))
+    text = json.dumps(data, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+# 未包含分析器指纹的旧缓存键
+LEGACY_KEY_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def image_hash(cache_key):
+    """缓存键中的图片哈希"""
+    return cache_key.split('-', 1)[0]
+
+
+class StorageContext(object):
+    """
+    配置与存储上下文：只加载配置、缓存目录和上传目录，
+    不创建分析器、不扫描目录，供清理等维护命令快速启动。
+    """
+
+    def __init__(self, config_path):
+        if config_path is None or not os.path.exists(config_path):
+            raise FileNotFoundError(f"配置文件未找到: {config_path}")
+        self.config_path = os.path.abspath(config_path)
+        self.config_dir = os.path.dirname(self.config_path)
+        log.info("配置文件: %s", self.config_path)
+        # 从配置文件中读取或默认
+        self.config = self.load_config(self.config_path)
+        # 缓存文件映射，由 scan_cache_files 填充
+        self.cache_files = {}
+        # 后台过期清理，由 start_sweeper 启动
+        self.sweeper = None
+        # 多进程共享的缓存变更日志，见 prefork.CacheEvents
+        self.events = None
+
+        # 初始化缓存配置
+        cache_dir = self.config['cache'].get('dir')
+        if not os.path.isabs(cache_dir):
+            cache_dir = os.path.join(self.config_dir, cache_dir)
+        self.cache_dir = Path(cache_dir)
+        self.cache_max_age = self.config['cache'].get('max_age')
+        # 过期后仍可返回旧结果并后台刷新的时间窗口
+        self.stale_window = self.config['cache'].get(
+            'stale_while_revalidate') or 0
+        self.cleanup_on_start = self.config['cache'].get('cleanup_on_start')
+        # 缓存键包含分析器指纹，修改模型或提示词后旧结果不再命中
+        self.fingerprint = analyzer_fingerprint(self.config) \
+            if self.config['cache']['fingerprint'] else None
+
+        # 创建缓存目录
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        log.info("缓存目录: %s", self.cache_dir)
+        log.info("缓存有效期: %.1f 天", self.cache_max_age / 86400)
+        if self.fingerprint:
+            log.info("分析器指纹: %s", self.fingerprint)
+        # 内存缓存与持久缓存层，依次查找，写入所有层
+        self.results_cache, self.cache_backends = create_backends(self)
+        log.info("缓存层: %s", ', '.join(self.config['cache']['backends']))
+        # 标签与全文检索索引，随缓存写入、删除增量更新
+        if self.config['cache']['search']:
+            from .search import SearchIndex
+            self.search_index = SearchIndex(self.cache_dir / 'search.sqlite3')
+        else:
+            self.search_index = None
+
+        # 获取上传保存配置
+        self.save_upload = self.config['server'].get('save_upload')
+        # 存储文件哈希映射，由 scan_existing_files 填充
+        self.file_hash_map = {}
+        # 如果启用上传保存功能，确保上传目录存在
+        if self.save_upload:
+            upload_dir = self.config['server'].get('upload_dir')
+            if not os.path.isabs(upload_dir):
+                upload_dir = Path(os.path.join(self.config_dir, upload_dir))
+            self.upload_dir = Path(upload_dir)
+            self.upload_dir.mkdir(parents=True, exist_ok=True)
+            log.info("上传目录: %s", self.upload_dir)
+        else:
+            self.upload_dir = None
+            log.info("上传保存功能已禁用，上传的文件将不会被保存")
+
+    @staticmethod
+    def load_config(config_path):
+        """加载配置文件"""
+        import yaml
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = yaml.safe_load(f)
+
+        # 设置缓存默认值
+        cache_config = config.get('cache', {})
+        cache_config.setdefault('dir', './cache')
+        cache_config.setdefault('max_age', 2592000)  # 30天
+        cache_config.setdefault('cleanup_on_start', False)
+        cache_config.setdefault('phash', False)  # 感知哈希近似重复查找
+        cache_config.setdefault('phash_distance', 4)  # 最大 Hamming 距离
+        cache_config.setdefault('stale_while_revalidate', 0)  # 秒，0 为关闭
+        cache_config.setdefault('refresh_queue_size', 16)  # 后台刷新队列长度
+        cache_config.setdefault('refresh_workers', 1)  # 后台刷新线程数
+        cache_config.setdefault('sweep', False)  # 服务器运行时后台清理过期缓存
+        cache_config.setdefault('sweep_batch', 50)  # 每批最多删除的文件数
+        cache_config.setdefault('sweep_interval', 1.0)  # 批次间隔，单位秒
+        cache_config.setdefault('job_queue', True)  # 持久化分析任务，重启后恢复
+        cache_config.setdefault('job_max_attempts', 3)  # 任务最多尝试次数
+        cache_config.setdefault('search', False)  # 标签与全文检索索引
+        cache_config.setdefault('peers', [])  # 对等节点地址，本地未命中时查询
+        cache_config.setdefault('peer_self', '')  # 本节点在 peers 中的地址
+        cache_config.setdefault('peer_timeout', 0.5)  # 对等节点查询超时，单位秒
+        cache_config.setdefault('peer_fanout', 2)  # 每个键查询的节点数
+        cache_config.setdefault('fingerprint', True)  # 缓存键包含分析器指纹
+        cache_config.setdefault('backends', ['memory', 'disk'])  # 缓存层
+        cache_config.setdefault('memory_size', 0)  # 内存层最多条目数，0 不限
+        cache_config.setdefault('redis_url', 'redis://127.0.0.1:6379/0')
+        cache_config.setdefault('redis_prefix', 'aimglyze:')  # 键前缀
+        cache_config.setdefault('redis_timeout', 2.0)  # 连接与读写超时，单位秒
+
+        # 设置服务器默认值
+        server_config = config.get('server', {})
+        server_config.setdefault('host', '127.0.0.1')
+        server_config.setdefault('port', 8080)
+        server_config.setdefault('frontend_root', './frontend')
+        server_config.setdefault('sample_file', './sample-msg.json')
+        server_config.setdefault('save_upload', False)  # 上传保存开关
+        server_config.setdefault('upload_dir', './uploads')
+        server_config.setdefault('max_upload_size', 10)
+        server_config.setdefault('allowed_extensions', [
+                                 '.jpg', '.jpeg', '.png', '.webp'])
+        server_config.setdefault('debug', False)  # 调试开关
+        server_config.setdefault('threaded', True)  # 每个请求一个线程
+        server_config.setdefault('admin_token', '')  # 管理接口令牌，为空则关闭
+        server_config.setdefault('drain_timeout', 30)  # 停止时等待分析完成的秒数
+        server_config.setdefault('drain_grace', 0)  # 停止接受新连接前的等待秒数
+        server_config.setdefault('request_timeout', 0)  # 分析请求截止秒数，0 不限
+        server_config.setdefault('on_disconnect', 'finish')  # 或 cancel
+        server_config.setdefault('workers', 1)  # 工作进程数，大于 1 时多进程
+        server_config.setdefault('reload_interval', 2.0)  # 配置文件轮询秒数，0 不轮询
+
+        # 设置前端默认值
+        frontend_config = config.get('frontend', {})
+        frontend_config.setdefault('title', '图片分析系统')
+        frontend_config.setdefault('subtitle', '基于AI的图片分析与描述')
+        frontend_config.setdefault('theme', 'light')
+        frontend_config.setdefault('show_sample_data', True)
+
+        # 设置日志默认值
+        log_config = config.get('log') or {}
+        log_config.setdefault(
+            'level', 'DEBUG' if server_config['debug'] else 'INFO')
+        log_config.setdefault('echo_tokens', False)  # 流式 token 回显
+        log_config.setdefault('access_log', '')  # 为空则不写访问日志
+        log_config.setdefault('max_bytes', 10 * 1024 * 1024)
+        log_config.setdefault('backup_count', 5)
+        access_log_file = log_config['access_log']
+        if access_log_file and not os.path.isabs(access_log_file):
+            log_config['access_log'] = os.path.join(
+                os.path.dirname(os.path.abspath(config_path)), access_log_file)
+
+        config['cache'] = cache_config
+        config['server'] = server_config
+        config['frontend'] = frontend_config
+        config['log'] = log_config
+
+        return config
+
+    def get_file_hash(self, image_data):
+        """计算文件的哈希值"""
+        return hashlib.sha1(image_data).hexdigest()
+
+    def scan_cache_files(self):
+        """扫描缓存目录中的已有缓存文件"""
+        log.info("正在扫描缓存目录 ...")
+        self.cache_files = {}
+        for file_path in self.cache_dir.iterdir():
+            if file_path.is_file() and file_path.suffix.lower() == '.json':
+                cache_key = file_path.stem  # 文件名作为缓存键
+                self.cache_files[cache_key] = {
+                    'path': str(file_path),
+                    'mtime': file_path.stat().st_mtime
+                }
+                log.debug("找到缓存文件: %s", cache_key)
+        log.info("扫描完成，找到 %s 个缓存文件", len(self.cache_files))
+
+    def scan_existing_files(self):
+        """扫描上传目录中已存在的文件，重建文件哈希映射"""
+        if not self.save_upload or self.upload_dir is None:
+            return
+
+        log.info("正在扫描上传目录 ...")
+        # 获取允许的文件扩展名
+        allowed_extensions = self.config['server']['allowed_extensions']
+        # 遍历上传目录中的所有文件
+        for file_path in self.upload_dir.iterdir():
+            if file_path.is_file():
+                # 检查文件扩展名是否在允许的列表中
+                file_ext = file_path.suffix.lower()
+                if allowed_extensions and file_ext not in allowed_extensions:
+                    log.debug("跳过非允许扩展名文件: %s", file_path.name)
+                    continue
+                # 从文件名中提取哈希值（{hash}{extension}）
+                file_stem = file_path.stem  # 获取不带扩展名的文件名
+                # 读取文件内容计算哈希值进行验证
+                try:
+                    with open(file_path, 'rb') as f:
+                        file_data = f.read()
+                    actual_hash = self.get_file_hash(file_data)
+                    # 验证文件名中的哈希值是否与实际文件内容匹配
+                    if file_stem != actual_hash:
+                        log.warning("文件 %s 的哈希值不匹配，跳过", file_path.name)
+                        continue
+                    # 添加到哈希映射中
+                    self.file_hash_map[actual_hash] = str(file_path)
+                    log.debug("已添加到哈希映射: %s -> %s", actual_hash, file_path)
+                except Exception as e:
+                    log.error("处理文件 %s 时出错: %s", file_path.name, e)
+        log.info("扫描完成，找到 %s 个有效文件", len(self.file_hash_map))
+
+    def save_uploaded_file(self, image_data, mime_type, file_hash):
+        """保存上传的文件，如果已存在则不重复保存"""
+        # 如果上传保存功能禁用，直接返回None
+        if not self.save_upload:
+            return None
+        # 检查是否已存在相同哈希的文件
+        if file_hash in self.file_hash_map:
+            existing_file = self.file_hash_map[file_hash]
+            log.debug("文件已存在，使用现有文件: %s", existing_file)
+            return existing_file
+        # 生成文件名
+        extension = mimetypes.guess_extension(mime_type) or '.jpg'
+        filename = f"{file_hash}{extension}"
+        filepath = self.upload_dir / filename
+        # 保存文件
+        with open(filepath, 'wb') as f:
+            f.write(image_data)
+        # 更新哈希映射
+        self.file_hash_map[file_hash] = str(filepath)
+        log.info("文件已保存: %s", filepath)
+        return str(filepath)
+
+    def result_key(self, file_hash, fingerprint=None):
+        """
+        图片哈希对应的缓存键，启用指纹时为 <图片哈希>-<分析器指纹>，
+        fingerprint 默认为当前配置的指纹
+        """
+        fingerprint = fingerprint or self.fingerprint
+        if fingerprint:
+            return f"{file_hash}-{fingerprint}"
+        return file_hash
+
+    def owns_key(self, cache_key):
+        """缓存键是否由当前分析器配置生成"""
+        return cache_key == self.result_key(image_hash(cache_key))
+
+    def key_glob(self):
+        """当前分析器配置生成的缓存键的 GLOB 模式，供检索索引筛选"""
+        if self.fingerprint:
+            return f"*-{self.fingerprint}"
+        return '[0-9a-f]' * 40
+
+    def get_cache_file_path(self, cache_key):
+        """获取缓存文件路径"""
+        return self.cache_dir / f"{cache_key}.json"
+
+    def load_from_cache(self, cache_key, max_age=None):
+        """
+        依次从各持久缓存层加载结果，max_age 默认为缓存有效期；
+        在较后的层命中时回填前面的层，都未命中时查找旧缓存键 (见 load_legacy)
+        """
+        max_age = max_age or self.cache_max_age
+        for i, backend in enumerate(self.cache_backends):
+            try:
+                cache_data = backend.get(cache_key)
+            except Exception as e:
+                log.warning("读取缓存失败: %s %s, 错误: %s", backend.name, cache_key, e)
+                continue
+            if cache_data is None:
+                continue
+            # 检查缓存是否过期
+            if time.time() - cache_data.get('timestamp', 0) >= max_age:
+                log.debug("缓存已过期: %s", cache_key)
+                # 过期的结果不删除，由清理任务或服务器的过期时间处理
+                continue
+            for upper in self.cache_backends[:i]:
+                try:
+                    self.put_backend(upper, cache_data)
+                except Exception as e:
+                    log.warning("回填缓存失败: %s %s, 错误: %s", upper.name, cache_key, e)
+            return cache_data
+        return self.load_legacy(cache_key, max_age)
+
+    def load_legacy(self, cache_key, max_age):
+        """
+        升级前以图片哈希为键的缓存: 带指纹的缓存键未命中时读取旧键的结果，
+        视为由当前配置生成 (同 migrate-keys) 改存到新键，旧条目保留到过期，
+        共用缓存目录的其他应用仍可读取。升级后不必先迁移，已有结果不会重新分析
+        """
+        legacy_key = image_hash(cache_key)
+        if legacy_key == cache_key or not LEGACY_KEY_RE.match(legacy_key):
+            return None
+        cache_data = self.load_from_cache(legacy_key, max_age)
+        if cache_data is None:
+            return None
+        cache_data = dict(cache_data, cache_key=cache_key)
+        for backend in self.cache_backends:
+            try:
+                self.put_backend(backend, cache_data)
+            except Exception as e:
+                log.warning("改存旧缓存失败: %s %s, 错误: %s", backend.name, cache_key, e)
+        log.info("旧缓存键改为: %s -> %s", legacy_key, cache_key)
+        self.index_cache_result(cache_key, cache_data.get('result'),
+                                cache_data['timestamp'])
+        return cache_data
+
+    def save_to_cache(self, cache_key, result, strict=False, **extra):
+        """
+        保存结果到各持久缓存层，extra 为附加字段，返回缓存数据；
+        写入失败时记录错误，strict 为 True 时抛出异常
+        """
+        cache_data = {
+            'result': result,
+            'timestamp': time.time(),
+            'cache_key': cache_key,
+            **extra
+        }
+        saved = False
+        for backend in self.cache_backends:
+            try:
+                self.put_backend(backend, cache_data)
+                saved = True
+            except Exception as e:
+                log.error("保存缓存失败: %s %s, 错误: %s", backend.name, cache_key, e)
+                if strict:
+                    raise
+        if saved:
+            log.info("结果已保存到缓存: %s", cache_key)
+            self.index_cache_result(cache_key, result, cache_data['timestamp'])
+        return cache_data
+
+    def put_backend(self, backend, cache_data):
+        """写入一个持久缓存层，按剩余有效期设置过期时间"""
+        ttl = self.cache_max_age + self.stale_window \
+            - (time.time() - cache_data['timestamp'])
+        if ttl <= 0:
+            return
+        backend.put(cache_data, ttl)
+        if backend.name == 'disk':
+            self.register_cache_file(cache_data['cache_key'])
+
+    def cache_index(self):
+        """
+        最后一个持久缓存层中的条目 {cache_key: {'mtime': ...}}，
+        供检索索引与统计对齐；磁盘层即 cache_files
+        """
+        if not self.cache_backends or self.cache_backends[-1].name == 'disk':
+            return self.cache_files
+        return {cache_key: {'mtime': timestamp} for cache_key, timestamp
+                in self.cache_backends[-1].iterate()}
+
+    def cache_entries(self, since=None, owns=None):
+        """
+        逐条读取最后一个持久缓存层 (与 cache_index 相同) 中的 (cache_key, 缓存数据)，
+        供导出、打包与统计使用，since、owns 见 CacheBackend.entries；
+        没有持久层时读取本进程的内存层
+        """
+        backend = self.cache_backends[-1] if self.cache_backends \
+            else self.results_cache
+        return backend.entries(since, owns)
+
+    def require_persistent(self):
+        """维护命令从持久缓存层读取结果，只配置了内存层时抛出 ValueError"""
+        if not self.cache_backends:
+            raise ValueError("cache.backends 中没有持久缓存层 (disk 或 redis)，"
+                             "维护命令没有可读取的缓存")
+
+    def register_cache_file(self, cache_key):
+        """缓存文件写入后，更新文件映射，并通知后台清理与其他进程"""
+        cache_file = self.get_cache_file_path(cache_key)
+        mtime = cache_file.stat().st_mtime
+        self.cache_files[cache_key] = {
+            'path': str(cache_file),
+            'mtime': mtime
+        }
+        if self.sweeper is not None:
+            self.sweeper.push(cache_key, mtime)
+        if self.events is not None:
+            self.events.publish('+', cache_key)
+
+    def index_cache_result(self, cache_key, result, timestamp):
+        """把缓存结果加入检索索引，失败时只记录警告"""
+        if self.search_index is not None:
+            try:
+                self.search_index.add(cache_key, result, timestamp)
+            except Exception as e:
+                log.warning("更新检索索引失败: %s, 错误: %s", cache_key, e)
+
+    def forget_cache(self, cache_key):
+        """缓存文件删除后，移除相应的文件映射、内存缓存与其他缓存层中的结果"""
+        self.cache_files.pop(cache_key, None)
+        self.results_cache.pop(cache_key, None)
+        for backend in self.cache_backends:
+            if backend.name == 'disk':
+                continue
+            try:
+                backend.delete(cache_key)
+            except Exception as e:
+                log.warning("删除缓存失败: %s %s, 错误: %s", backend.name, cache_key, e)
+        if self.events is not None:
+            self.events.publish('-', cache_key)
+        if self.search_index is not None:
+            try:
+                self.search_index.remove(cache_key)
+            except Exception as e:
+                log.warning("更新检索索引失败: %s, 错误: %s", cache_key, e)
+
+    def start_sweeper(self):
+        """启动后台过期清理线程"""
+        if self.sweeper is None:
+            cache_config = self.config['cache']
+            self.sweeper = ExpirySweeper(self, cache_config['sweep_batch'],
+                                         cache_config['sweep_interval'])
+            self.sweeper.start()
+        return self.sweeper
+
+    def clean_cache_files(self):
+        """
+        清理各持久缓存层中的过期缓存: 磁盘层删除过期的缓存文件，
+        其他层调用 expire (Redis 层由服务器按写入时设置的过期时间删除)
+        """
+        if not self.cache_backends:
+            log.info("没有持久缓存层，无需清理")
+            return 0
+        # 仍在 stale_while_revalidate 窗口内的缓存保留
+        max_age = self.cache_max_age + self.stale_window
+        deleted_count = 0
+        for backend in self.cache_backends:
+            if backend.name == 'disk':
+                deleted_count += self.clean_disk_files(max_age)
+                continue
+            try:
+                count = backend.expire(max_age)
+            except Exception as e:
+                log.error("清理缓存失败: %s, 错误: %s", backend.name, e)
+                continue
+            log.info("清理完成，%s 层删除了 %s 个过期缓存%s", backend.name, count,
+                     "" if count else " (由服务器按过期时间删除)")
+            deleted_count += count
+        return deleted_count
+
+    def clean_disk_files(self, max_age):
+        """清理磁盘层中超过 max_age 秒的缓存文件"""
+        log.info("清理过期缓存文件...")
+        now = time.time()
+        expired_files = []
+
+        # 直接遍历目录，不依赖启动时的扫描结果
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not (entry.name.lower().endswith('.json')
+                        and entry.is_file()):
+                    continue
+                # 先用文件修改时间筛选，只解析可能过期的文件
+                file_mtime = entry.stat().st_mtime
+                if now - file_mtime > max_age:
+                    cache_file = Path(entry.path)
+                    try:
+                        # 读取文件获取确切的时间戳
+                        with open(cache_file, 'r', encoding='utf-8') as f:
+                            cache_data = json.load(f)
+                        cache_time = cache_data.get('timestamp', file_mtime)
+
+                        if now - cache_time > max_age:
+                            expired_files.append(cache_file)
+                    except Exception:
+                        # 如果读取失败，使用文件修改时间
+                        expired_files.append(cache_file)
+
+        # 删除过期文件
+        deleted_count = 0
+        for cache_file in expired_files:
+            try:
+                cache_file.unlink()
+                self.forget_cache(cache_file.stem)
+                log.info("删除过期缓存: %s", cache_file.name)
+                deleted_count += 1
+            except Exception as e:
+                log.error("删除缓存文件失败: %s, 错误: %s", cache_file, e)
+        log.info("清理完成，删除了 %s 个过期缓存文件", deleted_count)
+        return deleted_count
+
+    def migrate_cache_keys(self, dry_run=False):
+        """
+        把以图片哈希命名的旧缓存文件改为包含当前分析器指纹的缓存键，
+        视为由当前配置生成；新键已有结果时保留新的。返回 (迁移数, 跳过数)
+        """
+        if not self.fingerprint:
+            log.info("未启用分析器指纹，无需迁移")
+            return 0, 0
+        migrated = skipped = 0
+        with os.scandir(self.cache_dir) as it:
+            names = [entry.name for entry in it if entry.name.endswith('.json')
+                     and LEGACY_KEY_RE.match(entry.name[:-5])]
+        for name in names:
+            old_file = self.cache_dir / name
+            cache_key = self.result_key(name[:-5])
+            new_file = self.get_cache_file_path(cache_key)
+            try:
+                with open(old_file, 'r', encoding='utf-8') as f:
+                    cache_data = json.load(f)
+                if new_file.exists():
+                    skipped += 1
+                    if not dry_run:
+                        old_file.unlink()
+                    continue
+                migrated += 1
+                if dry_run:
+                    continue
+                cache_data['cache_key'] = cache_key
+                mtime = old_file.stat().st_mtime
+                tmp_file = new_file.with_name(f".{cache_key}.{os.getpid()}.tmp")
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(cache_data, f, ensure_ascii=False, indent=2)
+                # 保留修改时间，过期清理仍按原写入时间
+                os.utime(tmp_file, (mtime, mtime))
+                os.replace(tmp_file, new_file)
+                old_file.unlink()
+            except Exception as e:
+                log.error("迁移缓存文件失败: %s, 错误: %s", name, e)
+        log.info("迁移完成: %s 个缓存改为指纹 %s，%s 个已有新结果%s",
+                 migrated, self.fingerprint, skipped, " (模拟运行)" if dry_run else "")
+        return migrated, skipped
+
+    def clean_low_confidence_uploads(self, confidence_threshold=0.5, dry_run=False):
+        """清理低置信度的上传文件"""
+        if not self.save_upload or self.upload_dir is None:
+            log.info("上传保存功能未启用，无法清理上传文件")
+            return 0
+        log.info("清理置信度低于 %s 的上传文件...", confidence_threshold)
+        if dry_run:
+            log.info("模拟运行模式 - 不会实际删除文件")
+
+        deleted_count = 0
+        # 获取允许的文件扩展名
+        allowed_extensions = self.config['server']['allowed_extensions']
+        # 遍历上传目录中的所有文件
+        for file_path in self.upload_dir.iterdir():
+            if file_path.is_file():
+                # 检查文件扩展名是否在允许的列表中
+                file_ext = file_path.suffix.lower()
+                if allowed_extensions and file_ext not in allowed_extensions:
+                    continue
+                # 从文件名中提取哈希值
+                file_stem = file_path.stem
+                # 查找对应的缓存文件
+                cache_key = self.result_key(file_stem)
+                cache_file = self.get_cache_file_path(cache_key)
+                if cache_file.exists():
+                    try:
+                        with open(cache_file, 'r', encoding='utf-8') as f:
+                            cache_data = json.load(f)
+                        # 获取置信度
+                        result = cache_data.get('result', {})
+                        confidence = result.get('confidence', 1.0)
+                        if confidence < confidence_threshold:
+                            log.info("文件 %s 置信度 %.2f 低于阈值 %s",
+                                     file_path.name, confidence, confidence_threshold)
+                            if not dry_run:
+                                # 删除上传文件
+                                file_path.unlink()
+                                log.info("已删除上传文件: %s", file_path.name)
+                                # 从哈希映射中移除
+                                if file_stem in self.file_hash_map:
+                                    del self.file_hash_map[file_stem]
+                                # 删除缓存文件
+                                cache_file.unlink()
+                                log.info("已删除缓存文件: %s", cache_file.name)
+                                # 从内存缓存、缓存文件映射与其他缓存层中移除
+                                self.forget_cache(cache_key)
+                            deleted_count += 1
+                    except Exception as e:
+                        log.error("处理文件 %s 时出错: %s", file_path.name, e)
+        log.info("找到 %s 个低置信度文件%s", deleted_count, " (模拟运行)" if dry_run else "")
+        return deleted_count
+
+
+class ExpirySweeper(object):
+    """
+    后台过期清理：按过期时间维护最小堆，只在最早的条目到期时唤醒，
+    每批最多删除 batch_size 个文件，批次间隔 interval 秒，避免 I/O 峰值。
+    过期时间由缓存文件的修改时间推算，不扫描目录、不解析缓存文件。
+    """
+
+    def __init__(self, storage, batch_size=50, interval=1.0):
+        self.storage = storage
+        self.batch_size = max(1, int(batch_size))
+        self.interval = float(interval)
+        # [(过期时间, cache_key)]，文件重写后旧条目留在堆中，取出时跳过
+        self.heap = []
+        # 建堆时的有效期，重新加载配置后有效期改变时重建
+        self.scheduled_max_age = None
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    @property
+    def max_age(self):
+        return self.storage.cache_max_age + self.storage.stale_window
+
+    def push(self, cache_key, mtime):
+        expire_at = mtime + self.max_age
+        with self.cond:
+            heapq.heappush(self.heap, (expire_at, cache_key))
+            # 新条目最早到期时唤醒清理线程重新计时
+            if self.heap[0][1] == cache_key:
+                self.cond.notify()
+
+    def schedule(self):
+        """按缓存文件映射与当前有效期重建最小堆，返回条目数"""
+        max_age = self.max_age
+        with self.cond:
+            self.heap = [(info['mtime'] + max_age, cache_key) for cache_key,
+                         info in list(self.storage.cache_files.items())]
+            heapq.heapify(self.heap)
+            self.scheduled_max_age = max_age
+            self.cond.notify()
+            return len(self.heap)
+
+    def reschedule(self, batch_size, interval):
+        """重新加载配置后更新批次设置；有效期改变时重建堆，不扫描目录"""
+        self.batch_size = max(1, int(batch_size))
+        self.interval = float(interval)
+        if self.max_age == self.scheduled_max_age:
+            return
+        count = self.schedule()
+        log.info("缓存有效期已改变，重新计算 %s 个缓存文件的过期时间", count)
+
+    def start(self):
+        self.schedule()
+        self.thread = threading.Thread(
+            target=self.run, daemon=True, name='aimglyze-sweeper')
+        self.thread.start()
+        log.info("后台过期清理已启动，跟踪 %s 个缓存文件", len(self.heap))
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def pop_due(self):
+        """取出最多 batch_size 个到期条目，没有到期条目时等待"""
+        with self.cond:
+            while not self.stopped:
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    due = []
+                    while (self.heap and self.heap[0][0] <= now
+                           and len(due) < self.batch_size):
+                        due.append(heapq.heappop(self.heap))
+                    return due
+                timeout = self.heap[0][0] - now if self.heap else None
+                self.cond.wait(timeout)
+            return []
+
+    def expire(self, due):
+        """删除到期的缓存文件，返回删除个数"""
+        storage = self.storage
+        max_age = self.max_age
+        deleted = 0
+        for expire_at, cache_key in due:
+            info = storage.cache_files.get(cache_key)
+            # 已删除，或已重写（新的过期时间在堆中）
+            if info is None or info['mtime'] + max_age != expire_at:
+                continue
+            try:
+                mtime = os.stat(info['path']).st_mtime
+                if mtime != info['mtime']:
+                    # 被其他进程重写
+                    storage.cache_files[cache_key] = dict(info, mtime=mtime)
+                    self.push(cache_key, mtime)
+                    continue
+                os.unlink(info['path'])
+                deleted += 1
+                log.debug("删除过期缓存: %s", cache_key)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.error("删除缓存文件失败: %s, 错误: %s", info['path'], e)
+                continue
+            storage.forget_cache(cache_key)
+        return deleted
+
+    def run(self):
+        while True:
+            due = self.pop_due()
+            if not due:
+                return
+            deleted = self.expire(due)
+            if deleted:
+                log.info("后台清理删除了 %s 个过期缓存文件", deleted)
+            # 批次之间限速
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopped, self.interval)
+
+
+def cleanup_cache(config_path):
+    """清理过期缓存"""
+    try:
+        # 只加载配置和存储，不创建分析器
+        context = StorageContext(config_path)
+        # 清理缓存文件
+        deleted_count = context.clean_cache_files()
+        return deleted_count
+    except Exception as e:
+        log.error("清理缓存失败: %s", e)
+        return 0
+
+
+def cleanup_low_confidence_uploads(config_path, confidence_threshold=0.5, dry_run=False):
+    """清理低置信度的上传文件"""
+    try:
+        # 只加载配置和存储，不创建分析器
+        context = StorageContext(config_path)
+        # 清理低置信度文件
+        deleted_count = context.clean_low_confidence_uploads(
+            confidence_threshold, dry_run)
+        return deleted_count
+    except Exception as e:
+        log.error("清理上传文件失败: %s", e)
+        return 0
+
+
+def migrate_cache_keys(config_path, dry_run=False):
+    """旧缓存键迁移为包含分析器指纹的缓存键"""
+    try:
+        # 只加载配置和存储，不创建分析器
+        context = StorageContext(config_path)
+        return context.migrate_cache_keys(dry_run)
+    except Exception as e:
+        log.error("迁移缓存键失败: %s", e)
+        return 0, 0
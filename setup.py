@@ -57,6 +57,9 @@ setup(
     extras_require={
         "full": [
             "google-genai>=0.3.0",
+            "Pillow>=9.1.0",
+            "numpy>=1.22",
+            "pyarrow>=10.0",
         ],
     },
     entry_points={
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 shmilee
+
+"""
+缓存层测试: RESP2 客户端、Redis 层、create_backends 与
+内存 -> 磁盘 -> Redis 的查找与回填顺序。
+Redis 由进程内的 RESP2 替身 RespStub 提供，不需要本地 Redis 服务。
+"""
+
+import os
+import json
+import time
+import fnmatch
+import tempfile
+import threading
+import socketserver
+import unittest
+from pathlib import Path
+
+from aimglyze.backends import (RespClient, RespError, RedisBackend,
+                               MemoryBackend, DiskBackend, create_backends)
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """按 RESP2 读取命令数组，由 RespStub.dispatch 执行并写回回复"""
+
+    def handle(self):
+        self.server.connections.append(self.connection)
+        self.authed = self.server.password is None
+        while True:
+            try:
+                args = self.read_command()
+            except (ConnectionError, OSError, ValueError):
+                return
+            if args is None:
+                return
+            try:
+                reply = self.server.dispatch(self, args)
+            except Exception as e:
+                reply = RespError(f"ERR {e}")
+            try:
+                self.wfile.write(encode(reply))
+            except OSError:
+                return
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            raise ValueError(line)
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+
+def encode(reply):
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, RespError):
+        return b'-%s\r\n' % str(reply).encode('utf-8')
+    if isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode('utf-8')
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    return b'*%d\r\n' % len(reply) + b''.join(map(encode, reply))
+
+
+class RespStub(socketserver.ThreadingTCPServer):
+    """
+    进程内的 Redis 替身，支持 RedisBackend 使用的命令:
+    AUTH、SELECT、PING、GET、SET (PX)、DEL、MGET、SCAN (MATCH、COUNT)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(('127.0.0.1', 0), RespHandler)
+        self.password = password
+        self.data = {}  # {键: (值, 过期时间或 None)}
+        self.commands = []
+        self.connections = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'redis://127.0.0.1:%d/0' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+    def drop_connections(self):
+        """断开所有客户端连接，模拟服务器重启或空闲超时"""
+        for conn in self.connections:
+            try:
+                conn.shutdown(2)
+            except OSError:
+                pass
+        self.connections = []
+
+    def count(self, name):
+        return self.commands.count(name)
+
+    def live(self, key):
+        value = self.data.get(key)
+        if value is None:
+            return None
+        if value[1] is not None and value[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return value[0]
+
+    def dispatch(self, handler, args):
+        name = args[0].decode().upper()
+        args = args[1:]
+        with self.lock:
+            self.commands.append(name)
+            if name == 'AUTH':
+                if args[-1].decode() != self.password:
+                    return RespError("WRONGPASS invalid password")
+                handler.authed = True
+                return 'OK'
+            if not handler.authed:
+                return RespError("NOAUTH Authentication required")
+            if name in ('PING', 'SELECT'):
+                return 'PONG' if name == 'PING' else 'OK'
+            if name == 'GET':
+                return self.live(args[0])
+            if name == 'SET':
+                expire = None
+                if len(args) == 4 and args[2].upper() == b'PX':
+                    expire = time.monotonic() + int(args[3]) / 1000
+                self.data[args[0]] = (args[1], expire)
+                return 'OK'
+            if name == 'DEL':
+                return sum(1 for key in args
+                           if self.live(key) is not None
+                           and self.data.pop(key, None))
+            if name == 'MGET':
+                return [self.live(key) for key in args]
+            if name == 'SCAN':
+                options = {args[i].upper(): args[i + 1]
+                           for i in range(1, len(args) - 1, 2)}
+                pattern = options.get(b'MATCH', b'*').decode()
+                count = int(options.get(b'COUNT', 10))
+                keys = sorted(
+                    k for k in list(self.data) if self.live(k) is not None
+                    and fnmatch.fnmatchcase(k.decode(), pattern))
+                start = int(args[0])
+                end = start + count
+                cursor = str(end).encode() if end < len(keys) else b'0'
+                return [cursor, keys[start:end]]
+            return RespError(f"ERR unknown command '{name}'")
+
+
+def cache_data(cache_key, age=0.0, **result):
+    return dict(cache_key=cache_key, timestamp=time.time() - age,
+                result=dict(result or dict(name=cache_key)))
+
+
+class RespClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = RespStub()
+        self.client = RespClient(self.stub.url, timeout=2.0)
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+
+    def test_set_get_delete(self):
+        self.assertEqual(self.client.execute('SET', 'k', 'v'), 'OK')
+        self.assertEqual(self.client.execute('GET', 'k'), b'v')
+        self.assertEqual(self.client.execute('MGET', 'k', 'missing'),
+                         [b'v', None])
+        self.assertEqual(self.client.execute('DEL', 'k'), 1)
+        self.assertIsNone(self.client.execute('GET', 'k'))
+        self.assertEqual(self.client.execute('DEL', 'k'), 0)
+
+    def test_binary_and_unicode_values(self):
+        value = json.dumps({'name': '夜景\r\n'}, ensure_ascii=False)
+        self.client.execute('SET', '键', value)
+        self.assertEqual(self.client.execute('GET', '键').decode('utf-8'),
+                         value)
+
+    def test_error_reply(self):
+        with self.assertRaises(RespError):
+            self.client.execute('NOSUCHCOMMAND')
+        # 错误回复之后连接仍可使用
+        self.assertEqual(self.client.execute('PING'), 'PONG')
+
+    def test_reconnect_after_server_closes(self):
+        self.client.execute('SET', 'k', 'v')
+        self.stub.drop_connections()
+        self.assertEqual(self.client.execute('GET', 'k'), b'v')
+
+    def test_auth_and_select_from_url(self):
+        stub = RespStub(password='s3cret')
+        try:
+            port = stub.server_address[1]
+            client = RespClient(f'redis://:s3cret@127.0.0.1:{port}/2')
+            self.assertEqual(client.execute('PING'), 'PONG')
+            self.assertEqual(stub.commands[:2], ['AUTH', 'SELECT'])
+            client.close()
+            client = RespClient(f'redis://:wrong@127.0.0.1:{port}/0')
+            with self.assertRaises(RespError):
+                client.execute('PING')
+            client.close()
+        finally:
+            stub.stop()
+
+    def test_invalid_url(self):
+        with self.assertRaises(ValueError):
+            RespClient('http://127.0.0.1:6379/0')
+
+
+class RedisBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = RespStub()
+        self.backend = RedisBackend(self.stub.url, prefix='test:')
+
+    def tearDown(self):
+        self.backend.close()
+        self.stub.stop()
+
+    def test_put_get_delete(self):
+        self.backend.put(cache_data('a-fp'), ttl=60)
+        self.assertEqual(self.backend.get('a-fp')['result'], {'name': 'a-fp'})
+        self.assertIn(b'test:a-fp', self.stub.data)
+        self.assertTrue(self.backend.delete('a-fp'))
+        self.assertIsNone(self.backend.get('a-fp'))
+        self.assertFalse(self.backend.delete('a-fp'))
+
+    def test_ttl_sets_expiry(self):
+        self.backend.put(cache_data('a-fp'), ttl=0.05)
+        self.backend.put(cache_data('b-fp'))
+        time.sleep(0.1)
+        self.assertIsNone(self.backend.get('a-fp'))
+        self.assertIsNotNone(self.backend.get('b-fp'))
+
+    def test_entries_scan_in_batches(self):
+        self.backend.scan_count = 2
+        for i in range(5):
+            self.backend.put(cache_data(f'{i}-fp'))
+        self.backend.put(cache_data('x-other'))
+        self.stub.data[b'other:0-fp'] = (b'{}', None)
+        keys = sorted(key for key, _ in self.backend.entries())
+        self.assertEqual(keys, ['0-fp', '1-fp', '2-fp', '3-fp', '4-fp',
+                                'x-other'])
+        self.assertGreater(self.stub.count('SCAN'), 1)
+        owned = [key for key, _ in self.backend.entries(
+            owns=lambda key: key.endswith('-fp'))]
+        self.assertEqual(len(owned), 5)
+
+    def test_iterate_max_age(self):
+        self.backend.put(cache_data('new', age=10))
+        self.backend.put(cache_data('old', age=1000))
+        self.assertEqual([key for key, _ in self.backend.iterate(100)],
+                         ['new'])
+        self.assertEqual(len(list(self.backend.iterate())), 2)
+
+
+class FakeContext(object):
+
+    def __init__(self, cache_dir, backends, redis_url=''):
+        self.cache_dir = Path(cache_dir)
+        self.config = dict(cache=dict(
+            backends=backends, memory_size=0, redis_url=redis_url,
+            redis_prefix='aimglyze:', redis_timeout=2.0))
+
+
+class CreateBackendsTest(unittest.TestCase):
+
+    def test_order_and_types(self):
+        context = FakeContext('/tmp', ['memory', 'disk', 'redis'],
+                              'redis://127.0.0.1:1/0')
+        memory, backends = create_backends(context)
+        self.assertIsInstance(memory, MemoryBackend)
+        self.assertEqual([b.name for b in backends], ['disk', 'redis'])
+        self.assertIsInstance(backends[0], DiskBackend)
+
+    def test_without_memory_tier(self):
+        memory, backends = create_backends(FakeContext('/tmp', ['disk']))
+        memory['k'] = cache_data('k')
+        self.assertNotIn('k', memory)
+        self.assertEqual([b.name for b in backends], ['disk'])
+
+    def test_invalid(self):
+        for names in (['disk', 'memory'], ['disk', 'disk'], ['s3']):
+            with self.assertRaises(ValueError):
+                create_backends(FakeContext('/tmp', names))
+
+
+CONFIG = """
+analyzer: FakeAnalyzer
+setting:
+  model: fake
+  ttft: 0
+cache:
+  dir: ./cache
+  backends: {backends}
+  redis_url: "{redis_url}"
+  job_queue: false
+server:
+  frontend_root: ./frontend
+  sample_file: ./sample-msg.json
+"""
+
+
+class TierOrderTest(unittest.TestCase):
+    """内存 -> 磁盘 -> Redis 依次查找，较后的层命中时回填前面的层"""
+
+    def setUp(self):
+        from aimglyze.server import AnalysisServer
+        self.stub = RespStub()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.tmp.name, 'frontend'))
+        with open(os.path.join(self.tmp.name, 'sample-msg.json'), 'w') as f:
+            f.write('{}')
+        self.server = AnalysisServer(self.write_config(
+            ['memory', 'disk', 'redis']))
+        self.disk, self.redis = self.server.cache_backends
+        self.key = self.server.result_key('a' * 40)
+
+    def tearDown(self):
+        self.redis.close()
+        self.stub.stop()
+        self.tmp.cleanup()
+
+    def write_config(self, backends, name='config.yaml'):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(CONFIG.format(backends=json.dumps(backends),
+                                  redis_url=self.stub.url))
+        return path
+
+    def test_save_writes_every_tier(self):
+        self.server.save_to_cache(self.key, {'name': 'x'})
+        self.assertIsNotNone(self.disk.get(self.key))
+        self.assertIsNotNone(self.redis.get(self.key))
+
+    def test_redis_hit_backfills_disk_and_memory(self):
+        self.redis.put(cache_data(self.key), ttl=60)
+        self.assertIsNone(self.disk.get(self.key))
+        self.assertIsNotNone(self.server.lookup_cache(self.key))
+        self.assertIsNotNone(self.disk.get(self.key))
+        self.assertIn(self.key, self.server.results_cache)
+        self.assertEqual(self.server.stats['disk_hits'], 1)
+
+    def test_lookup_stops_at_first_hit(self):
+        data = self.server.save_to_cache(self.key, {'name': 'x'})
+        self.server.results_cache[self.key] = data
+        gets = self.stub.count('GET')
+        # 内存层命中，不读磁盘与 Redis
+        self.assertIsNotNone(self.server.lookup_cache(self.key))
+        self.assertEqual(self.server.stats['memory_hits'], 1)
+        # 磁盘层命中，不读 Redis
+        self.server.results_cache.clear()
+        self.assertIsNotNone(self.server.lookup_cache(self.key))
+        self.assertEqual(self.stub.count('GET'), gets)
+
+    def test_miss_checks_every_tier(self):
+        gets = self.stub.count('GET')
+        self.assertIsNone(self.server.lookup_cache(self.key))
+        # 带指纹的键与旧键各查一次
+        self.assertEqual(self.stub.count('GET'), gets + 2)
+
+    def test_expired_entry_is_not_returned(self):
+        self.redis.put(cache_data(self.key, age=self.server.cache_max_age
+                                  + 10))
+        self.assertIsNone(self.server.lookup_cache(self.key))
+
+    def test_maintenance_reads_redis_without_disk(self):
+        from aimglyze.storage import StorageContext
+        from aimglyze.export import iter_cache_entries
+        self.redis.put(cache_data(self.key, tags=['夜景']), ttl=60)
+        self.redis.put(cache_data(self.server.result_key('b' * 40),
+                                  tags=['风景']), ttl=60)
+        context = StorageContext(self.write_config(['memory', 'redis'],
+                                                   'redis.yaml'))
+        try:
+            context.require_persistent()
+            entries = list(iter_cache_entries(context, tag='夜景',
+                                              owns=context.owns_key))
+            self.assertEqual([e['cache_key'] for e in entries], [self.key])
+            self.assertEqual(set(context.cache_index()),
+                             {self.key, self.server.result_key('b' * 40)})
+            self.assertEqual(context.clean_cache_files(), 0)
+        finally:
+            context.cache_backends[-1].close()
+
+    def test_memory_only_is_refused(self):
+        from aimglyze.storage import StorageContext
+        context = StorageContext(self.write_config(['memory'], 'mem.yaml'))
+        with self.assertRaises(ValueError):
+            context.require_persistent()
+
+
+if __name__ == '__main__':
+    unittest.main()